@@ -1,39 +1,152 @@
-"""data/prepare.py"""
+"""
+data/prepare.py
+
+Uncompress the MIMIC-IV demo tables. Run from the project directory with
+``python -m data.prepare``.
+"""
 
 import gzip
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Optional
+
+from scraibe.storage import csv_to_parquet
+
+MIMIC_DIR = Path(__file__).parent.joinpath("mimic-iv-demo")
+FOLDERS = [MIMIC_DIR.joinpath("hosp"), MIMIC_DIR.joinpath("icu")]
+
+
+def gz_to_csv(file: Path, buffer_size: int = 1 << 20) -> Path:
+    """
+    Uncompress a .csv.gz file to a .csv file.
+
+    The file is copied through a fixed-size buffer, so memory use does not
+    depend on the size of the file.
+
+    Parameters
+    ----------
+    file : Path
+        The filepath to the .csv.gz file.
+    buffer_size : int
+        Number of bytes to copy at a time.
+
+    Returns
+    -------
+    Path
+        The filepath to the .csv file.
+    """
+
+    out_fp = file.with_suffix("").with_suffix(".csv")
+
+    # Write to a temporary file so a failed copy never leaves a partial file
+    tmp_fp = out_fp.with_suffix(".tmp")
+    try:
+        with gzip.open(file, "rb") as f_in, tmp_fp.open("wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, buffer_size)
+        tmp_fp.replace(out_fp)
+    except BaseException:
+        tmp_fp.unlink(missing_ok=True)
+        raise
+
+    return out_fp
+
+
+def gz_to_parquet(file: Path, block_size: int = 1 << 24) -> Path:
+    """
+    Convert a .csv.gz file directly to a .parquet file.
+
+    The file is decompressed and parsed in blocks of ``block_size`` bytes and
+    each block is written as its own row group, as by
+    scraibe.storage.csv_to_parquet().
 
+    Parameters
+    ----------
+    file : Path
+        The filepath to the .csv.gz file.
+    block_size : int
+        Number of bytes of CSV to parse at a time.
 
-def uncompress() -> None:
+    Returns
+    -------
+    Path
+        The filepath to the .parquet file.
+    """
+
+    out_fp = file.with_suffix("").with_suffix(".parquet")
+    return csv_to_parquet(file, out_fp, block_size=block_size)
+
+
+def uncompress_file(file: Path, archive_folder: Path, to_parquet: bool = False) -> Path:
+    """
+    Uncompress a .csv.gz file and move it to the archive folder.
+
+    Parameters
+    ----------
+    file : Path
+        The filepath to the .csv.gz file.
+    archive_folder : Path
+        The folder to move the compressed file to.
+    to_parquet : bool
+        Convert to Parquet instead of CSV.
+
+    Returns
+    -------
+    Path
+        The filepath to the uncompressed file.
+    """
+
+    out_fp = gz_to_parquet(file) if to_parquet else gz_to_csv(file)
+    print(f"Uncompressed {file} to {out_fp}")
+
+    # Move the compressed file to the archive folder
+    archive_folder.mkdir(parents=True, exist_ok=True)
+    shutil.move(file, archive_folder.joinpath(file.name))
+    print(f"Moved {file.name} to {archive_folder}.")
+
+    return out_fp
+
+
+def uncompress(
+    workers: Optional[int] = None,
+    to_parquet: bool = False,
+    folders: Optional[list[Path]] = None,
+) -> None:
     """
     Uncompress .csv.gz files
+
+    Files from all folders are uncompressed concurrently in a process pool.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    to_parquet : bool
+        Convert to Parquet instead of CSV.
+    folders : list[Path], optional
+        The folders of the .csv.gz files. Each folder's files are archived
+        to archive/<folder name> next to it. Defaults to the demo's hosp and
+        icu folders.
     """
 
-    folders = ["mimic-iv-demo/hosp", "mimic-iv-demo/icu"]
+    if folders is None:
+        folders = list(FOLDERS)
 
+    jobs = []
     for folder in folders:
+        archive_folder = folder.parent.joinpath("archive", folder.name)
+
         # Get all .csv.gz files in the folder
-        files = Path(folder).glob("*.csv.gz")
-
-        # Uncompress each file
-        for file in files:
-            with gzip.open(file, "rt") as f_in:
-                content = f_in.read()  # Read the content from the compressed file
-                print(
-                    f"Content from {file}: {content[:100]}..."
-                )  # Print first 100 characters
-
-                with open(file.with_suffix("").with_suffix(".csv"), "wt") as f_out:
-                    f_out.write(content)  # Write the content to the uncompressed file
-
-            # Move the compressed file to the archive folder
-            archive_folder = Path(folder).parent.joinpath(
-                "archive", folder.split("/")[-1]
-            )
-            archive_folder.mkdir(parents=True, exist_ok=True)
-            shutil.move(file, archive_folder.joinpath(file.name))
-            print(f"Moved {file.name} to {archive_folder}.")
+        for file in folder.glob("*.csv.gz"):
+            jobs.append((file, archive_folder))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(uncompress_file, file, archive_folder, to_parquet)
+            for file, archive_folder in jobs
+        ]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
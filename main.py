@@ -1,19 +1,31 @@
 """main.py"""
 
-import csv
+import asyncio
+import hashlib
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Optional
 from uuid import uuid4
 
-from codeinterpreterapi import File
-from fastapi import FastAPI, Form, UploadFile
+from fastapi import FastAPI, Form, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from pydantic import BaseModel
 
 from config import DATA_DIR
-from scraibe.agent import analyze_data, generate_graphs
-from scraibe.pdf import pdf_to_txt
-from scraibe.utils import del_dir
+from scraibe.agent import analyze_data, generate_visuals, load_files
+from scraibe.cache import EmbeddingCache
+from scraibe.catalog import NoteCatalog
+from scraibe.charts import CHARTS
+from scraibe.chat import ChatService
+from scraibe.dedup import DedupIndex
+from scraibe.embed import BatchEmbedder
+from scraibe.ingest import IngestPipeline, Note
+from scraibe.jobs import Job, JobManager
+from scraibe.store import get_vector_store
+from scraibe.utils import del_dir, try_lock
 
 app = FastAPI()
 
@@ -27,40 +39,230 @@ app.add_middleware(
 )
 
 
-files = [
-    File.from_path("data/split/d_hcpcs.csv"),
-    File.from_path("data/split/patients.csv"),
-    File.from_path("data/split/hcpcsevents.csv"),
-    File.from_path("data/split/icustays.csv"),
-    File.from_path("data/split/procedures_icd.csv"),
-    File.from_path("data/split/drgcodes.csv"),
-    File.from_path("data/split/transfers.csv"),
-    File.from_path("data/split/diagnoses_icd.csv"),
-    File.from_path("data/split/microbiologyevents.csv"),
-    File.from_path("data/split/outputevents.csv"),
-    File.from_path("data/split/prescriptions.csv"),
-    File.from_path("data/split/pharmacy.csv"),
-    File.from_path("data/split/d_items.csv"),
-]
+files = load_files(
+    tables=[
+        "d_hcpcs",
+        "patients",
+        "hcpcsevents",
+        "icustays",
+        "procedures_icd",
+        "drgcodes",
+        "transfers",
+        "diagnoses_icd",
+        "microbiologyevents",
+        "outputevents",
+        "prescriptions",
+        "pharmacy",
+        "d_items",
+    ]
+)
+
+jobs = JobManager()
+
+# Number of tables the code interpreter analyzes at once, each in its own session
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", 4))
+
+# Uploads are copied to disk in chunks and capped in size
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_SIZE = 50 << 20
+# Room for the metadata and multipart headers of an upload's request
+MAX_UPLOAD_OVERHEAD = 1 << 20
+
+# PDFs are converted to text and charts rendered in a process pool
+PDF_WORKERS = 2
+pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+
+NOTES_DIR = DATA_DIR.joinpath("notes")
+catalog = NoteCatalog()
+
+# Only the worker holding the lock ingests notes and saves the vector store
+INGEST_LOCK_FP = NOTES_DIR.joinpath("ingest.lock")
+RESUME_INTERVAL = 5
+
+embedder = BatchEmbedder(cache=EmbeddingCache())
+vector_store = get_vector_store()
+
+# Conversations are kept in this process's memory, so with several uvicorn
+# workers a session_id is only known to the worker that started it. Run a
+# single worker, or route each session to the same worker (sticky sessions).
+chat = ChatService(embedder, vector_store)
+
+
+def update_catalog(note: Note, state: dict) -> None:
+    # Notes uploaded before the catalog existed are added as they resume
+    catalog.add(note.id, note.metadata)
+    catalog.update(
+        note.id,
+        status=state["stage"],
+        page_count=state.get("pages"),
+        text_size=state.get("text_size"),
+        error=state.get("error"),
+    )
+
+
+pipeline = IngestPipeline(
+    embedder,
+    vector_store,
+    DedupIndex(),
+    executor=pdf_pool,
+    extract_workers=PDF_WORKERS,
+    on_state=update_catalog,
+)
+
+
+class ChatRequest(BaseModel):
+    message: str
+    session_id: Optional[str] = None
+    subject_id: Optional[int] = None
+
+
+def files_key(kind: str) -> str:
+    """
+    Identify a job by its kind and the content of the files it runs on.
+    """
+    digest = hashlib.sha256(kind.encode())
+    for file in files:
+        digest.update(file.name.encode())
+        digest.update(hashlib.sha256(file.content).digest())
+    return digest.hexdigest()
+
+
+def sse(name: str, data: dict) -> str:
+    """
+    Format a Server-Sent Event.
+    """
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def wait_for_job(job: Job) -> JSONResponse:
+    """
+    Wait for a job and respond with its result.
+
+    The job is shielded, so it keeps running for other clients if this one
+    disconnects.
+    """
+    try:
+        await asyncio.shield(job.task)
+    except asyncio.CancelledError:
+        if not job.finished:
+            raise
+    if job.status == Job.FAILED:
+        return JSONResponse(content={"error": job.error}, status_code=500)
+    return JSONResponse(content=job.result, status_code=200)
 
 
-def add_to_index(index_path: Path, file_id: str, filename: str) -> None:
+async def save_upload(file: UploadFile, fp: Path, max_size: int) -> int:
     """
-    Append file info to the index CSV.
+    Copy an upload to a file in fixed-size chunks and flush it to disk.
 
     Parameters
     ----------
-    index_path : Path
-        Path to the index CSV file.
-    file_id : str
-        Unique ID for the file.
-    filename : str
-        Original filename from the metadata.
+    file : UploadFile
+        The upload.
+    fp : Path
+        The filepath to save it to.
+    max_size : int
+        Maximum number of bytes.
+
+    Returns
+    -------
+    int
+        The number of bytes.
+
+    Raises
+    ------
+    ValueError
+        If the upload is larger than max_size.
+    """
+
+    size = 0
+    with fp.open("wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError(f"File is larger than {max_size} bytes.")
+            buffer.write(chunk)
+
+        buffer.flush()
+        await asyncio.to_thread(os.fsync, buffer.fileno())
+
+    return size
+
+
+async def ingest_notes():
+    """
+    Ingest the notes in the uvicorn worker that holds the ingest lock.
+
+    The other workers wait for the lock, and take over if that worker exits.
+    Notes uploaded to them are picked up from the catalog.
     """
+    while try_lock(INGEST_LOCK_FP) is None:
+        await asyncio.sleep(RESUME_INTERVAL)
+
+    # Load the vectors saved by the previous holder of the lock
+    await asyncio.to_thread(vector_store.refresh)
+    pipeline.start()
+    try:
+        await pipeline.resume(NOTES_DIR)
+    except Exception as e:
+        print(f"Failed to resume the notes: {e}")
+
+    while True:
+        try:
+            for note_id in catalog.pending():
+                note = Note(NOTES_DIR.joinpath(note_id))
+                if note.pdf_fp.exists():
+                    await pipeline.submit(note)
+        except Exception as e:
+            print(f"Failed to submit the pending notes: {e}")
+        await asyncio.sleep(RESUME_INTERVAL)
+
 
-    with index_path.open("a", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([file_id, filename])
+ingest_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def start_pipeline():
+    global ingest_task
+    INGEST_LOCK_FP.parent.mkdir(parents=True, exist_ok=True)
+    ingest_task = asyncio.create_task(ingest_notes())
+
+
+@app.on_event("shutdown")
+async def stop_pipeline():
+    if ingest_task is not None:
+        ingest_task.cancel()
+    await pipeline.stop()
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Reject uploads that are too large before their body is read.
+
+    The form of an upload is parsed, and its file spooled, before the
+    endpoint runs, so its size is checked on the Content-Length header.
+    """
+    if request.method == "POST" and request.url.path == "/upload/notes":
+        length = request.headers.get("content-length")
+        if length is None or not length.isdigit():
+            return JSONResponse(
+                content={"error": "Content-Length is required."}, status_code=411
+            )
+        if int(length) > MAX_UPLOAD_SIZE + MAX_UPLOAD_OVERHEAD:
+            return JSONResponse(
+                content={"error": f"File is larger than {MAX_UPLOAD_SIZE} bytes."},
+                status_code=413,
+            )
+    return await call_next(request)
 
 
 @app.get("/")
@@ -78,6 +280,10 @@ async def upload_notes(file: UploadFile = Form(...), metadata: str = Form(...)):
     """
     Upload clinical notes to the server.
 
+    The response is sent once the PDF is saved. It is then extracted,
+    chunked, embedded and stored in the background: poll /notes/{note_id}
+    for its progress.
+
     Parameters
     ----------
     file : UploadFile
@@ -97,9 +303,8 @@ async def upload_notes(file: UploadFile = Form(...), metadata: str = Form(...)):
         )
 
     basename = str(uuid4())
-    base_dir = DATA_DIR.joinpath("notes", basename)
+    base_dir = NOTES_DIR.joinpath(basename)
     pdf_fp = base_dir.joinpath(f"{basename}.pdf")
-    txt_fp = base_dir.joinpath(f"{basename}.txt")
     json_fp = base_dir.joinpath(f"{basename}.json")
 
     try:
@@ -108,61 +313,219 @@ async def upload_notes(file: UploadFile = Form(...), metadata: str = Form(...)):
 
         # Save the PDF file
         try:
-            with pdf_fp.open("wb") as buffer:
-                buffer.write(await file.read())
-        except Exception as e:
-            return JSONResponse(content={"error": str(e)}, status_code=500)
+            await save_upload(file, pdf_fp, MAX_UPLOAD_SIZE)
+        except ValueError as e:
+            del_dir(base_dir)
+            return JSONResponse(content={"error": str(e)}, status_code=413)
 
         # Save the metadata as a JSON file
-        try:
-            with json_fp.open("w") as json_file:
-                json.dump(metadata, json_file)
-        except Exception as e:
-            pdf_fp.unlink()
-            return JSONResponse(content={"error": str(e)}, status_code=500)
-
-        # Convert the pdf file to a text file
-        try:
-            pdf_to_txt(pdf_fp, txt_fp)
-        except Exception as e:
-            pdf_fp.unlink()
-            json_fp.unlink()
-            return JSONResponse(content={"error": str(e)}, status_code=500)
-
-        # Add file to index
-        index_path = DATA_DIR.joinpath("notes", "index.csv")
-        add_to_index(index_path, basename, filename)
+        with json_fp.open("w") as json_file:
+            json.dump(metadata, json_file)
 
-        return JSONResponse(
-            content={
-                "message": "Files uploaded successfully.",
-                "filename": basename,
-            },
-            status_code=200,
-        )
+        catalog.add(basename, metadata)
 
     except Exception as e:
         del_dir(base_dir)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+    # Respond once the file is saved, and ingest it in the background, here
+    # or in the worker that ingests the notes
+    if pipeline.running:
+        await pipeline.submit(Note(base_dir))
+
+    return JSONResponse(
+        content={
+            "message": "Files uploaded successfully.",
+            "filename": basename,
+        },
+        status_code=202,
+    )
+
+
+@app.get("/notes")
+async def list_notes(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    subject_id: Optional[int] = None,
+    status: Optional[str] = None,
+    filename: Optional[str] = None,
+):
+    """
+    List the uploaded notes, newest first.
+
+    Notes can be filtered by subject_id, ingestion status and the start of
+    their original filename. Pass the returned next_cursor to get the next
+    page; it is null on the last page.
+    """
+    limit = max(1, min(limit, 500))
+    try:
+        notes, next_cursor = catalog.list(
+            limit, cursor, subject_id=subject_id, status=status, filename=filename
+        )
+    except ValueError:
+        return JSONResponse(content={"error": "Invalid cursor."}, status_code=400)
+    return JSONResponse(
+        content={"notes": notes, "next_cursor": next_cursor}, status_code=200
+    )
+
+
+@app.get("/notes/{note_id}")
+async def get_note(note_id: str):
+    """
+    Get a note's catalog entry and ingestion state.
+    """
+    note = catalog.get(note_id)
+    if note is None:
+        return JSONResponse(content={"error": "Note not found."}, status_code=404)
+    state = Note(NOTES_DIR.joinpath(note_id)).state
+    return JSONResponse(content={**note, "state": state}, status_code=200)
+
+
+async def run_analysis(job: Job):
+    return await analyze_data(
+        files=files, concurrency=ANALYSIS_CONCURRENCY, on_result=job.report
+    )
+
+
+def submit_analysis_job() -> Job:
+    """
+    Submit the analysis job, or get the one already submitted.
+    """
+    return jobs.submit(
+        "analysis", files_key("analysis"), run_analysis, total=len(files)
+    )
+
+
+@app.post("/analysis")
+async def submit_analysis():
+    """
+    Submit an analysis job.
+    Poll /jobs/{job_id} for its progress and results.
+    """
+
+    job = submit_analysis_job()
+    return JSONResponse(content=job.to_dict(), status_code=202)
+
 
 @app.get("/analysis")
 async def get_analysis():
     """
-    Get the analysis from the server.
+    Get the analysis, waiting for the analysis job.
+
+    Kept for clients of the synchronous API: prefer POST /analysis or
+    /analysis/stream.
+    """
+
+    return await wait_for_job(submit_analysis_job())
+
+
+@app.get("/analysis/stream")
+async def stream_analysis():
+    """
+    Stream the analysis of each table as Server-Sent Events.
+
+    The events come from the shared analysis job, which is submitted if it is
+    not already: a "job" event gives its id, then a "result" event is sent for
+    each table already analyzed and as soon as each other table is, with its
+    file name, text and image paths, followed by a "done" event. If the
+    analysis fails, an "error" event is sent instead.
     """
-    answer = await analyze_data(files=files)
-    return JSONResponse(content=answer, status_code=200)
+
+    job = submit_analysis_job()
+
+    async def events():
+        yield sse("job", {"job_id": job.id})
+        try:
+            async for name, data in job.subscribe():
+                yield sse("result", {"name": name, **data})
+        except Exception as e:
+            yield sse("error", {"error": str(e)})
+            return
+        yield sse("done", {})
+
+    return event_stream(events())
+
+
+async def run_graphs(job: Job):
+    # Standard charts are rendered locally, without an analysis
+    data = await analyze_data(
+        files=[f for f in files if f.name not in CHARTS],
+        concurrency=ANALYSIS_CONCURRENCY,
+    )
+    return await generate_visuals(
+        files=files, data=data, on_result=job.report, executor=pdf_pool
+    )
+
+
+def submit_graphs_job() -> Job:
+    """
+    Submit the graphs job, or get the one already submitted.
+    """
+    return jobs.submit("graphs", files_key("graphs"), run_graphs, total=len(files))
+
+
+@app.post("/graphs")
+async def submit_graphs():
+    """
+    Submit a graphs job.
+    Poll /jobs/{job_id} for its progress and results.
+    """
+
+    job = submit_graphs_job()
+    return JSONResponse(content=job.to_dict(), status_code=202)
 
 
 @app.get("/graphs")
 async def get_graphs():
     """
-    Get the graphs from the server.
+    Get the graphs, waiting for the graphs job.
+
+    Kept for clients of the synchronous API: prefer POST /graphs.
+    """
+
+    return await wait_for_job(submit_graphs_job())
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Get the status, progress and (partial) results of a job.
     """
-    data = await analyze_data(files=files)
-    answer = await generate_graphs(files=files, data=data)
-    return JSONResponse(content=answer, status_code=200)
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found."}, status_code=404)
+    return JSONResponse(content=job.to_dict(), status_code=200)
+
+
+@app.post("/chat")
+async def post_chat(request: ChatRequest):
+    """
+    Send a message to the bot and stream its reply as Server-Sent Events.
+
+    A "session" event gives the session_id to continue the conversation with,
+    then "token" events carry the reply as it is generated, followed by a
+    "done" event. If the reply fails, an "error" event is sent instead.
+    Notes are retrieved from the given subject_id's notes if one is set.
+    An unknown session_id, e.g. one started by another worker, starts a new
+    conversation.
+    """
+
+    session = chat.get_session(request.session_id)
+    filters = {}
+    if request.subject_id is not None:
+        filters["subject_id"] = request.subject_id
+
+    async def events():
+        yield sse("session", {"session_id": session.id})
+        try:
+            async for content in chat.stream(session, request.message, **filters):
+                yield sse("token", {"content": content})
+        except Exception as e:
+            yield sse("error", {"error": str(e)})
+            return
+        yield sse("done", {})
+
+    return event_stream(events())
 
 
 @app.get("/get_image/{image_path:path}")
@@ -1,28 +1,132 @@
 """scraibe/agent.py"""
+
+import asyncio
+import csv
+import hashlib
+import json
+import shutil
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional
 from uuid import uuid4
 
 import openai
-import pandas as pd
 from codeinterpreterapi import CodeInterpreterSession, File
-from codeinterpreterapi.schema import CodeInterpreterResponse
 from dotenv import load_dotenv
 
 from config import DATA_DIR, PROJECT_DIR
 from scraibe import SUBJECT_ID
-from scraibe.db import connect
+from scraibe.cache import ResultCache, get_result_cache
+from scraibe.charts import CHARTS, render_charts
+from scraibe.db import ConnectionPool, connect, get_tables_with_column
+from scraibe.embed import count_tokens
+from scraibe.storage import (
+    cache_table,
+    load_schema,
+    partition_by_subject,
+    read_table,
+    to_csv,
+    write_table,
+)
+from scraibe.subject_index import SubjectIndex
+from scraibe.utils import file_digest
 
 load_dotenv(PROJECT_DIR.joinpath(".env"))
 
+MODEL = "gpt-4"
+
+# The request for each table's analysis
+ANALYSIS_REQUEST = (
+    "You're a seasoned medical data scientist with expertise in generating insightful visualizations. "
+    "Examine the provided dataset with a sharp clinical perspective. "
+    "Break down its primary features and present concise summaries to illuminate the essence of the data. "
+    "Dive into the dataset from various perspectives to obtain an initial grasp of its potential. "
+    "Your analysis should provide the data science team with rich, multidimensional insights. "
+    "Only generate visualizations if they are truly meaningful. "
+    "It is not required to generate a visual for each dataset table. "
+    "Logically analyze and build on top of each table, which composes a part of the dataset as a whole. "
+    "Build on top of each table's analysis to provided a holistic analysis that can be used in future. "
+    "YOU ARE ONLY PROVIDED AND SHOULD ANALYZE DATA OF 1 PATIENT."
+)
+
+# The request for each table's summary
+SUMMARY_REQUEST = (
+    "You're a seasoned medical data scientist with expertise in generating insightful visualizations. "
+    "Examine the provided dataset with a sharp clinical perspective. "
+    "Summarize the key findings of the analysis to provide a summary of the patient's medical history. "
+    "YOU ARE ONLY PROVIDED AND SHOULD ANALYZE DATA OF 1 PATIENT."
+)
+
+
+def export_table(cur, query: str, file_path: Path, batch_size: int = 10_000) -> int:
+    """
+    Stream the results of a query to a CSV file.
+
+    Rows are fetched from the cursor in batches of at most ``batch_size`` and
+    appended to the file as they arrive, so memory use does not depend on the
+    size of the table.
+
+    Parameters
+    ----------
+    cur
+        DB-API cursor to execute the query on.
+    query : str
+        The query to execute.
+    file_path : Path
+        The filepath to the output CSV file.
+    batch_size : int
+        Maximum number of rows to hold in memory at once.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+
+    cur.execute(query)
+    columns = [col[0] for col in cur.description]
+
+    n_rows = 0
+    with file_path.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.writerows(rows)
+            n_rows += len(rows)
+
+    return n_rows
+
 
-def get_data():
+def get_data(
+    db_dir: Path = None,
+    batch_size: int = 10_000,
+    workers: int = 4,
+    subject_ids: Optional[list[int]] = None,
+):
     """
     Get data from the database and save it to /db/mimic/*.csv.
     Only fetch rows where subject_id == SUBJECT_ID if possible.
-    """
 
-    # Connect to the database and get the cursor
-    conn = connect()
-    cur = conn.cursor()
+    Tables are exported concurrently, each over its own pooled connection.
+    When ``subject_ids`` is given, each table is fetched once for the whole
+    cohort with a single ``WHERE subject_id IN (...)`` query.
+
+    Parameters
+    ----------
+    db_dir : Path
+        Directory to save the CSV files to. Defaults to /db/mimic.
+    batch_size : int
+        Number of rows fetched from the database per round trip.
+    workers : int
+        Number of tables to export in parallel.
+    subject_ids : list[int], optional
+        The cohort to fetch. Defaults to [SUBJECT_ID].
+    """
 
     # List of all tables
     tables = [
@@ -41,108 +145,525 @@ def get_data():
         "transfers",
     ]
 
-    db_dir = PROJECT_DIR.joinpath("db", "mimic")
+    if db_dir is None:
+        db_dir = PROJECT_DIR.joinpath("db", "mimic")
 
-    for table in tables:
-        print(f"Fetching data from {table}")
+    if subject_ids is None:
+        subject_ids = [SUBJECT_ID]
+    subject_filter = (
+        f" WHERE subject_id IN ({', '.join(str(int(sid)) for sid in subject_ids)})"
+    )
 
-        # Check if the table has a subject_id column
-        # If it has, filter the data by SUBJECT_ID
-        query = f"SELECT * FROM {table}"
-        if table != "patients":  # patients table always has subject_id
-            try:
-                cur.execute(f"SELECT subject_id FROM {table} LIMIT 1")
-                query += f" WHERE subject_id = {SUBJECT_ID}"
-            except:
-                pass
+    with ConnectionPool(size=workers, connect_fn=connect) as pool:
+        # Look up which tables have a subject_id column in one round trip
+        with pool.connection() as conn:
+            subject_tables = get_tables_with_column(conn, "subject_id", tables)
 
-        df = pd.read_sql_query(query, conn)
+        def fetch(table: str) -> None:
+            print(f"Fetching data from {table}")
 
-        # Save the dataframe to a CSV file
-        filename = table + ".csv"
-        file_path = db_dir.joinpath(filename)
-        df.to_csv(file_path, index=False)
-        print(f"Saved data from {table} to {file_path}")
+            # If the table has a subject_id column, filter the data by the cohort
+            query = f"SELECT * FROM {table}"
+            if table in subject_tables:
+                query += subject_filter
 
-    cur.close()
-    conn.close()
+            # Stream the rows to a CSV file
+            file_path = db_dir.joinpath(table + ".csv")
+            with pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    n_rows = export_table(cur, query, file_path, batch_size)
+                finally:
+                    cur.close()
+            print(f"Saved {n_rows} rows from {table} to {file_path}")
 
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume the results to re-raise any exception from the workers
+            list(executor.map(fetch, tables))
 
-def prepare_data():
+
+def split_table(fp: Path, shared_fp: Path, subject_fps: dict[int, Path]) -> bool:
+    """
+    Split a CSV file into one file per subject.
+
+    Each subject's rows are copied straight out of the file using its
+    SubjectIndex, which is built in a single pass the first time the file is
+    split. Files without a subject_id column are copied to ``shared_fp``.
+
+    Parameters
+    ----------
+    fp : Path
+        The filepath to the source CSV file.
+    shared_fp : Path
+        The filepath to write the file to if it has no subject_id column.
+    subject_fps : dict[int, Path]
+        The filepath to write each subject's rows to.
+
+    Returns
+    -------
+    bool
+        True if the file has no subject_id column and was copied to ``shared_fp``.
+    """
+
+    index = SubjectIndex.load(fp)
+
+    if index is None:
+        shared_fp.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(fp, shared_fp)
+        print(f"Saved to {shared_fp}")
+        return True
+
+    for subject_id, out_fp in subject_fps.items():
+        out_fp.parent.mkdir(parents=True, exist_ok=True)
+        out_fp.write_bytes(index.read(subject_id))
+
+    print(f"Saved {fp.name} for {len(subject_fps)} subject(s)")
+    return False
+
+
+def split_parquet(fp: Path, shared_fp: Path, subject_fps: dict[int, Path]) -> bool:
+    """
+    Split a Parquet file into one Parquet file per subject.
+
+    Only row groups containing the requested subjects are read. Files without a
+    subject_id column are copied to ``shared_fp`` unchanged.
+
+    Parameters
+    ----------
+    fp : Path
+        The filepath to the source Parquet file.
+    shared_fp : Path
+        The filepath to write the file to if it has no subject_id column.
+    subject_fps : dict[int, Path]
+        The filepath to write each subject's rows to.
+
+    Returns
+    -------
+    bool
+        True if the file has no subject_id column and was copied to ``shared_fp``.
+    """
+
+    table = read_table(fp, subject_ids=subject_fps.keys())
+
+    if "subject_id" not in table.column_names:
+        write_table(table, shared_fp)
+        print(f"Saved to {shared_fp}")
+        return True
+
+    partitions = partition_by_subject(table, subject_fps.keys())
+    for subject_id, rows in partitions.items():
+        write_table(rows, subject_fps[subject_id])
+
+    print(f"Saved {fp.stem} for {len(subject_fps)} subject(s)")
+    return False
+
+
+def _load_manifest(manifest_fp: Path) -> dict:
+    if not manifest_fp.exists():
+        return {}
+    with manifest_fp.open() as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest_fp: Path, manifest: dict) -> None:
+    # Replace the manifest atomically so an interrupted run never corrupts it
+    manifest_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = manifest_fp.with_suffix(".tmp")
+    with tmp_fp.open("w") as f:
+        json.dump(manifest, f, indent=2)
+    tmp_fp.replace(manifest_fp)
+
+
+def _is_unchanged(
+    fp: Path, entry: Optional[dict], subjects: str, fmt: str
+) -> Optional[dict]:
+    """
+    Check a source file against its manifest entry.
+
+    Returns the up-to-date entry if the file and the split settings are
+    unchanged, otherwise None. The content hash is only computed when the
+    file's size or mtime differ from the entry.
+    """
+    if not entry or entry["subjects"] != subjects or entry["fmt"] != fmt:
+        return None
+
+    stat = fp.stat()
+    if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+        return entry
+
+    if stat.st_size == entry["size"] and file_digest(fp) == entry["sha256"]:
+        # Touched but not modified
+        return {**entry, "mtime_ns": stat.st_mtime_ns}
+
+    return None
+
+
+def prepare_data(
+    db_dir: Path = None,
+    split_dir: Path = None,
+    subject_ids: Optional[list[int]] = None,
+    fmt: str = "parquet",
+    force: bool = False,
+):
     """
     Read the data from /db/*.csv and filter subject_id == SUBJECT_ID if possible.
-    Then save it to data/*.csv
+    Then save it to data/split/*.parquet
+
+    When ``subject_ids`` is given, each file is read once and partitioned into
+    data/split/<subject_id>/* for every subject in the cohort. Files without
+    a subject_id column are shared by the cohort and saved to data/split/*.
+
+    With ``fmt="parquet"`` the source CSV files are first cached as typed
+    Parquet files next to them (see scraibe.storage), so each CSV file is only
+    parsed once. Use load_files() to hand the split tables to the code
+    interpreter as CSV.
+
+    The size, mtime and SHA-256 of every source file, and the subjects and
+    format it was split for, are recorded in data/split/manifest.json. Files
+    that have not changed since the last run are skipped unless ``force``.
+
+    Parameters
+    ----------
+    db_dir : Path
+        Directory to read the CSV files from. Defaults to /db/mimic.
+    split_dir : Path
+        Directory to save the split files to. Defaults to data/split.
+    subject_ids : list[int], optional
+        The cohort to split the data for.
+    fmt : str
+        Format of the split files, either "parquet" or "csv".
+    force : bool
+        Re-split every file, even if it has not changed.
     """
 
-    db_dir = PROJECT_DIR.joinpath("db", "mimic")
+    if fmt not in ("parquet", "csv"):
+        raise ValueError(f"Unknown format: {fmt}")
+
+    if db_dir is None:
+        db_dir = PROJECT_DIR.joinpath("db", "mimic")
+    if split_dir is None:
+        split_dir = DATA_DIR.joinpath("split")
+
     original_files = [fp for fp in db_dir.glob("*.csv")]
+    schema = load_schema() if fmt == "parquet" else None
+    suffix = f".{fmt}"
+
+    manifest_fp = split_dir.joinpath("manifest.json")
+    manifest = {} if force else _load_manifest(manifest_fp)
+
+    # Identify the subject filter so that changing the cohort re-splits every file
+    if subject_ids is None:
+        subjects = f"subject:{SUBJECT_ID}"
+    else:
+        ids = ",".join(str(sid) for sid in sorted(subject_ids))
+        subjects = f"cohort:{hashlib.sha256(ids.encode()).hexdigest()}"
 
     for fp in original_files:
+        name = fp.with_suffix(suffix).name
+        shared_fp = split_dir.joinpath(name)
+
+        if subject_ids is None:
+            subject_fps = {SUBJECT_ID: shared_fp}
+        else:
+            subject_fps = {
+                subject_id: split_dir.joinpath(str(subject_id), name)
+                for subject_id in subject_ids
+            }
+
+        entry = _is_unchanged(fp, manifest.get(fp.name), subjects, fmt)
+        if entry is not None:
+            outputs = [shared_fp] if entry["shared"] else subject_fps.values()
+            if all(out_fp.exists() for out_fp in outputs):
+                print(f"Skipping {fp.name}, unchanged")
+                manifest[fp.name] = entry
+                continue
+
         print(f"Processing {fp.name}")
-        # Do not read the first column as index
-        df = pd.read_csv(fp)
+        stat = fp.stat()
+        if fmt == "parquet":
+            shared = split_parquet(cache_table(fp, schema), shared_fp, subject_fps)
+        else:
+            shared = split_table(fp, shared_fp, subject_fps)
+
+        manifest[fp.name] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_digest(fp),
+            "subjects": subjects,
+            "fmt": fmt,
+            "shared": shared,
+        }
+        _save_manifest(manifest_fp, manifest)
+
+    _save_manifest(manifest_fp, manifest)
+
+
+def load_files(
+    split_dir: Path = None, tables: Optional[list[str]] = None
+) -> list[File]:
+    """
+    Load split tables as CSV files for the code interpreter.
+
+    Parquet tables are converted to CSV in memory; tables that were split as
+    CSV are loaded as is.
+
+    Parameters
+    ----------
+    split_dir : Path
+        Directory to load the tables from. Defaults to data/split.
+    tables : list[str], optional
+        Names of the tables to load, in order. Defaults to all tables.
+
+    Returns
+    -------
+    list[File]
+        One CSV file per table, named <table>.csv.
+    """
+
+    if split_dir is None:
+        split_dir = DATA_DIR.joinpath("split")
+
+    if tables is None:
+        tables = sorted(
+            {fp.stem for fp in split_dir.glob("*.parquet")}
+            | {fp.stem for fp in split_dir.glob("*.csv")}
+        )
 
-        if "subject_id" in df.columns:
-            df = df[df["subject_id"] == SUBJECT_ID]
+    files = []
+    for table in tables:
+        parquet_fp = split_dir.joinpath(f"{table}.parquet")
+        if parquet_fp.exists():
+            content = to_csv(read_table(parquet_fp))
+            files.append(File(name=f"{table}.csv", content=content))
+        else:
+            files.append(File.from_path(str(split_dir.joinpath(f"{table}.csv"))))
+
+    return files
+
+
+async def iter_analysis(
+    files: list[File],
+    concurrency: int = 1,
+    session_cls=CodeInterpreterSession,
+    cache: Optional[ResultCache] = None,
+    user_request: Optional[str] = None,
+    text_only: bool = False,
+) -> AsyncIterator[tuple[str, dict[str, str]]]:
+    """
+    Analyze each table with the code interpreter, yielding results as they complete.
+
+    Tables are analyzed on a pool of up to ``concurrency`` sessions, so at most
+    that many analyses run at once. With the default of 1, every table is
+    analyzed in order in the same session and each analysis can build on the
+    previous ones; with more sessions, tables are analyzed independently.
+
+    Each table's result is cached by its content, so only new or changed
+    tables are analyzed, and sessions are only started if there is one.
+
+    Parameters
+    ----------
+    files : list[File]
+        The tables to analyze.
+    concurrency : int
+        Number of sessions, i.e. the maximum number of concurrent analyses.
+    session_cls
+        The session class, CodeInterpreterSession or a stand-in for it.
+    cache : ResultCache, optional
+        The result cache. Defaults to the shared cache in data/cache.sqlite.
+    user_request : str, optional
+        The request made for each table. Defaults to ANALYSIS_REQUEST.
+    text_only : bool
+        Only keep the text of the analyses: nothing is printed or shown, and
+        no visualization is saved.
+
+    Yields
+    ------
+    tuple[str, dict[str, str]]
+        The file name and the text and saved image paths of its analysis, in
+        the order the analyses complete.
+    """
 
-        df.to_csv(DATA_DIR.joinpath("split", fp.name))
-        print(f"Saved to {DATA_DIR.joinpath('split', fp.name)}")
+    if cache is None:
+        cache = get_result_cache()
 
+    if user_request is None:
+        user_request = ANALYSIS_REQUEST
+    max_iterations = 25
 
-async def analyze_data(files: list[File]) -> dict[str, dict[str, str]]:
-    response = {}
+    # Idle sessions; waiting on the queue limits the number of concurrent analyses
+    sessions = asyncio.Queue()
+    n_sessions = 0
 
-    async with CodeInterpreterSession(max_iterations=25) as session:
-        for dataset in files:
-            # define the user request
-            user_request = (
-                "You're a seasoned medical data scientist with expertise in generating insightful visualizations. "
-                "Examine the provided dataset with a sharp clinical perspective. "
-                "Break down its primary features and present concise summaries to illuminate the essence of the data. "
-                "Dive into the dataset from various perspectives to obtain an initial grasp of its potential. "
-                "Your analysis should provide the data science team with rich, multidimensional insights. "
-                "Only generate visualizations if they are truly meaningful. "
-                "It is not required to generate a visual for each dataset table. "
-                "Logically analyze and build on top of each table, which composes a part of the dataset as a whole. "
-                "Build on top of each table's analysis to provided a holistic analysis that can be used in future. "
-                "YOU ARE ONLY PROVIDED AND SHOULD ANALYZE DATA OF 1 PATIENT."
+    async def acquire(stack: AsyncExitStack):
+        nonlocal n_sessions
+        if sessions.empty() and n_sessions < max(1, concurrency):
+            n_sessions += 1
+            return await stack.enter_async_context(
+                session_cls(max_iterations=max_iterations, model=MODEL)
             )
-
+        return await sessions.get()
+
+    async def analyze(dataset: File, stack: AsyncExitStack) -> tuple[str, dict]:
+        # Text-only results have no images, so they are cached apart
+        prompt = f"text only\n{user_request}" if text_only else user_request
+        key = cache.make_key(prompt, [dataset.content], MODEL, max_iterations)
+        data = cache.get(key)
+        if data is not None:
+            return dataset.name, data
+
+        session = await acquire(stack)
+        try:
             resp = await session.agenerate_response(
                 user_request,
                 files=[dataset],
                 detailed_error=True,
             )
+        finally:
+            sessions.put_nowait(session)
 
+        data = {"text": resp.content, "images": []}
+        if not text_only:
             # Output to the user
             print("AI: ", resp.content)
             for file in resp.files:
                 file.show_image()
 
-            data = {"text": resp.content, "images": []}
-
             # Save the visualizations
             for file in resp.files:
                 fp = DATA_DIR.joinpath("visualizations", f"{uuid4()}.png")
                 file.save_image(fp)
                 data["images"].append(str(fp))
 
-            response.update({dataset.name: data})
+        cache.set(key, data)
+        return dataset.name, data
+
+    async with AsyncExitStack() as stack:
+        tasks = [asyncio.create_task(analyze(dataset, stack)) for dataset in files]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # Stop the remaining analyses if the consumer stops early or fails
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def analyze_data(
+    files: list[File],
+    concurrency: int = 1,
+    session_cls=CodeInterpreterSession,
+    cache: Optional[ResultCache] = None,
+    on_result: Optional[Callable[[str, dict], None]] = None,
+) -> dict[str, dict[str, str]]:
+    """
+    Analyze each table with the code interpreter.
 
-        return response
+    See iter_analysis() for the parameters.
+
+    Parameters
+    ----------
+    on_result : Callable[[str, dict], None], optional
+        Called with the file name and result of each table as it completes.
+
+    Returns
+    -------
+    dict[str, dict[str, str]]
+        The text and saved image paths of each table's analysis, by file name,
+        in the same order as ``files``.
+    """
+
+    results = {}
+    async for name, data in iter_analysis(files, concurrency, session_cls, cache):
+        results[name] = data
+        if on_result is not None:
+            on_result(name, data)
+
+    return {dataset.name: results[dataset.name] for dataset in files}
 
 
 async def generate_visuals(
-    files: list[File], data: dict[str, dict[str, str]]
+    files: list[File],
+    data: dict[str, dict[str, str]],
+    cache: Optional[ResultCache] = None,
+    on_result: Optional[Callable[[str, dict], None]] = None,
+    executor: Optional[Executor] = None,
 ) -> dict[str, dict[str, str]]:
+    """
+    Generate visualizations of each table from its analysis.
+
+    Tables with a standard chart (see scraibe.charts) are rendered locally
+    and need no analysis. The code interpreter only visualizes the other
+    tables, and those whose chart failed to render, which are analyzed first
+    if they are not in ``data``. Results are cached by the analysis and the table's content, and
+    the session is only started if a table is not cached.
+
+    Parameters
+    ----------
+    files : list[File]
+        The tables.
+    data : dict[str, dict[str, str]]
+        The analysis of each table, by file name, as returned by analyze_data().
+        Only needed for tables without a standard chart.
+    cache : ResultCache, optional
+        The result cache. Defaults to the shared cache in data/cache.sqlite.
+    on_result : Callable[[str, dict], None], optional
+        Called with the file name and result of each table as it completes.
+    executor : Executor, optional
+        Process pool to render the standard charts in.
+
+    Returns
+    -------
+    dict[str, dict[str, str]]
+        The text and saved image paths of each table's visualizations.
+    """
+
+    if cache is None:
+        cache = get_result_cache()
+
+    max_iterations = 40
     processed_files = set()
-    response = {}
+    response = await render_charts(files, cache, executor, on_result=on_result)
+    misses = {}
+
+    # Tables whose standard chart failed are visualized from an analysis
+    failed = [
+        dataset
+        for dataset in files
+        if dataset.name in CHARTS
+        and dataset.name not in response
+        and dataset.name not in data
+    ]
+    if failed:
+        data = {**data, **await analyze_data(failed, cache=cache)}
+
+    for name, vals in data.items():
+        if name in response:
+            continue
+        datasets = [dataset for dataset in files if dataset.name == name]
+        key = cache.make_key(
+            f"generate_visuals\n{vals['text']}",
+            [dataset.content for dataset in datasets],
+            MODEL,
+            max_iterations,
+        )
+        response[name] = cache.get(key)
+        if response[name] is None:
+            misses[name] = key
+        elif on_result is not None:
+            on_result(name, response[name])
+
+    if not misses:
+        return response
 
-    async with CodeInterpreterSession(max_iterations=40) as session:
-        for name, vals in data.items():
+    async with CodeInterpreterSession(
+        max_iterations=max_iterations, model=MODEL
+    ) as session:
+        for name, key in misses.items():
+            vals = data[name]
             info_request = f"""
             Given the previous analysis, please summarize the key findings...
-            {vals['content']}  # Getting the text from the previous response
+            {vals['text']}  # Getting the text from the previous response
             """
             info_response = await session.agenerate_response(
                 info_request,
@@ -166,55 +687,93 @@ async def generate_visuals(
                 detailed_error=True,
             )
 
-            data = {"text": visual_response.content, "images": []}
+            result = {"text": visual_response.content, "images": []}
 
             # Save the visualizations
             for file in visual_response.files:
                 if file.name not in processed_files:
                     fp = DATA_DIR.joinpath("visualizations", f"{uuid4()}.png")
                     file.save_image(fp)
-                    data["images"].append(str(fp))
+                    result["images"].append(str(fp))
                     processed_files.add(file.name)
 
-            response[name] = data
+            cache.set(key, result)
+            response[name] = result
+            if on_result is not None:
+                on_result(name, result)
 
     return response
 
 
-async def summarize_report(files: list[File]) -> dict[str, CodeInterpreterResponse]:
-    response = {}
-
-    async with CodeInterpreterSession(max_iterations=25) as session:
-        for dataset in files:
-            # define the user request
-            user_request = (
-                "You're a seasoned medical data scientist with expertise in generating insightful visualizations. "
-                "Examine the provided dataset with a sharp clinical perspective. "
-                "Summarize the key findings of the analysis to provide a summary of the patient's medical history. "
-                "YOU ARE ONLY PROVIDED AND SHOULD ANALYZE DATA OF 1 PATIENT."
-            )
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut a text down to about ``max_tokens`` tokens.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    return text[: (max_tokens - 1) * 4]
 
-            resp = await session.agenerate_response(
-                user_request,
-                files=[dataset],
-                detailed_error=True,
-            )
 
-            response.update({dataset.name: resp})
+def pack_texts(
+    texts: list[str], max_tokens: int, separator: str = ""
+) -> list[list[str]]:
+    """
+    Group consecutive texts so that each group fits in ``max_tokens`` tokens.
+
+    Parameters
+    ----------
+    texts : list[str]
+        The texts, each of at most ``max_tokens`` tokens.
+    max_tokens : int
+        Maximum number of tokens of a group.
+    separator : str
+        The separator the texts of a group are joined with, counted once
+        between every two texts.
+
+    Returns
+    -------
+    list[list[str]]
+        The groups, in order.
+    """
 
-            # Output to the user
-            # print("AI: ", data.content)
-            # for file in data.files:
-            #     file.show_image()
-
-    final_prompt = "\n\n".join(
-        [
-            f"Here are the results of the analysis for {dataset.name}:\n\n{resp.content}"
-            for dataset, resp in response.items()
-        ]
-    )
+    separator_tokens = count_tokens(separator) if separator else 0
+    groups, tokens = [], 0
+    for text in texts:
+        n = count_tokens(text)
+        if groups and tokens + separator_tokens + n <= max_tokens:
+            groups[-1].append(text)
+            tokens += separator_tokens + n
+        else:
+            groups.append([text])
+            tokens = n
+    return groups
+
+
+async def complete(
+    prompt: str, cache: ResultCache, max_tokens: Optional[int] = None
+) -> str:
+    """
+    Get the model's reply to a prompt, cached by the prompt.
+
+    Parameters
+    ----------
+    prompt : str
+        The prompt.
+    cache : ResultCache
+        The result cache.
+    max_tokens : int, optional
+        Maximum number of tokens of the reply.
+
+    Returns
+    -------
+    str
+        The reply.
+    """
 
-    final_prompt += "\n\nPlease summarize the key findings of the analysis to provide a summary of the patient's medical history."
+    key = cache.make_key(prompt, [], MODEL, max_tokens or 0)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached["text"]
 
     messages = [
         {
@@ -223,79 +782,219 @@ async def summarize_report(files: list[File]) -> dict[str, CodeInterpreterRespon
         },
         {
             "role": "user",
-            "content": final_prompt,
+            "content": prompt,
         },
     ]
 
-    resp = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages,
+    kwargs = {} if max_tokens is None else {"max_tokens": max_tokens}
+    resp = await openai.ChatCompletion.acreate(model=MODEL, messages=messages, **kwargs)
+
+    text = resp["choices"][0]["message"]["content"]
+    cache.set(key, {"text": text})
+    return text
+
+
+async def summarize_chat(
+    summary: str,
+    messages: list[dict],
+    cache: Optional[ResultCache] = None,
+    max_tokens: int = 500,
+) -> str:
+    """
+    Fold the oldest turns of a conversation into its running summary.
+
+    Parameters
+    ----------
+    summary : str
+        The summary so far, empty at first.
+    messages : list[dict]
+        The turns dropped from the conversation.
+    cache : ResultCache, optional
+        The result cache. Defaults to the shared cache in data/cache.sqlite.
+    max_tokens : int
+        Maximum number of tokens of the summary.
+
+    Returns
+    -------
+    str
+        The new summary.
+    """
+
+    if cache is None:
+        cache = get_result_cache()
+
+    turns = "\n\n".join(
+        f"{message['role']}: {message['content']}" for message in messages
+    )
+    prompt = (
+        f"Summary of the conversation so far:\n{summary or '(none)'}\n\n"
+        f"Later turns of the conversation:\n\n{turns}\n\n"
+        "Please update the summary with these turns, keeping every clinically "
+        "relevant detail and question, in at most a few paragraphs."
+    )
+    return await complete(prompt, cache, max_tokens)
+
+
+async def summarize_report(
+    files: list[File],
+    concurrency: int = 4,
+    session_cls=CodeInterpreterSession,
+    cache: Optional[ResultCache] = None,
+    max_tokens: int = 6000,
+    summary_tokens: int = 1000,
+) -> str:
+    """
+    Summarize the patient's medical history from all tables.
+
+    Each table is summarized on its own, up to ``concurrency`` at a time, as
+    text only. While the table summaries and the instructions do not fit in
+    ``max_tokens`` together, the summaries are merged in groups that do,
+    concurrently, into summaries of at most ``summary_tokens``. The final
+    summary is then made from what remains, so no merge or final prompt
+    exceeds ``max_tokens`` however many tables there are.
+
+    Each table's summary, each merge and the final summary are cached by
+    content.
+
+    Parameters
+    ----------
+    files : list[File]
+        The tables.
+    concurrency : int
+        Maximum number of concurrent requests.
+    session_cls
+        The session class, CodeInterpreterSession or a stand-in for it.
+    cache : ResultCache, optional
+        The result cache. Defaults to the shared cache in data/cache.sqlite.
+    max_tokens : int
+        Maximum number of tokens of a merge or final prompt.
+    summary_tokens : int
+        Maximum number of tokens of a merged summary.
+
+    Returns
+    -------
+    str
+        The summary.
+
+    Raises
+    ------
+    ValueError
+        If max_tokens leaves no room for the summaries next to the instructions.
+    """
+
+    if cache is None:
+        cache = get_result_cache()
+
+    merge_instructions = "\n\nPlease merge these partial summaries of the patient's medical history into one concise summary, keeping every clinically relevant finding."
+    final_instructions = "\n\nPlease summarize the key findings of the analysis to provide a summary of the patient's medical history."
+    separator = "\n\n"
+
+    # The tokens left for the summaries of a prompt, joined by separators
+    budget = max_tokens - max(
+        map(count_tokens, [merge_instructions, final_instructions])
     )
+    # Texts are at most half the budget, so every group merges at least two
+    text_tokens = (budget - count_tokens(separator)) // 2
+    if text_tokens < 1:
+        raise ValueError(f"max_tokens={max_tokens} is too small for the instructions.")
+
+    # Map: summarize each table
+    response = {}
+    async for name, data in iter_analysis(
+        files,
+        concurrency,
+        session_cls,
+        cache,
+        user_request=SUMMARY_REQUEST,
+        text_only=True,
+    ):
+        response[name] = data["text"]
+
+    texts = [
+        truncate_tokens(
+            f"Here are the results of the analysis for {dataset.name}:\n\n"
+            f"{response[dataset.name]}",
+            text_tokens,
+        )
+        for dataset in files
+    ]
+
+    # Reduce: merge the summaries until they fit in one prompt
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def merge(group: list[str]) -> str:
+        prompt = separator.join(group) + merge_instructions
+        async with semaphore:
+            text = await complete(prompt, cache, summary_tokens)
+        return truncate_tokens(text, text_tokens)
+
+    while len(groups := pack_texts(texts, budget, separator)) > 1:
+        texts = await asyncio.gather(*[merge(group) for group in groups])
 
-    return resp["choices"][0]["message"]["content"]
+    return await complete(separator.join(texts) + final_instructions, cache)
 
 
 if __name__ == "__main__":
     # get_data()
     # prepare_data()
 
-    import asyncio
-
-    _files = [
-        # File.from_path("data/split/d_hcpcs.csv"),
-        File.from_path("data/split/patients.csv"),
-        # File.from_path("data/split/hcpcsevents.csv"),
-        File.from_path("data/split/icustays.csv"),
-        File.from_path("data/split/procedures_icd.csv"),
-        # File.from_path("data/split/drgcodes.csv"),
-        # File.from_path("data/split/transfers.csv"),
-        File.from_path("data/split/diagnoses_icd.csv"),
-        # File.from_path("data/split/microbiologyevents.csv"),
-        # File.from_path("data/split/outputevents.csv"),
-        File.from_path("data/split/prescriptions.csv"),
-        File.from_path("data/split/pharmacy.csv"),
-        # File.from_path("data/split/d_items.csv"),
-    ]
+    _files = load_files(
+        tables=[
+            # "d_hcpcs",
+            "patients",
+            # "hcpcsevents",
+            "icustays",
+            "procedures_icd",
+            # "drgcodes",
+            # "transfers",
+            "diagnoses_icd",
+            # "microbiologyevents",
+            # "outputevents",
+            "prescriptions",
+            "pharmacy",
+            # "d_items",
+        ]
+    )
 
     _data = {
         "d_hcpcs.csv": {
-            "content": "Here are the results of the analysis:\n\n- There are 89,200 unique HCPCS codes in the dataset.\n- The `category` column has 6,844 missing values, and the `long_description` column has 82,400 missing values. There are no missing values in the other columns.\n- The histograms show the distribution of the length of the long and short descriptions. Most of the long descriptions have a length of around 50 characters, while most of the short descriptions have a length of around 10 characters.\n\nThe large number of missing values in the `long_description` column is concerning. This column could potentially contain important information about the medical procedures, so it might be worth investigating why these values are missing.\n\nThe next step could be to examine the `category` column to see if it contains any useful information. We could also look at the most common words in the descriptions to get a better understanding of the types of medical procedures in the dataset."
+            "text": "Here are the results of the analysis:\n\n- There are 89,200 unique HCPCS codes in the dataset.\n- The `category` column has 6,844 missing values, and the `long_description` column has 82,400 missing values. There are no missing values in the other columns.\n- The histograms show the distribution of the length of the long and short descriptions. Most of the long descriptions have a length of around 50 characters, while most of the short descriptions have a length of around 10 characters.\n\nThe large number of missing values in the `long_description` column is concerning. This column could potentially contain important information about the medical procedures, so it might be worth investigating why these values are missing.\n\nThe next step could be to examine the `category` column to see if it contains any useful information. We could also look at the most common words in the descriptions to get a better understanding of the types of medical procedures in the dataset."
         },
         "patients.csv": {
-            "content": "The dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `gender`: The gender of the patient.\n- `anchor_age`: The age of the patient.\n- `anchor_year`: The year of the patient's visit.\n- `anchor_year_group`: The year group of the patient's visit.\n- `dod`: This could be the date of death of the patient, but it's not clear without more context.\n\nLet's continue by examining the data types of each column, checking for missing values, and getting some basic statistics for the numerical columns."
+            "text": "The dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `gender`: The gender of the patient.\n- `anchor_age`: The age of the patient.\n- `anchor_year`: The year of the patient's visit.\n- `anchor_year_group`: The year group of the patient's visit.\n- `dod`: This could be the date of death of the patient, but it's not clear without more context.\n\nLet's continue by examining the data types of each column, checking for missing values, and getting some basic statistics for the numerical columns."
         },
         "hcpcsevents.csv": {
-            "content": "The basic statistics for the numerical columns in the `hcpcsevents.csv` dataset are as follows:\n\n- `Unnamed: 0`: This column ranges from 20 to 25, with a mean of 22.5. Since this is likely an index column, these statistics may not be very meaningful.\n- `subject_id`: All rows have the same subject ID of 10014354. This suggests that all the events in this dataset are for the same patient.\n- `hadm_id`: This column has a mean of approximately 24,648,430, with a standard deviation of approximately 2,595,482. The minimum value is 20,900,960 and the maximum value is 27,494,880. This suggests that the dataset includes events from a range of different hospital admissions.\n- `seq_num`: All rows have the same sequence number of 1. This suggests that each event is the first event of its respective hospital admission.\n\nNext, let's examine the non-numerical columns in the dataset. We can look at the unique values in the `hcpcs_cd` and `short_description` columns to get a better understanding of the types of procedures and services in the dataset."
+            "text": "The basic statistics for the numerical columns in the `hcpcsevents.csv` dataset are as follows:\n\n- `Unnamed: 0`: This column ranges from 20 to 25, with a mean of 22.5. Since this is likely an index column, these statistics may not be very meaningful.\n- `subject_id`: All rows have the same subject ID of 10014354. This suggests that all the events in this dataset are for the same patient.\n- `hadm_id`: This column has a mean of approximately 24,648,430, with a standard deviation of approximately 2,595,482. The minimum value is 20,900,960 and the maximum value is 27,494,880. This suggests that the dataset includes events from a range of different hospital admissions.\n- `seq_num`: All rows have the same sequence number of 1. This suggests that each event is the first event of its respective hospital admission.\n\nNext, let's examine the non-numerical columns in the dataset. We can look at the unique values in the `hcpcs_cd` and `short_description` columns to get a better understanding of the types of procedures and services in the dataset."
         },
         "icustays.csv": {
-            "content": "The `icustays.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `stay_id`: This could be a unique identifier for each ICU stay.\n- `first_careunit`: The first care unit the patient was admitted to during their ICU stay.\n- `last_careunit`: The last care unit the patient was in during their ICU stay.\n- `intime`: The time the patient was admitted to the ICU.\n- `outtime`: The time the patient was discharged from the ICU.\n- `los`: The length of stay in the ICU, in days.\n\nThe dataset contains 4,000 rows and 9 columns. There are no missing values in the dataset.\n\nThe `first_careunit` and `last_careunit` columns contain the names of the care units, which could be useful for understanding the types of care the patients received. The `intime` and `outtime` columns contain timestamps, which could be useful for understanding the timing of the ICU stays. The `los` column contains the length of stay in the ICU, which could be useful for understanding the severity of the patients' conditions.\n\nNext, let's examine the distribution of the `los` column and the unique values in the `first_careunit` and `last_careunit` columns."
+            "text": "The `icustays.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `stay_id`: This could be a unique identifier for each ICU stay.\n- `first_careunit`: The first care unit the patient was admitted to during their ICU stay.\n- `last_careunit`: The last care unit the patient was in during their ICU stay.\n- `intime`: The time the patient was admitted to the ICU.\n- `outtime`: The time the patient was discharged from the ICU.\n- `los`: The length of stay in the ICU, in days.\n\nThe dataset contains 4,000 rows and 9 columns. There are no missing values in the dataset.\n\nThe `first_careunit` and `last_careunit` columns contain the names of the care units, which could be useful for understanding the types of care the patients received. The `intime` and `outtime` columns contain timestamps, which could be useful for understanding the timing of the ICU stays. The `los` column contains the length of stay in the ICU, which could be useful for understanding the severity of the patients' conditions.\n\nNext, let's examine the distribution of the `los` column and the unique values in the `first_careunit` and `last_careunit` columns."
         },
         "procedures_icd.csv": {
-            "content": "The `procedures_icd.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `seq_num`: This could be a sequence number for the procedures performed during each hospital admission.\n- `chartdate`: The date of the procedure.\n- `icd_code`: The ICD code for the procedure.\n- `icd_version`: The version of the ICD code.\n\nThe dataset contains information about the procedures performed during each hospital admission. The `icd_code` and `icd_version` columns could be useful for understanding the types of procedures performed. The `chartdate` column could be useful for understanding the timing of the procedures.\n\nNext, let's examine the unique values in the `icd_code` and `icd_version` columns, and the distribution of the `chartdate` column."
+            "text": "The `procedures_icd.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `seq_num`: This could be a sequence number for the procedures performed during each hospital admission.\n- `chartdate`: The date of the procedure.\n- `icd_code`: The ICD code for the procedure.\n- `icd_version`: The version of the ICD code.\n\nThe dataset contains information about the procedures performed during each hospital admission. The `icd_code` and `icd_version` columns could be useful for understanding the types of procedures performed. The `chartdate` column could be useful for understanding the timing of the procedures.\n\nNext, let's examine the unique values in the `icd_code` and `icd_version` columns, and the distribution of the `chartdate` column."
         },
         "drgcodes.csv": {
-            "content": "The `drgcodes.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `drg_type`: The type of Diagnosis-Related Group (DRG).\n- `drg_code`: The code of the DRG.\n- `description`: The description of the DRG.\n- `drg_severity`: The severity of the DRG.\n- `drg_mortality`: The mortality rate of the DRG.\n\nThe dataset contains information about the DRGs associated with each hospital admission. The `drg_type`, `drg_code`, `description`, `drg_severity`, and `drg_mortality` columns could be useful for understanding the types of diagnoses and their severity and mortality rates.\n\nNext, let's examine the unique values in the `drg_type` and `drg_code` columns, and the distribution of the `drg_severity` and `drg_mortality` columns."
+            "text": "The `drgcodes.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `drg_type`: The type of Diagnosis-Related Group (DRG).\n- `drg_code`: The code of the DRG.\n- `description`: The description of the DRG.\n- `drg_severity`: The severity of the DRG.\n- `drg_mortality`: The mortality rate of the DRG.\n\nThe dataset contains information about the DRGs associated with each hospital admission. The `drg_type`, `drg_code`, `description`, `drg_severity`, and `drg_mortality` columns could be useful for understanding the types of diagnoses and their severity and mortality rates.\n\nNext, let's examine the unique values in the `drg_type` and `drg_code` columns, and the distribution of the `drg_severity` and `drg_mortality` columns."
         },
         "transfers.csv": {
-            "content": "The `transfers.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `transfer_id`: This could be a unique identifier for each transfer.\n- `eventtype`: The type of event that triggered the transfer.\n- `careunit`: The care unit involved in the transfer.\n- `intime`: The time the transfer started.\n- `outtime`: The time the transfer ended.\n- `los`: The length of the transfer, in days.\n\nThe dataset contains information about the transfers that occurred during each hospital admission. The `eventtype` and `careunit` columns could be useful for understanding the types of events that trigger transfers and the types of care units involved in transfers. The `intime` and `outtime` columns could be useful for understanding the timing of the transfers. The `los` column contains the length of the transfer, which could be useful for understanding the duration of the transfers.\n\nNext, let's examine the unique values in the `eventtype` and `careunit` columns, and the distribution of the `los` column."
+            "text": "The `transfers.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `transfer_id`: This could be a unique identifier for each transfer.\n- `eventtype`: The type of event that triggered the transfer.\n- `careunit`: The care unit involved in the transfer.\n- `intime`: The time the transfer started.\n- `outtime`: The time the transfer ended.\n- `los`: The length of the transfer, in days.\n\nThe dataset contains information about the transfers that occurred during each hospital admission. The `eventtype` and `careunit` columns could be useful for understanding the types of events that trigger transfers and the types of care units involved in transfers. The `intime` and `outtime` columns could be useful for understanding the timing of the transfers. The `los` column contains the length of the transfer, which could be useful for understanding the duration of the transfers.\n\nNext, let's examine the unique values in the `eventtype` and `careunit` columns, and the distribution of the `los` column."
         },
         "diagnoses_icd.csv": {
-            "content": "The `diagnoses_icd.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `seq_num`: This could be a sequence number for the diagnoses made during each hospital admission.\n- `icd_code`: The ICD code for the diagnosis.\n- `icd_version`: The version of the ICD code.\n\nThe dataset contains information about the diagnoses made during each hospital admission. The `icd_code` and `icd_version` columns could be useful for understanding the types of diagnoses made.\n\nNext, let's examine the unique values in the `icd_code` and `icd_version` columns. We can also look at the distribution of the `seq_num` column to understand the number of diagnoses made during each hospital admission."
+            "text": "The `diagnoses_icd.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `seq_num`: This could be a sequence number for the diagnoses made during each hospital admission.\n- `icd_code`: The ICD code for the diagnosis.\n- `icd_version`: The version of the ICD code.\n\nThe dataset contains information about the diagnoses made during each hospital admission. The `icd_code` and `icd_version` columns could be useful for understanding the types of diagnoses made.\n\nNext, let's examine the unique values in the `icd_code` and `icd_version` columns. We can also look at the distribution of the `seq_num` column to understand the number of diagnoses made during each hospital admission."
         },
         "microbiologyevents.csv": {
-            "content": "The `microbiologyevents.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `chartdate`: The date of the microbiology event.\n- `spec_itemid`: The item ID of the specimen.\n- `spec_type_desc`: The description of the specimen type.\n- `org_itemid`: The item ID of the organism.\n- `org_name`: The name of the organism.\n- `ab_itemid`: The item ID of the antibiotic.\n- `ab_name`: The name of the antibiotic.\n- `dilution_text`: The dilution text.\n- `dilution_comparison`: The dilution comparison.\n- `dilution_value`: The dilution value.\n- `interpretation`: The interpretation of the results.\n\nThe dataset contains information about microbiology events that occurred during each hospital admission. The `spec_itemid`, `spec_type_desc`, `org_itemid`, `org_name`, `ab_itemid`, `ab_name`, `dilution_text`, `dilution_comparison`, `dilution_value`, and `interpretation` columns could be useful for understanding the types of specimens, organisms, and antibiotics involved in the events, as well as the results of the events.\n\nNext, let's examine the unique values in the `spec_type_desc`, `org_name`, `ab_name`, and `interpretation` columns. We can also look at the distribution of the `chartdate` column to understand the timing of the microbiology events."
+            "text": "The `microbiologyevents.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `chartdate`: The date of the microbiology event.\n- `spec_itemid`: The item ID of the specimen.\n- `spec_type_desc`: The description of the specimen type.\n- `org_itemid`: The item ID of the organism.\n- `org_name`: The name of the organism.\n- `ab_itemid`: The item ID of the antibiotic.\n- `ab_name`: The name of the antibiotic.\n- `dilution_text`: The dilution text.\n- `dilution_comparison`: The dilution comparison.\n- `dilution_value`: The dilution value.\n- `interpretation`: The interpretation of the results.\n\nThe dataset contains information about microbiology events that occurred during each hospital admission. The `spec_itemid`, `spec_type_desc`, `org_itemid`, `org_name`, `ab_itemid`, `ab_name`, `dilution_text`, `dilution_comparison`, `dilution_value`, and `interpretation` columns could be useful for understanding the types of specimens, organisms, and antibiotics involved in the events, as well as the results of the events.\n\nNext, let's examine the unique values in the `spec_type_desc`, `org_name`, `ab_name`, and `interpretation` columns. We can also look at the distribution of the `chartdate` column to understand the timing of the microbiology events."
         },
         "outputevents.csv": {
-            "content": "The `outputevents.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `stay_id`: This could be a unique identifier for each ICU stay.\n- `charttime`: The time of the output event.\n- `itemid`: The item ID of the output.\n- `value`: The value of the output.\n- `valueuom`: The unit of measure of the output.\n- `storetime`: The time the output was stored.\n- `cgid`: The ID of the caregiver who recorded the output.\n- `stopped`: Whether the output was stopped.\n- `newbottle`: Whether a new bottle was used for the output.\n- `iserror`: Whether there was an error in recording the output.\n\nThe dataset contains information about output events that occurred during each ICU stay. The `itemid`, `value`, `valueuom`, `storetime`, `cgid`, `stopped`, `newbottle`, and `iserror` columns could be useful for understanding the types of outputs and any issues with the outputs.\n\nNext, let's examine the unique values in the `itemid`, `valueuom`, `stopped`, `newbottle`, and `iserror` columns. We can also look at the distribution of the `value` column to understand the range of output values."
+            "text": "The `outputevents.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `stay_id`: This could be a unique identifier for each ICU stay.\n- `charttime`: The time of the output event.\n- `itemid`: The item ID of the output.\n- `value`: The value of the output.\n- `valueuom`: The unit of measure of the output.\n- `storetime`: The time the output was stored.\n- `cgid`: The ID of the caregiver who recorded the output.\n- `stopped`: Whether the output was stopped.\n- `newbottle`: Whether a new bottle was used for the output.\n- `iserror`: Whether there was an error in recording the output.\n\nThe dataset contains information about output events that occurred during each ICU stay. The `itemid`, `value`, `valueuom`, `storetime`, `cgid`, `stopped`, `newbottle`, and `iserror` columns could be useful for understanding the types of outputs and any issues with the outputs.\n\nNext, let's examine the unique values in the `itemid`, `valueuom`, `stopped`, `newbottle`, and `iserror` columns. We can also look at the distribution of the `value` column to understand the range of output values."
         },
         "prescriptions.csv": {
-            "content": "The `prescriptions.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `stay_id`: This could be a unique identifier for each ICU stay.\n- `starttime`: The start time of the prescription.\n- `stoptime`: The stop time of the prescription.\n- `drug_type`: The type of drug prescribed.\n- `drug`: The name of the drug prescribed.\n- `drug_name_poe`: The name of the drug as entered by the provider.\n- `drug_name_generic`: The generic name of the drug.\n- `formulary_drug_cd`: The formulary drug code.\n- `gsn`: The group sequential number of the drug.\n- `ndc`: The National Drug Code of the drug.\n- `prod_strength`: The strength of the drug.\n- `dose_val_rx`: The dose value of the drug.\n- `dose_unit_rx`: The dose unit of the drug.\n- `form_val_disp`: The form value dispensed.\n- `form_unit_disp`: The form unit dispensed.\n- `route`: The route of administration.\n\nThe dataset contains information about prescriptions given during each ICU stay. The `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns could be useful for understanding the types of drugs prescribed and their dosages.\n\nNext, let's examine the unique values in the `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns. We can also look at the distribution of the `starttime` and `stoptime` columns to understand the timing of the prescriptions."
+            "text": "The `prescriptions.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `stay_id`: This could be a unique identifier for each ICU stay.\n- `starttime`: The start time of the prescription.\n- `stoptime`: The stop time of the prescription.\n- `drug_type`: The type of drug prescribed.\n- `drug`: The name of the drug prescribed.\n- `drug_name_poe`: The name of the drug as entered by the provider.\n- `drug_name_generic`: The generic name of the drug.\n- `formulary_drug_cd`: The formulary drug code.\n- `gsn`: The group sequential number of the drug.\n- `ndc`: The National Drug Code of the drug.\n- `prod_strength`: The strength of the drug.\n- `dose_val_rx`: The dose value of the drug.\n- `dose_unit_rx`: The dose unit of the drug.\n- `form_val_disp`: The form value dispensed.\n- `form_unit_disp`: The form unit dispensed.\n- `route`: The route of administration.\n\nThe dataset contains information about prescriptions given during each ICU stay. The `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns could be useful for understanding the types of drugs prescribed and their dosages.\n\nNext, let's examine the unique values in the `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns. We can also look at the distribution of the `starttime` and `stoptime` columns to understand the timing of the prescriptions."
         },
         "pharmacy.csv": {
-            "content": "The `pharmacy.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `starttime`: The start time of the pharmacy event.\n- `stoptime`: The stop time of the pharmacy event.\n- `drug_type`: The type of drug involved in the event.\n- `drug`: The name of the drug.\n- `drug_name_poe`: The name of the drug as entered by the provider.\n- `drug_name_generic`: The generic name of the drug.\n- `formulary_drug_cd`: The formulary drug code.\n- `gsn`: The group sequential number of the drug.\n- `ndc`: The National Drug Code of the drug.\n- `prod_strength`: The strength of the drug.\n- `dose_val_rx`: The dose value of the drug.\n- `dose_unit_rx`: The dose unit of the drug.\n- `form_val_disp`: The form value dispensed.\n- `form_unit_disp`: The form unit dispensed.\n- `route`: The route of administration.\n\nThe dataset contains information about pharmacy events that occurred during each hospital admission. The `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns could be useful for understanding the types of drugs involved in the events and their dosages.\n\nNext, let's examine the unique values in the `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns. We can also look at the distribution of the `starttime` and `stoptime` columns to understand the timing of the pharmacy events."
+            "text": "The `pharmacy.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `subject_id`: This is likely a unique identifier for each patient.\n- `hadm_id`: This could be a unique identifier for each hospital admission.\n- `starttime`: The start time of the pharmacy event.\n- `stoptime`: The stop time of the pharmacy event.\n- `drug_type`: The type of drug involved in the event.\n- `drug`: The name of the drug.\n- `drug_name_poe`: The name of the drug as entered by the provider.\n- `drug_name_generic`: The generic name of the drug.\n- `formulary_drug_cd`: The formulary drug code.\n- `gsn`: The group sequential number of the drug.\n- `ndc`: The National Drug Code of the drug.\n- `prod_strength`: The strength of the drug.\n- `dose_val_rx`: The dose value of the drug.\n- `dose_unit_rx`: The dose unit of the drug.\n- `form_val_disp`: The form value dispensed.\n- `form_unit_disp`: The form unit dispensed.\n- `route`: The route of administration.\n\nThe dataset contains information about pharmacy events that occurred during each hospital admission. The `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns could be useful for understanding the types of drugs involved in the events and their dosages.\n\nNext, let's examine the unique values in the `drug_type`, `drug`, `drug_name_poe`, `drug_name_generic`, `formulary_drug_cd`, `gsn`, `ndc`, `prod_strength`, `dose_val_rx`, `dose_unit_rx`, `form_val_disp`, `form_unit_disp`, and `route` columns. We can also look at the distribution of the `starttime` and `stoptime` columns to understand the timing of the pharmacy events."
         },
         "d_items.csv": {
-            "content": "The `d_items.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `row_id`: This could be a unique identifier for each row.\n- `itemid`: The item ID.\n- `label`: The label of the item.\n- `abbreviation`: The abbreviation of the item.\n- `dbsource`: The source of the item.\n- `linksto`: The links to the item.\n- `category`: The category of the item.\n- `unitname`: The unit name of the item.\n- `param_type`: The parameter type of the item.\n- `lownormalvalue`: The low normal value of the item.\n- `highnormalvalue`: The high normal value of the item.\n\nThe dataset contains information about different items. The `itemid`, `label`, `abbreviation`, `dbsource`, `linksto`, `category`, `unitname`, `param_type`, `lownormalvalue`, and `highnormalvalue` columns could be useful for understanding the types of items and their characteristics.\n\nNext, let's examine the unique values in the `label`, `abbreviation`, `dbsource`, `linksto`, `category`, `unitname`, and `param_type` columns. We can also look at the distribution of the `lownormalvalue` and `highnormalvalue` columns to understand the range of normal values for the items."
+            "text": "The `d_items.csv` dataset contains the following columns:\n\n- `Unnamed: 0`: This seems to be an index column.\n- `row_id`: This could be a unique identifier for each row.\n- `itemid`: The item ID.\n- `label`: The label of the item.\n- `abbreviation`: The abbreviation of the item.\n- `dbsource`: The source of the item.\n- `linksto`: The links to the item.\n- `category`: The category of the item.\n- `unitname`: The unit name of the item.\n- `param_type`: The parameter type of the item.\n- `lownormalvalue`: The low normal value of the item.\n- `highnormalvalue`: The high normal value of the item.\n\nThe dataset contains information about different items. The `itemid`, `label`, `abbreviation`, `dbsource`, `linksto`, `category`, `unitname`, `param_type`, `lownormalvalue`, and `highnormalvalue` columns could be useful for understanding the types of items and their characteristics.\n\nNext, let's examine the unique values in the `label`, `abbreviation`, `dbsource`, `linksto`, `category`, `unitname`, and `param_type` columns. We can also look at the distribution of the `lownormalvalue` and `highnormalvalue` columns to understand the range of normal values for the items."
         },
     }
 
@@ -1,32 +1,34 @@
 """scraibe/bot.py"""
 
-import hashlib
-from scraibe.store import Vector, VectorStore
-from config import DATA_DIR
+import asyncio
+
+from scraibe.agent import summarize_chat
+from scraibe.cache import EmbeddingCache
+from scraibe.context import ChatContext
+from scraibe.dedup import DedupIndex, hash_text
+from scraibe.embed import BatchEmbedder
+from scraibe.store import Vector, get_vector_store
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 import openai
 
+SYSTEM_PROMPT = "You are a medical assistant with access to historical medical notes."
+
 
 class Bot:
     def __init__(self, query: str = None, clinical_test: str = None):
         self.query = query
 
-        self.vector_file_path = f"{DATA_DIR}/vector.txt"
-        self.vector_store = VectorStore()
+        self.dedup = DedupIndex()
+        self.vector_store = get_vector_store()
+        self.embedder = BatchEmbedder(cache=EmbeddingCache())
 
-        self.query_embeddings = self.get_embedded(query)
+        self.query_embeddings = self.get_embedded(query) if query else None
         self.query_vector = Vector(text=query, embedding=self.query_embeddings)
 
-    @staticmethod
-    def get_embedded(text: str):
-        response = openai.Embedding.create(
-            model="text-embedding-ada-002",
-            input=text,
-        )
-        embeddings = response["data"][0]["embedding"]
-        return embeddings
+    def get_embedded(self, text: str):
+        return self.embedder.embed([text])[0]
 
     @staticmethod
     def chunk_text(text: str) -> list[Document]:
@@ -38,44 +40,47 @@ class Bot:
         )
         return text_splitter.create_documents([text])
 
-    def _hash_text(self, text: str) -> str:
-        return hashlib.sha256(text.encode()).hexdigest()
-
     def add_to_vector_store(self, text: str):
-        if self._is_text_in_vector_file(text):
+        if hash_text(text) in self.dedup:
             print("Text already exists in the vector store.")
             return
-        chunks = self.chunk_text(text)
-        for chunk in chunks:
-            self.vector_store.push(Vector(chunk))
-        self._add_text_to_vector_file(text)
-
-    def _is_text_in_vector_file(self, text: str) -> bool:
-        hash_value = self._hash_text(text)
-        with open(self.vector_file_path, "r") as f:
-            for line in f.readlines():
-                if hash_value in line:
-                    return True
-        return False
-
-    def _add_text_to_vector_file(self, text: str):
-        hash_value = self._hash_text(text)
-        with open(self.vector_file_path, "a") as f:
-            f.write(f"{hash_value}\n")
-
-    def get_similar_texts(self):
-        # Assuming VectorStore has a method to retrieve similar vectors
-        similar_vectors = self.vector_store.select_nearest(Vector(self.query_vector))
-        return [vector.document for vector in similar_vectors]
-
-    def chat(self):
-        # Starting with an initial system message
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a medical assistant with access to historical medical notes.",
-            }
-        ]
+
+        # Skip chunks that are already stored, e.g. from another note
+        chunks = {
+            hash_text(chunk.page_content): chunk.page_content
+            for chunk in self.chunk_text(text)
+        }
+        new_hashes = self.dedup.missing(list(chunks))
+        texts = [chunks[h] for h in new_hashes]
+        if texts:
+            embeddings = self.embedder.embed(texts)
+            self.vector_store.insert_many(texts, embeddings)
+            self.vector_store.save()
+
+        self.dedup.add_many(new_hashes, DedupIndex.CHUNK)
+        self.dedup.add_many([hash_text(text)], DedupIndex.DOCUMENT)
+
+    def get_similar_texts(self, query: str = None, limit: int = 4, **filters):
+        # Embed the new query, rather than searching with an earlier one
+        if query is not None:
+            self.query = query
+            self.query_embeddings = self.get_embedded(query)
+
+        similar_vectors = self.vector_store.select_nearest(
+            self.query_embeddings, limit=limit, **filters
+        )
+        return [vector.text for vector in similar_vectors]
+
+    def chat(self, max_tokens: int = 6000):
+        # The system prompt, retrieved notes and conversation, within a budget,
+        # with the oldest turns summarized
+        context = ChatContext(
+            SYSTEM_PROMPT,
+            max_tokens=max_tokens,
+            summarize=lambda summary, messages: asyncio.run(
+                summarize_chat(summary, messages)
+            ),
+        )
 
         while True:
             # Taking user input
@@ -86,20 +91,16 @@ class Bot:
                 print("Bot: Goodbye!")
                 break
 
-            # Fetching similar texts using vector embeddings
-            similar_texts = self.get_similar_texts()
-
-            # Appending the extracted medical notes to the conversation history
-            for text in similar_texts:
-                messages.append({"role": "assistant", "content": f"Note: {text}"})
+            # Fetching similar texts using vector embeddings, once per note
+            context.add_notes(self.get_similar_texts(self.query))
 
             # Append user's message to the list
-            messages.append({"role": "user", "content": self.query})
+            context.add_message("user", self.query)
 
             # Requesting the model for a response
             response = openai.ChatCompletion.create(
                 model="gpt-4",
-                messages=messages,
+                messages=context.messages(),
             )
 
             # Extracting the model's response
@@ -107,4 +108,4 @@ class Bot:
 
             # Printing and appending the model's response to the list of messages
             print(f"Bot: {assistant_response}")
-            messages.append({"role": "assistant", "content": assistant_response})
+            context.add_message("assistant", assistant_response)
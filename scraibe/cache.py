@@ -0,0 +1,484 @@
+"""
+scraibe/cache.py
+
+Content-addressed cache for agent results
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from config import DATA_DIR
+from scraibe.utils import lock_file, unlock_file
+
+CACHE_FP = DATA_DIR.joinpath("cache.sqlite")
+EMBEDDING_CACHE_DIR = DATA_DIR.joinpath("embeddings")
+
+
+class ResultCache:
+    """
+    Persistent cache of agent results.
+
+    Results are keyed by everything that determines them: the prompt, the
+    content of the input files, the model and the iteration limit. Entries
+    expire after ``ttl`` seconds, and once there are more than
+    ``max_entries`` the least recently used ones are evicted.
+
+    Results are JSON-serializable dicts. A result's "images" paths are
+    checked on lookup, and a result whose images were deleted is a miss.
+    """
+
+    def __init__(
+        self,
+        path: Path = CACHE_FP,
+        ttl: Optional[float] = 30 * 24 * 60 * 60,
+        max_entries: Optional[int] = 10_000,
+    ):
+        """
+        Parameters
+        ----------
+        path : Path
+            The filepath to the SQLite database.
+        ttl : float, optional
+            Seconds before an entry expires. None to never expire.
+        max_entries : int, optional
+            Maximum number of entries. None for no limit.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(
+        prompt: str, contents: list[bytes], model: str, max_iterations: int
+    ) -> str:
+        """
+        Build the cache key of a request.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt template, with any inputs filled in.
+        contents : list[bytes]
+            The content of each input file.
+        model : str
+            The model name.
+        max_iterations : int
+            The session's iteration limit.
+
+        Returns
+        -------
+        str
+            The key.
+        """
+        request = {
+            "prompt": prompt,
+            "files": [hashlib.sha256(content).hexdigest() for content in contents],
+            "model": model,
+            "max_iterations": max_iterations,
+        }
+        return hashlib.sha256(json.dumps(request).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Get a cached result.
+
+        Parameters
+        ----------
+        key : str
+            The key, from make_key().
+
+        Returns
+        -------
+        dict, optional
+            The result, or None if it is not cached, expired or its images
+            were deleted.
+        """
+        row = self.conn.execute(
+            "SELECT value, created_at FROM results WHERE key = ?", [key]
+        ).fetchone()
+        if row is None:
+            return None
+
+        value, created_at = json.loads(row[0]), row[1]
+        now = time.time()
+        expired = self.ttl is not None and now - created_at > self.ttl
+        images = value.get("images", []) if isinstance(value, dict) else []
+        if expired or not all(Path(fp).exists() for fp in images):
+            self.invalidate(key)
+            return None
+
+        with self.conn:
+            self.conn.execute(
+                "UPDATE results SET accessed_at = ? WHERE key = ?", [now, key]
+            )
+        return value
+
+    def set(self, key: str, value: dict) -> None:
+        """
+        Cache a result.
+
+        Parameters
+        ----------
+        key : str
+            The key, from make_key().
+        value : dict
+            The result.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                [key, json.dumps(value), now, now],
+            )
+        self.evict()
+
+    def invalidate(self, key: str) -> None:
+        """
+        Remove a result from the cache.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM results WHERE key = ?", [key])
+
+    def clear(self) -> None:
+        """
+        Remove every result from the cache.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM results")
+
+    def evict(self) -> None:
+        """
+        Remove expired results and the least recently used results over the limit.
+        """
+        with self.conn:
+            if self.ttl is not None:
+                self.conn.execute(
+                    "DELETE FROM results WHERE created_at < ?",
+                    [time.time() - self.ttl],
+                )
+            if self.max_entries is not None:
+                self.conn.execute(
+                    """
+                    DELETE FROM results WHERE key IN (
+                        SELECT key FROM results
+                        ORDER BY accessed_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    [self.max_entries],
+                )
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+@lru_cache
+def get_result_cache() -> ResultCache:
+    """
+    Get the result cache in data/cache.sqlite, shared by the whole process.
+    """
+    return ResultCache()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of text embeddings.
+
+    Embeddings are keyed by the hash of the model name and the text, and
+    stored as rows of a float32 matrix in a memory-mapped file, so a lookup
+    only reads the rows it needs. A SQLite index maps each key to its row.
+    Once there are ``max_entries`` embeddings, the rows of the least recently
+    used ones are reused. Lookups only record when an embedding was used if
+    it was last recorded more than ``touch_interval`` seconds ago, so most
+    lookups do not write.
+
+    Lookups hold a shared lock on the cache while they read the index and the
+    rows, and writes hold an exclusive one, so a row is never read while
+    another process reuses it.
+
+    ``hits`` and ``misses`` count lookups since the cache was opened.
+    """
+
+    def __init__(
+        self,
+        path: Path = EMBEDDING_CACHE_DIR,
+        max_entries: int = 50_000,
+        touch_interval: float = 60,
+    ):
+        """
+        Parameters
+        ----------
+        path : Path
+            The directory to store the cache in.
+        max_entries : int
+            Maximum number of embeddings.
+        touch_interval : float
+            Seconds before a lookup records again that an embedding was used.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+
+        path.mkdir(parents=True, exist_ok=True)
+        self.vectors_fp = path.joinpath("vectors.f32")
+        self.vectors_fp.touch()
+        self._vectors: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._file_lock_fd = os.open(
+            path.joinpath("vectors.lock"), os.O_RDWR | os.O_CREAT, 0o644
+        )
+
+        # Transactions are managed explicitly, so slots are allocated atomically
+        self.conn = sqlite3.connect(
+            path.joinpath("index.sqlite"),
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed_at "
+            "ON embeddings (accessed_at)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim: Optional[int] = row[0] if row else None
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{text}".encode()).hexdigest()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run statements in one transaction, taking the write lock up front.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    @contextmanager
+    def _file_lock(self, shared: bool):
+        """
+        Lock the cache against the other processes' writes.
+        """
+        lock_file(self._file_lock_fd, shared)
+        try:
+            yield
+        finally:
+            unlock_file(self._file_lock_fd)
+
+    def _slots(self, keys: list[str]) -> dict[str, tuple[int, float]]:
+        """
+        Get the slots and access times of the cached keys.
+        """
+        slots = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            rows = self.conn.execute(
+                "SELECT key, slot, accessed_at FROM embeddings "
+                f"WHERE key IN ({', '.join('?' * len(batch))})",
+                batch,
+            ).fetchall()
+            slots.update((key, (slot, accessed_at)) for key, slot, accessed_at in rows)
+        return slots
+
+    def _rows(self, slots: list[int]) -> np.ndarray:
+        """
+        Map the vectors file with room for at least the given slots.
+        """
+        if self.dim is None:
+            self.dim = self.conn.execute(
+                "SELECT value FROM meta WHERE name = 'dim'"
+            ).fetchone()[0]
+
+        needed = max(slots) + 1
+        if self._vectors is None or len(self._vectors) < needed:
+            row_size = self.dim * 4
+            rows = self.vectors_fp.stat().st_size // row_size
+            if rows < needed:
+                rows = max(needed, min(self.max_entries, max(2 * rows, 1024)))
+                with self.vectors_fp.open("r+b") as f:
+                    f.truncate(rows * row_size)
+            self._vectors = np.memmap(
+                self.vectors_fp, dtype=np.float32, mode="r+", shape=(rows, self.dim)
+            )
+        return self._vectors
+
+    def get_many(self, model: str, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """
+        Get cached embeddings.
+
+        Parameters
+        ----------
+        model : str
+            The embedding model name.
+        texts : list[str]
+            The texts.
+
+        Returns
+        -------
+        list[np.ndarray, optional]
+            The embedding of each text, or None for texts that are not cached.
+        """
+        keys = [self.make_key(model, text) for text in texts]
+        embeddings = [None] * len(keys)
+        with self._lock:
+            with self._file_lock(shared=True):
+                self.conn.execute("BEGIN")
+                try:
+                    slots = self._slots(keys)
+                    if slots:
+                        vectors = self._rows([slot for slot, _ in slots.values()])
+                        for i, key in enumerate(keys):
+                            if key in slots:
+                                embeddings[i] = np.array(vectors[slots[key][0]])
+                finally:
+                    self.conn.execute("COMMIT")
+
+            now = time.time()
+            stale = [
+                key
+                for key, (_, accessed_at) in slots.items()
+                if now - accessed_at >= self.touch_interval
+            ]
+            if stale:
+                with self._transaction():
+                    self.conn.executemany(
+                        "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                        [(now, key) for key in stale],
+                    )
+
+            hits = sum(embedding is not None for embedding in embeddings)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return embeddings
+
+    def set_many(self, model: str, texts: list[str], embeddings: list) -> None:
+        """
+        Cache embeddings.
+
+        Parameters
+        ----------
+        model : str
+            The embedding model name.
+        texts : list[str]
+            The texts.
+        embeddings : list
+            The embedding of each text.
+        """
+        if not texts:
+            return
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        items = dict(zip((self.make_key(model, text) for text in texts), vectors))
+        # Keep the last items if there are more than fit in the cache
+        keys = list(items)[-self.max_entries :]
+
+        with self._lock, self._file_lock(shared=False), self._transaction():
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE name = 'dim'"
+            ).fetchone()
+            self.dim = row[0] if row else vectors.shape[1]
+            if vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Expected embeddings of size {self.dim}, got {vectors.shape[1]}"
+                )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('dim', ?)", [self.dim]
+            )
+
+            slots = {key: slot for key, (slot, _) in self._slots(keys).items()}
+            new_keys = [key for key in keys if key not in slots]
+
+            # Allocate free slots, then reuse those of the least recently used
+            count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            free = list(range(count, min(self.max_entries, count + len(new_keys))))
+            if len(free) < len(new_keys):
+                candidates = self.conn.execute(
+                    "SELECT key, slot FROM embeddings ORDER BY accessed_at LIMIT ?",
+                    [len(new_keys) - len(free) + len(slots)],
+                ).fetchall()
+                evicted = [(key, slot) for key, slot in candidates if key not in slots]
+                evicted = evicted[: len(new_keys) - len(free)]
+                self.conn.executemany(
+                    "DELETE FROM embeddings WHERE key = ?",
+                    [(key,) for key, _ in evicted],
+                )
+                free.extend(slot for _, slot in evicted)
+            slots.update(zip(new_keys, free))
+
+            rows = self._rows(list(slots.values()))
+            for key, slot in slots.items():
+                rows[slot] = items[key]
+            rows.flush()
+
+            now = time.time()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(key, slot, now) for key, slot in slots.items()],
+            )
+
+    def clear(self) -> None:
+        """
+        Remove every embedding from the cache.
+        """
+        with self._lock:
+            self.conn.execute("DELETE FROM embeddings")
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self) -> None:
+        self._vectors = None
+        self.conn.close()
+        os.close(self._file_lock_fd)
@@ -0,0 +1,261 @@
+"""
+scraibe/catalog.py
+
+Catalog of the uploaded notes
+"""
+
+import csv
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+from config import DATA_DIR
+
+NOTES_DIR = DATA_DIR.joinpath("notes")
+CATALOG_FP = NOTES_DIR.joinpath("catalog.sqlite")
+LEGACY_FP = NOTES_DIR.joinpath("index.csv")
+
+COLUMNS = (
+    "id",
+    "filename",
+    "metadata",
+    "subject_id",
+    "page_count",
+    "text_size",
+    "status",
+    "error",
+    "created_at",
+    "updated_at",
+)
+
+
+class NoteCatalog:
+    """
+    SQLite catalog of the uploaded notes and their ingestion status.
+
+    Notes are listed newest first and paginated with a cursor, the position
+    of the last note of a page, so every page is an index range scan however
+    deep it is. Lookups by id, subject_id, status and filename prefix are
+    indexed. The database is in WAL mode and writes are single statements,
+    so readers never block and writers in other processes, e.g. other
+    uvicorn workers, wait on each other for at most ``timeout`` seconds.
+    """
+
+    UPLOADED = "uploaded"
+    FAILED = "failed"
+
+    def __init__(
+        self, path: Path = CATALOG_FP, legacy_fp: Path = LEGACY_FP, timeout: float = 30
+    ):
+        """
+        Parameters
+        ----------
+        path : Path
+            The filepath to the SQLite database.
+        legacy_fp : Path
+            The filepath to an index CSV of note ids and filenames to import.
+            The notes are imported as uploaded, to be ingested from their PDFs
+            in the CSV's directory.
+        timeout : float
+            Seconds to wait for other writers.
+        """
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS notes (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    subject_id INTEGER,
+                    page_count INTEGER,
+                    text_size INTEGER,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            for name, columns in [
+                ("created_at", "created_at, id"),
+                ("subject_id", "subject_id, created_at, id"),
+                ("status", "status, created_at, id"),
+                ("filename", "filename"),
+            ]:
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS notes_{name} ON notes ({columns})"
+                )
+
+        if legacy_fp.exists() and len(self) == 0:
+            self._import(legacy_fp)
+
+    def _import(self, legacy_fp: Path) -> None:
+        with legacy_fp.open(newline="") as f:
+            rows = [row for row in csv.reader(f) if len(row) == 2]
+        notes = [row for row in rows if row != ["id", "filename"]]
+        for note_id, filename in notes:
+            # Never ingested by the pipeline, so ingest them if the PDF is kept
+            pdf_fp = legacy_fp.parent.joinpath(note_id, f"{note_id}.pdf")
+            if pdf_fp.exists():
+                self.add(note_id, {"filename": filename})
+            else:
+                self.add(note_id, {"filename": filename}, status=self.FAILED)
+                self.update(note_id, error="PDF not found")
+
+    def add(self, note_id: str, metadata: dict, status: str = UPLOADED) -> None:
+        """
+        Add a note.
+
+        Parameters
+        ----------
+        note_id : str
+            The note id.
+        metadata : dict
+            The note's metadata, with its original "filename".
+        status : str
+            The ingestion status.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR IGNORE INTO notes
+                    (id, filename, metadata, subject_id, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    note_id,
+                    metadata["filename"],
+                    json.dumps(metadata),
+                    metadata.get("subject_id"),
+                    status,
+                    now,
+                    now,
+                ],
+            )
+
+    def update(self, note_id: str, **fields) -> None:
+        """
+        Update a note's fields, e.g. status, page_count, text_size or error.
+        """
+        fields = {k: v for k, v in fields.items() if k in COLUMNS and k != "id"}
+        if not fields:
+            return
+        fields["updated_at"] = time.time()
+        with self.conn:
+            self.conn.execute(
+                f"UPDATE notes SET {', '.join(f'{k} = ?' for k in fields)} "
+                "WHERE id = ?",
+                [*fields.values(), note_id],
+            )
+
+    def get(self, note_id: str) -> Optional[dict]:
+        """
+        Get a note, or None if it is unknown.
+        """
+        row = self.conn.execute(
+            "SELECT * FROM notes WHERE id = ?", [note_id]
+        ).fetchone()
+        return self._to_dict(row) if row else None
+
+    def pending(self, limit: int = 100) -> list[str]:
+        """
+        Get the ids of the oldest notes that are not stored or failed yet.
+        """
+        rows = self.conn.execute(
+            """
+            SELECT id FROM notes
+            WHERE status NOT IN ('stored', 'failed')
+            ORDER BY created_at, id
+            LIMIT ?
+            """,
+            [limit],
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def list(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        subject_id: Optional[int] = None,
+        status: Optional[str] = None,
+        filename: Optional[str] = None,
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        List notes, newest first.
+
+        Parameters
+        ----------
+        limit : int
+            Maximum number of notes.
+        cursor : str, optional
+            The cursor returned with the previous page.
+        subject_id : int, optional
+            Only notes of this subject.
+        status : str, optional
+            Only notes with this ingestion status.
+        filename : str, optional
+            Only notes whose original filename starts with this.
+
+        Returns
+        -------
+        tuple[list[dict], str | None]
+            The notes, and the cursor of the next page, or None if this is the
+            last page.
+
+        Raises
+        ------
+        ValueError
+            If the cursor is invalid.
+        """
+        where, params = [], []
+        if subject_id is not None:
+            where.append("subject_id = ?")
+            params.append(subject_id)
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        if filename:
+            # A range rather than LIKE, so the filename index is used
+            where.append("filename >= ? AND filename < ?")
+            params.extend([filename, filename + "\U0010ffff"])
+        if cursor is not None:
+            created_at, note_id = cursor.split(":", 1)
+            where.append("(created_at, id) < (?, ?)")
+            params.extend([float(created_at), note_id])
+
+        rows = self.conn.execute(
+            f"""
+            SELECT * FROM notes
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+            """,
+            [*params, limit + 1],
+        ).fetchall()
+
+        notes = [self._to_dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = f"{notes[-1]['created_at']!r}:{notes[-1]['id']}"
+        return notes, next_cursor
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        note = dict(row)
+        note["metadata"] = json.loads(note["metadata"])
+        return note
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
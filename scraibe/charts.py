@@ -0,0 +1,245 @@
+"""
+scraibe/charts.py
+
+Standard charts of the split tables, rendered locally
+"""
+
+import asyncio
+import io
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+import seaborn as sns
+from codeinterpreterapi import File
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
+
+from config import DATA_DIR
+from scraibe.cache import ResultCache, get_result_cache
+
+logger = logging.getLogger(__name__)
+
+VISUALIZATIONS_DIR = DATA_DIR.joinpath("visualizations")
+
+# Bump to re-render the cached charts after changing how they are drawn
+CHART_VERSION = 1
+
+# Maximum number of bars of the frequency charts
+TOP_N = 20
+
+
+def medication_timeline(df: pd.DataFrame, ax: Axes) -> Optional[str]:
+    """
+    Draw when each of the most prescribed drugs was given.
+    """
+    start = pd.to_datetime(df["starttime"], errors="coerce")
+    stop = pd.to_datetime(df["stoptime"], errors="coerce").fillna(start)
+    df = df.assign(start=start, stop=stop).dropna(subset=["start", "drug"])
+    if df.empty:
+        return None
+
+    drugs = df["drug"].value_counts().index[:TOP_N]
+    df = df[df["drug"].isin(drugs)]
+    colors = dict(zip(drugs, sns.color_palette("husl", len(drugs))))
+
+    for drug, rows in df.groupby("drug"):
+        ax.hlines(
+            [drug] * len(rows), rows["start"], rows["stop"], colors=[colors[drug]], lw=6
+        )
+        ax.plot(rows["start"], [drug] * len(rows), "|", color=colors[drug])
+
+    ax.set_title("Medication timeline")
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Drug")
+    ax.tick_params(axis="x", rotation=45)
+
+    return (
+        f"{len(df)} prescriptions of the {len(drugs)} most prescribed drugs, "
+        f"from {df['start'].min():%Y-%m-%d} to {df['stop'].max():%Y-%m-%d}."
+    )
+
+
+def icu_length_of_stay(df: pd.DataFrame, ax: Axes) -> Optional[str]:
+    """
+    Draw the length of each ICU stay, by care unit.
+    """
+    df = df.assign(intime=pd.to_datetime(df["intime"], errors="coerce"))
+    df = df.dropna(subset=["intime", "los"]).sort_values("intime")
+    if df.empty:
+        return None
+    df = df.assign(stay=df["intime"].dt.strftime("%Y-%m-%d %H:%M"))
+
+    sns.barplot(data=df, x="stay", y="los", hue="first_careunit", dodge=False, ax=ax)
+
+    ax.set_title("ICU length of stay")
+    ax.set_xlabel("Admitted to the ICU")
+    ax.set_ylabel("Days")
+    ax.tick_params(axis="x", rotation=45)
+
+    return (
+        f"{len(df)} ICU stays, {df['los'].sum():.1f} days in total, "
+        f"the longest {df['los'].max():.1f} days."
+    )
+
+
+def diagnosis_frequencies(df: pd.DataFrame, ax: Axes) -> Optional[str]:
+    """
+    Draw the most frequent diagnosis codes.
+    """
+    df = df.dropna(subset=["icd_code"])
+    if df.empty:
+        return None
+
+    codes = df["icd_code"].astype(str) + " (ICD-" + df["icd_version"].astype(str) + ")"
+    counts = codes.value_counts()
+    top = counts[:TOP_N].rename_axis("code").reset_index(name="count")
+
+    sns.barplot(data=top, x="count", y="code", color=sns.color_palette()[0], ax=ax)
+
+    ax.set_title("Most frequent diagnoses")
+    ax.set_xlabel("Count")
+    ax.set_ylabel("Diagnosis code")
+
+    return (
+        f"{len(codes)} diagnoses of {len(counts)} distinct codes, "
+        f"the most frequent {counts.index[0]} ({counts.iloc[0]} times)."
+    )
+
+
+# The chart of each standard table, by file name. Charts return their text,
+# or None if no row can be charted.
+CHARTS: dict[str, Callable[[pd.DataFrame, Axes], Optional[str]]] = {
+    "prescriptions.csv": medication_timeline,
+    "icustays.csv": icu_length_of_stay,
+    "diagnoses_icd.csv": diagnosis_frequencies,
+}
+
+
+def render_chart(name: str, content: bytes, fp: Path) -> dict[str, list[str]]:
+    """
+    Render the standard chart of a table to a PNG file.
+
+    Parameters
+    ----------
+    name : str
+        The file name of the table, a key of CHARTS.
+    content : bytes
+        The CSV content of the table.
+    fp : Path
+        The filepath to save the chart to.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        The text and saved image paths of the chart. Tables without rows that
+        can be charted have no chart.
+    """
+
+    df = pd.read_csv(io.BytesIO(content))
+    if df.empty:
+        return {"text": f"{name} has no rows.", "images": []}
+
+    # A bare Figure needs no GUI backend, and is freed once out of scope
+    sns.set_theme()
+    fig = Figure(figsize=(12, 6))
+    text = CHARTS[name](df, fig.subplots())
+    if text is None:
+        return {"text": f"{name} has no rows to chart.", "images": []}
+    fig.tight_layout()
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(fp, dpi=100)
+
+    return {"text": text, "images": [str(fp)]}
+
+
+@lru_cache
+def get_chart_pool() -> ProcessPoolExecutor:
+    """
+    Get the shared process pool the charts are rendered in by default.
+
+    It is created on first use, with a process per CPU.
+    """
+    return ProcessPoolExecutor()
+
+
+async def render_charts(
+    files: list[File],
+    cache: Optional[ResultCache] = None,
+    executor: Optional[Executor] = None,
+    out_dir: Optional[Path] = None,
+    on_result: Optional[Callable[[str, dict], None]] = None,
+) -> dict[str, dict[str, list[str]]]:
+    """
+    Render the standard chart of each table that has one.
+
+    Charts are cached by the content of their table, and the missing ones are
+    rendered in parallel processes. Tables whose chart fails to render are
+    left out of the results, to be visualized another way.
+
+    Parameters
+    ----------
+    files : list[File]
+        The tables. Tables without a standard chart are skipped.
+    cache : ResultCache, optional
+        The result cache. Defaults to the shared cache in data/cache.sqlite.
+    executor : Executor, optional
+        Process pool to render in. Defaults to the shared chart pool.
+    out_dir : Path, optional
+        Directory to save the charts to. Defaults to data/visualizations.
+    on_result : Callable[[str, dict], None], optional
+        Called with the file name and result of each table as it completes.
+
+    Returns
+    -------
+    dict[str, dict[str, list[str]]]
+        The text and saved image paths of each table's chart, by file name,
+        in the same order as ``files``, except the tables that failed.
+    """
+
+    if cache is None:
+        cache = get_result_cache()
+    if out_dir is None:
+        out_dir = VISUALIZATIONS_DIR
+
+    results = {}
+    misses = {}
+    for dataset in files:
+        if dataset.name not in CHARTS:
+            continue
+        key = cache.make_key(
+            f"render_chart\n{dataset.name}", [dataset.content], "local", CHART_VERSION
+        )
+        results[dataset.name] = cache.get(key)
+        if results[dataset.name] is None:
+            misses[dataset.name] = (dataset, key)
+        elif on_result is not None:
+            on_result(dataset.name, results[dataset.name])
+
+    if not misses:
+        return results
+
+    loop = asyncio.get_running_loop()
+    pool = executor or get_chart_pool()
+
+    async def render(dataset: File, key: str) -> None:
+        # Named by its key, so re-rendering a table overwrites its chart
+        fp = out_dir.joinpath(f"{key[:32]}.png")
+        try:
+            result = await loop.run_in_executor(
+                pool, render_chart, dataset.name, dataset.content, fp
+            )
+        except Exception as e:
+            logger.warning("Failed to render the chart of %s: %s", dataset.name, e)
+            del results[dataset.name]
+            return
+        cache.set(key, result)
+        results[dataset.name] = result
+        if on_result is not None:
+            on_result(dataset.name, result)
+
+    await asyncio.gather(*[render(*miss) for miss in misses.values()])
+    return results
@@ -0,0 +1,166 @@
+"""
+scraibe/chat.py
+
+Async chat service over the clinical notes
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+from uuid import uuid4
+
+import openai
+
+from scraibe.agent import summarize_chat
+from scraibe.bot import SYSTEM_PROMPT
+from scraibe.cache import ResultCache
+from scraibe.context import ChatContext
+from scraibe.embed import BatchEmbedder
+from scraibe.store import BaseVectorStore
+
+CHAT_MODEL = "gpt-4"
+
+
+class ChatSession:
+    """
+    One conversation and its context.
+
+    Turns of a conversation run one at a time, in order.
+    """
+
+    def __init__(self, context: ChatContext):
+        self.id = str(uuid4())
+        self.context = context
+        self.lock = asyncio.Lock()
+
+
+class ChatService:
+    """
+    Serves many conversations from one event loop.
+
+    Each turn embeds the message with an async request and searches the
+    vector store in a worker thread, so turns of other conversations run
+    meanwhile. The reply is streamed token by token as the model generates
+    it. The oldest turns of a conversation over its token budget are
+    summarized by the model. Once there are more than ``max_sessions``
+    conversations, the least recently used ones are forgotten.
+
+    Conversations are kept in memory, so they are only known to the process
+    that started them.
+    """
+
+    def __init__(
+        self,
+        embedder: BatchEmbedder,
+        vector_store: BaseVectorStore,
+        model: str = CHAT_MODEL,
+        limit: int = 4,
+        max_tokens: int = 6000,
+        max_sessions: int = 1000,
+        cache: Optional[ResultCache] = None,
+    ):
+        """
+        Parameters
+        ----------
+        embedder : BatchEmbedder
+            Embeds the messages.
+        vector_store : BaseVectorStore
+            The notes to search.
+        model : str
+            The chat model.
+        limit : int
+            Number of notes to retrieve per message.
+        max_tokens : int
+            Token budget of each conversation's context.
+        max_sessions : int
+            Maximum number of conversations to remember.
+        cache : ResultCache, optional
+            Caches the summaries. Defaults to the shared cache in
+            data/cache.sqlite.
+        """
+        self.embedder = embedder
+        self.vector_store = vector_store
+        self.model = model
+        self.limit = limit
+        self.max_tokens = max_tokens
+        self.max_sessions = max_sessions
+        self.cache = cache
+        self.sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+    async def summarize(self, summary: str, messages: list[dict]) -> str:
+        """
+        Fold the oldest turns of a conversation into its summary.
+        """
+        return await summarize_chat(summary, messages, self.cache)
+
+    def get_session(self, session_id: Optional[str] = None) -> ChatSession:
+        """
+        Get a conversation, or start one if it is unknown.
+        """
+        session = self.sessions.get(session_id) if session_id else None
+        if session is None:
+            session = ChatSession(
+                ChatContext(SYSTEM_PROMPT, self.max_tokens, summarize=self.summarize)
+            )
+            self.sessions[session.id] = session
+
+        self.sessions.move_to_end(session.id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+        return session
+
+    async def retrieve(self, query: str, **filters) -> list[str]:
+        """
+        Find the notes most similar to a query.
+        """
+        (embedding,) = await self.embedder.aembed([query])
+
+        def search():
+            # Load the notes ingested by another worker since the last search
+            self.vector_store.refresh()
+            return self.vector_store.select_nearest(embedding, self.limit, **filters)
+
+        matches = await asyncio.to_thread(search)
+        return [match.text for match in matches]
+
+    async def stream(
+        self, session: ChatSession, message: str, **filters
+    ) -> AsyncIterator[str]:
+        """
+        Reply to a message.
+
+        Parameters
+        ----------
+        session : ChatSession
+            The conversation.
+        message : str
+            The user's message.
+        **filters
+            Metadata the retrieved notes must have, e.g. subject_id.
+
+        Yields
+        ------
+        str
+            The reply, a few tokens at a time.
+        """
+        async with session.lock:
+            session.context.add_notes(await self.retrieve(message, **filters))
+            session.context.add_message("user", message)
+
+            response = await openai.ChatCompletion.acreate(
+                model=self.model,
+                messages=await session.context.amessages(),
+                stream=True,
+            )
+
+            reply = []
+            try:
+                async for chunk in response:
+                    content = chunk["choices"][0]["delta"].get("content")
+                    if content:
+                        reply.append(content)
+                        yield content
+            finally:
+                # Keep what was sent, even if the client disconnected
+                session.context.add_message("assistant", "".join(reply))
@@ -0,0 +1,216 @@
+"""
+scraibe/context.py
+
+Bounded chat context for the bot
+"""
+
+import inspect
+from functools import lru_cache
+from typing import Awaitable, Callable, Optional, Union
+
+import tiktoken
+
+from scraibe.dedup import hash_text
+from scraibe.embed import count_tokens as estimate_tokens
+
+# Tokenizer of the chat models
+ENCODING = "cl100k_base"
+
+# Tokens added by the chat format to each message
+MESSAGE_TOKENS = 4
+
+
+@lru_cache
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    """
+    Get the chat models' tokenizer, or None if it cannot be loaded.
+
+    tiktoken downloads the tokenizer on first use, which fails offline.
+    """
+    try:
+        return tiktoken.get_encoding(ENCODING)
+    except Exception as e:
+        print(f"Failed to load the {ENCODING} tokenizer, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text as the chat models do.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + MESSAGE_TOKENS
+
+
+class ChatContext:
+    """
+    The messages sent to the model, kept within a token budget.
+
+    The context is the system prompt, then one message with the retrieved
+    notes, then the conversation. Notes are kept once each, however often
+    they are retrieved, and the least recently retrieved notes are dropped
+    once they exceed ``notes_tokens``. The oldest turns of the conversation
+    are dropped once the whole context exceeds ``max_tokens``. With a
+    ``summarize`` function, dropped turns are folded into a running summary
+    instead. An async ``summarize`` needs the async amessages().
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        max_tokens: int = 6000,
+        notes_tokens: int = 2000,
+        summarize: Optional[
+            Callable[[str, list[dict]], Union[str, Awaitable[str]]]
+        ] = None,
+    ):
+        """
+        Parameters
+        ----------
+        system_prompt : str
+            The system prompt.
+        max_tokens : int
+            Maximum number of tokens of the context.
+        notes_tokens : int
+            Maximum number of tokens of notes, out of ``max_tokens``.
+        summarize : Callable[[str, list[dict]], str], optional
+            Function of the summary so far and the dropped messages, returning
+            the new summary, or a coroutine of it.
+        """
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.notes_tokens = notes_tokens
+        self.summarize = summarize
+
+        self.notes: dict[str, str] = {}
+        self.history: list[dict] = []
+        self.summary = ""
+
+    def add_notes(self, texts: list[str]) -> list[str]:
+        """
+        Add retrieved notes to the context.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The notes, most relevant first.
+
+        Returns
+        -------
+        list[str]
+            The notes that were not already in the context.
+        """
+        new = []
+        for text in reversed(texts):
+            key = hash_text(text)
+            if key in self.notes:
+                # Retrieved again, so it is now the most recent
+                self.notes[key] = self.notes.pop(key)
+            else:
+                self.notes[key] = text
+                new.append(text)
+
+        while len(self.notes) > 1 and self._notes_tokens() > self.notes_tokens:
+            del self.notes[next(iter(self.notes))]
+
+        return new[::-1]
+
+    def add_message(self, role: str, content: str) -> None:
+        """
+        Add a message to the conversation.
+        """
+        self.history.append({"role": role, "content": content})
+
+    def _notes_tokens(self) -> int:
+        return sum(count_tokens(text) for text in self.notes.values())
+
+    def _prefix(self) -> list[dict]:
+        """
+        The messages before the conversation.
+        """
+        prefix = [{"role": "system", "content": self.system_prompt}]
+        if self.summary:
+            prefix.append(
+                {
+                    "role": "system",
+                    "content": f"Summary of the conversation so far:\n{self.summary}",
+                }
+            )
+        if self.notes:
+            notes = "\n\n".join(f"Note: {text}" for text in self.notes.values())
+            prefix.append(
+                {
+                    "role": "system",
+                    "content": f"Relevant medical notes:\n\n{notes}",
+                }
+            )
+        return prefix
+
+    def _overflow(self) -> int:
+        """
+        Number of the oldest messages to drop to fit in ``max_tokens``.
+
+        The latest message is always kept.
+        """
+        budget = self.max_tokens - sum(map(message_tokens, self._prefix()))
+        total = sum(map(message_tokens, self.history))
+
+        dropped = 0
+        while dropped < len(self.history) - 1 and total > budget:
+            total -= message_tokens(self.history[dropped])
+            dropped += 1
+        return dropped
+
+    def trim(self) -> None:
+        """
+        Drop the oldest turns until the context fits in ``max_tokens``.
+
+        The latest message is always kept.
+        """
+        # A longer summary can take the room of more turns, so check again
+        while dropped := self._overflow():
+            if self.summarize is not None:
+                summary = self.summarize(self.summary, self.history[:dropped])
+                if inspect.iscoroutine(summary):
+                    summary.close()
+                    raise TypeError("An async summarize needs amessages()")
+                self.summary = summary
+            self.history = self.history[dropped:]
+
+    async def atrim(self) -> None:
+        """
+        Drop the oldest turns like trim(), awaiting an async ``summarize``.
+        """
+        while dropped := self._overflow():
+            if self.summarize is not None:
+                summary = self.summarize(self.summary, self.history[:dropped])
+                if inspect.isawaitable(summary):
+                    summary = await summary
+                self.summary = summary
+            self.history = self.history[dropped:]
+
+    def messages(self) -> list[dict]:
+        """
+        Get the messages to send to the model.
+        """
+        self.trim()
+        return self._prefix() + self.history
+
+    async def amessages(self) -> list[dict]:
+        """
+        Get the messages to send to the model, awaiting an async ``summarize``.
+        """
+        await self.atrim()
+        return self._prefix() + self.history
+
+    def tokens(self) -> int:
+        """
+        Count the tokens of the messages.
+        """
+        return sum(map(message_tokens, self.messages()))
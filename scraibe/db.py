@@ -1,6 +1,10 @@
 """scraibe/db.py"""
 
 import os
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable
 
 import iris
 from dotenv import load_dotenv
@@ -14,6 +18,8 @@ IRIS_PORT = os.getenv("IRIS_PORT")
 IRIS_NAME = os.getenv("IRIS_NAME")
 IRIS_USER = os.getenv("IRIS_USER")
 IRIS_PASS = os.getenv("IRIS_PASS")
+# The schema of the MIMIC tables, which unqualified table names resolve to
+IRIS_SCHEMA = os.getenv("IRIS_SCHEMA", "SQLUser")
 
 assert IRIS_HOST, "IRIS_HOST environment variable not set"
 assert IRIS_PORT, "IRIS_PORT environment variable not set"
@@ -29,6 +35,122 @@ def connect() -> iris.IRISConnection:
     return iris.connect(f"{IRIS_HOST}:{IRIS_PORT}/{IRIS_NAME}", IRIS_USER, IRIS_PASS)
 
 
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections.
+
+    Connections are opened lazily, up to ``size`` at a time, and handed back
+    to the pool for reuse once the caller is done with them.
+    """
+
+    def __init__(self, size: int = 4, connect_fn: Callable = connect):
+        """
+        Parameters
+        ----------
+        size : int
+            Maximum number of open connections.
+        connect_fn : Callable
+            Function returning a new DB-API connection.
+        """
+        if size < 1:
+            raise ValueError("Pool size must be at least 1.")
+
+        self.size = size
+        self._connect = connect_fn
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+
+        if not can_open:
+            # Wait for another thread to release a connection
+            return self._idle.get()
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool for the duration of the block.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        """
+        Close all idle connections.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def __enter__(self) -> "ConnectionPool":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def get_tables_with_column(
+    conn, column: str, tables: Iterable[str], schema: str = IRIS_SCHEMA
+) -> set[str]:
+    """
+    Find which tables have a given column with a single INFORMATION_SCHEMA query.
+
+    Parameters
+    ----------
+    conn
+        DB-API connection.
+    column : str
+        The column name to look for (case-insensitive).
+    tables : Iterable[str]
+        The tables to check.
+    schema : str
+        The schema of the tables (case-insensitive). Tables of the same name
+        in other schemas are ignored.
+
+    Returns
+    -------
+    set[str]
+        The subset of ``tables`` that have the column.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            "WHERE LOWER(TABLE_SCHEMA) = ? AND LOWER(COLUMN_NAME) = ?",
+            [schema.lower(), column.lower()],
+        )
+        found = {row[0].lower() for row in cur.fetchall()}
+    finally:
+        cur.close()
+
+    return {table for table in tables if table.lower() in found}
+
+
 if __name__ == "__main__":
     conn = connect()
 
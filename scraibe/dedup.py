@@ -0,0 +1,114 @@
+"""
+scraibe/dedup.py
+
+Index of texts already added to the vector store
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from config import DATA_DIR
+
+DEDUP_FP = DATA_DIR.joinpath("dedup.sqlite")
+LEGACY_FP = DATA_DIR.joinpath("vector.txt")
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class DedupIndex:
+    """
+    Set of hashes of the documents and chunks in the vector store.
+
+    Hashes are the primary key of a SQLite table, so membership is an index
+    lookup. Writers in other threads or processes are serialized by a lock
+    and by SQLite. Hashes from the old data/vector.txt file are imported once.
+    """
+
+    DOCUMENT = "document"
+    CHUNK = "chunk"
+
+    def __init__(self, path: Path = DEDUP_FP, legacy_fp: Path = LEGACY_FP):
+        """
+        Parameters
+        ----------
+        path : Path
+            The filepath to the SQLite database.
+        legacy_fp : Path
+            The filepath to a file of document hashes, one per line, to import.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS hashes (
+                    hash TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                ) WITHOUT ROWID
+                """
+            )
+
+        if legacy_fp.exists() and len(self) == 0:
+            with legacy_fp.open() as f:
+                self.add_many([line.strip() for line in f if line.strip()])
+
+    def missing(self, hashes: list[str]) -> list[str]:
+        """
+        Get the hashes that are not in the index.
+
+        Parameters
+        ----------
+        hashes : list[str]
+            The hashes.
+
+        Returns
+        -------
+        list[str]
+            The hashes not in the index, in order and without repeats.
+        """
+        hashes = list(dict.fromkeys(hashes))
+        found = set()
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i : i + 500]
+            rows = self.conn.execute(
+                f"SELECT hash FROM hashes WHERE hash IN ({', '.join('?' * len(batch))})",
+                batch,
+            ).fetchall()
+            found.update(row[0] for row in rows)
+        return [h for h in hashes if h not in found]
+
+    def __contains__(self, hash_value: str) -> bool:
+        return not self.missing([hash_value])
+
+    def add_many(self, hashes: list[str], kind: str = DOCUMENT) -> None:
+        """
+        Add hashes to the index in one transaction.
+
+        Parameters
+        ----------
+        hashes : list[str]
+            The hashes.
+        kind : str
+            DOCUMENT or CHUNK.
+        """
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO hashes VALUES (?, ?, ?)",
+                [(h, kind, now) for h in hashes],
+            )
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
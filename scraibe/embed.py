@@ -0,0 +1,174 @@
+"""
+scraibe/embed.py
+
+Batched OpenAI embeddings
+"""
+
+import asyncio
+import random
+from typing import Optional
+
+import openai
+
+from scraibe.cache import EmbeddingCache
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Errors worth retrying: rate limits and transient server or network failures
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text, at about 4 characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+class BatchEmbedder:
+    """
+    Embeds many texts with few requests.
+
+    Texts are grouped into multi-input requests of at most ``max_batch_size``
+    texts and ``max_batch_tokens`` estimated tokens. Up to ``concurrency``
+    requests are in flight at once, and requests that hit a rate limit or a
+    transient error are retried with exponential backoff.
+
+    Repeated texts are embedded once, and with a ``cache`` only texts that are
+    not cached are sent.
+    """
+
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        max_batch_size: int = 512,
+        max_batch_tokens: int = 100_000,
+        concurrency: int = 4,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        cache: Optional[EmbeddingCache] = None,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cache = cache
+
+    def batches(self, texts: list[str]) -> list[list[int]]:
+        """
+        Group texts into batches.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts.
+
+        Returns
+        -------
+        list[list[int]]
+            The indices of the texts in each batch, in order.
+        """
+        batches = []
+        batch, batch_tokens = [], 0
+
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text)
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or batch_tokens + tokens > self.max_batch_tokens
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    async def _request(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await openai.Embedding.acreate(model=self.model, input=texts)
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+
+                # Prefer the server's hint, otherwise back off exponentially with jitter
+                retry_after = (getattr(e, "headers", None) or {}).get("retry-after")
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = min(self.max_delay, self.base_delay * 2**attempt)
+                    delay *= random.uniform(0.5, 1.0)
+                await asyncio.sleep(delay)
+
+        # Results are not guaranteed to be in input order
+        data = sorted(response["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embed texts.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts.
+
+        Returns
+        -------
+        list[list[float]]
+            The embedding of each text, in order.
+        """
+        unique = list(dict.fromkeys(texts))
+        embeddings = {}
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get_many, self.model, unique)
+            for text, embedding in zip(unique, cached):
+                if embedding is not None:
+                    embeddings[text] = embedding.tolist()
+        missing = [text for text in unique if text not in embeddings]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def embed_batch(batch: list[int]) -> list[list[float]]:
+            async with semaphore:
+                return await self._request([missing[i] for i in batch])
+
+        batches = self.batches(missing)
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+
+        new_embeddings = {}
+        for batch, batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                new_embeddings[missing[i]] = embedding
+
+        if self.cache is not None:
+            await asyncio.to_thread(
+                self.cache.set_many,
+                self.model,
+                list(new_embeddings),
+                list(new_embeddings.values()),
+            )
+        embeddings.update(new_embeddings)
+
+        return [embeddings[text] for text in texts]
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embed texts. Blocking version of aembed().
+        """
+        return asyncio.run(self.aembed(texts))
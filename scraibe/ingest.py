@@ -0,0 +1,531 @@
+"""
+scraibe/ingest.py
+
+Background ingestion of uploaded notes into the vector store
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+from scraibe.bot import Bot
+from scraibe.dedup import DedupIndex, hash_text
+from scraibe.embed import BatchEmbedder
+from scraibe.pdf import page_count, pdf_to_txt
+from scraibe.store import BaseVectorStore
+
+
+class Note:
+    """
+    An uploaded note and its ingestion state.
+
+    The files of a note are in its own directory, named by its id. The state
+    is saved after each stage, with the stage's output, so ingestion can
+    resume from the last completed stage.
+    """
+
+    EXTRACTED = "extracted"
+    CHUNKED = "chunked"
+    EMBEDDED = "embedded"
+    STORED = "stored"
+    FAILED = "failed"
+
+    def __init__(self, base_dir: Path):
+        self.id = base_dir.name
+        self.base_dir = base_dir
+        self.pdf_fp = base_dir.joinpath(f"{self.id}.pdf")
+        self.txt_fp = base_dir.joinpath(f"{self.id}.txt")
+        self.json_fp = base_dir.joinpath(f"{self.id}.json")
+        self.state_fp = base_dir.joinpath(f"{self.id}.ingest.json")
+        self.chunks_fp = base_dir.joinpath(f"{self.id}.chunks.json")
+        self.embeddings_fp = base_dir.joinpath(f"{self.id}.embeddings.npy")
+
+    @property
+    def metadata(self) -> dict:
+        if not self.json_fp.exists():
+            return {}
+        return json.loads(self.json_fp.read_text())
+
+    @property
+    def state(self) -> dict:
+        if not self.state_fp.exists():
+            return {"stage": None}
+        return json.loads(self.state_fp.read_text())
+
+    def save_state(self, stage: str, **info) -> None:
+        """
+        Save the last completed stage, keeping the info of earlier stages.
+        """
+        state = {**self.state, "stage": stage, **info}
+        tmp_fp = self.state_fp.with_suffix(".tmp")
+        tmp_fp.write_text(json.dumps(state))
+        os.replace(tmp_fp, self.state_fp)
+
+
+class IngestPipeline:
+    """
+    Staged pipeline from uploaded PDFs to searchable vectors.
+
+    Notes go through the stages extract (PDF to text), chunk (split, and
+    drop chunks that are already stored), embed (in batched requests) and
+    store (bulk insert). Each stage runs in its own tasks, and stages are
+    connected by bounded queues: when a later stage falls behind, the
+    earlier stages wait instead of piling up work, which keeps the load on
+    the embedding API in check.
+
+    The vector store is saved at most once every ``save_interval`` seconds,
+    for all the notes stored meanwhile, and once more on stop(). Notes are
+    marked as stored once their chunks are saved.
+
+    A chunk shared by notes ingested at the same time is claimed by the
+    first note to reach it, and only that note embeds and stores it. The
+    other notes wait for it before they are marked as stored, and store it
+    themselves if that note fails.
+    """
+
+    STAGES = (None, Note.EXTRACTED, Note.CHUNKED, Note.EMBEDDED)
+
+    def __init__(
+        self,
+        embedder: BatchEmbedder,
+        vector_store: BaseVectorStore,
+        dedup: DedupIndex,
+        executor: Optional[Executor] = None,
+        queue_size: int = 8,
+        extract_workers: int = 2,
+        embed_workers: int = 2,
+        save_interval: float = 1.0,
+        on_state: Optional[Callable[[Note, dict], None]] = None,
+    ):
+        """
+        Parameters
+        ----------
+        embedder : BatchEmbedder
+            Embeds the chunks.
+        vector_store : BaseVectorStore
+            Stores the chunks.
+        dedup : DedupIndex
+            Index of the stored notes and chunks.
+        executor : Executor, optional
+            Executor to extract text from PDFs in. Defaults to the event
+            loop's thread pool.
+        queue_size : int
+            Maximum number of notes waiting between two stages.
+        extract_workers : int
+            Number of notes extracted at once.
+        embed_workers : int
+            Number of notes embedded at once.
+        save_interval : float
+            Seconds to wait for more notes before saving the vector store.
+        on_state : Callable[[Note, dict], None], optional
+            Called with a note and its new state after each stage.
+        """
+        self.embedder = embedder
+        self.vector_store = vector_store
+        self.dedup = dedup
+        self.executor = executor
+        self.queue_size = queue_size
+        self.workers = {
+            None: extract_workers,
+            Note.EXTRACTED: 1,
+            Note.CHUNKED: embed_workers,
+            Note.EMBEDDED: 1,
+        }
+        self.save_interval = save_interval
+        self.on_state = on_state
+
+        self.queues: dict[Optional[str], asyncio.Queue] = {}
+        self.tasks: list[asyncio.Task] = []
+
+        # Ids of the submitted notes that are not stored or failed yet
+        self._active: set[str] = set()
+
+        # Chunks being ingested, so concurrent notes do not store them twice:
+        # by hash, the id of the note storing it and a future that is done once
+        # that note stored it or failed
+        self._in_flight: dict[str, tuple[str, asyncio.Future]] = {}
+
+        # Stored notes waiting for the vector store to be saved, or for the
+        # shared chunks of other notes
+        self._finishing: set[asyncio.Task] = set()
+
+        # The next save of the vector store, and the hashes and ids of the
+        # chunks inserted since the last one
+        self._save: Optional[asyncio.Task] = None
+        self._unsaved: list[tuple[list[str], list[int]]] = []
+
+    def start(self) -> None:
+        """
+        Start the stages. Must be called from a running event loop.
+        """
+        stage_fns = {
+            None: self.extract,
+            Note.EXTRACTED: self.chunk,
+            Note.CHUNKED: self.embed,
+            Note.EMBEDDED: self.store,
+        }
+        for i, stage in enumerate(self.STAGES):
+            # Uploads are never held back, only the stages after them
+            self.queues[stage] = asyncio.Queue(maxsize=0 if i == 0 else self.queue_size)
+
+        for i, stage in enumerate(self.STAGES):
+            next_stages = self.STAGES[i + 1 :]
+            next_queue = self.queues[next_stages[0]] if next_stages else None
+            for _ in range(self.workers[stage]):
+                self.tasks.append(
+                    asyncio.create_task(
+                        self._work(stage_fns[stage], self.queues[stage], next_queue)
+                    )
+                )
+
+    @property
+    def running(self) -> bool:
+        return bool(self.tasks)
+
+    async def stop(self) -> None:
+        """
+        Stop the stages. Notes in progress resume from their last stage.
+        """
+        tasks = [*self.tasks, *self._finishing]
+        if self._save is not None:
+            tasks.append(self._save)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+        self._in_flight.clear()
+        self._active.clear()
+
+        # Save the chunks inserted so far, so resumed notes skip them
+        await self.flush()
+
+    async def join(self) -> None:
+        """
+        Wait until every submitted note is stored or failed.
+        """
+        for stage in self.STAGES:
+            await self.queues[stage].join()
+        while self._finishing:
+            await asyncio.gather(*self._finishing, return_exceptions=True)
+
+    async def submit(self, note: Note) -> bool:
+        """
+        Ingest a note, from the stage after its last completed stage.
+
+        Returns
+        -------
+        bool
+            Whether the note was queued. Notes already stored or failed, or
+            already being ingested, are not.
+        """
+        stage = note.state["stage"]
+        if stage in (Note.STORED, Note.FAILED) or note.id in self._active:
+            return False
+        self._active.add(note.id)
+        if stage in (Note.CHUNKED, Note.EMBEDDED):
+            # Resumed, so claim its chunks again
+            data = json.loads(await asyncio.to_thread(note.chunks_fp.read_text))
+            self._claim(note, [h for h in data["chunks"] if h not in self._in_flight])
+        await self.queues[stage].put(note)
+        return True
+
+    async def resume(self, notes_dir: Path) -> list[Note]:
+        """
+        Resume ingesting the notes that were not finished.
+
+        Parameters
+        ----------
+        notes_dir : Path
+            The directory of the notes' directories.
+
+        Returns
+        -------
+        list[Note]
+            The resumed notes.
+        """
+        notes = []
+        if notes_dir.exists():
+            for base_dir in sorted(notes_dir.iterdir()):
+                note = Note(base_dir)
+                if not note.pdf_fp.exists():
+                    continue
+                if await self.submit(note):
+                    notes.append(note)
+        return notes
+
+    def save_state(self, note: Note, stage: str, **info) -> None:
+        """
+        Save a note's state, and report it to ``on_state``.
+        """
+        note.save_state(stage, **info)
+        if stage in (Note.STORED, Note.FAILED):
+            self._active.discard(note.id)
+        if self.on_state is not None:
+            self.on_state(note, note.state)
+
+    def _claim(self, note: Note, hashes: list[str]) -> None:
+        """
+        Mark chunks as being stored by a note.
+        """
+        loop = asyncio.get_running_loop()
+        for h in hashes:
+            self._in_flight[h] = (note.id, loop.create_future())
+
+    def _release(self, note: Note, hashes: Optional[list[str]] = None) -> None:
+        """
+        Release the chunks claimed by a note, by default all of them, once they
+        are stored or failed. Notes waiting on them are woken up.
+        """
+        if hashes is None:
+            hashes = [
+                h for h, (note_id, _) in self._in_flight.items() if note_id == note.id
+            ]
+        for h in hashes:
+            claim = self._in_flight.get(h)
+            if claim is not None and claim[0] == note.id:
+                del self._in_flight[h]
+                claim[1].set_result(None)
+
+    async def _wait_for(self, note: Note, hashes: list[str]) -> list[str]:
+        """
+        Wait until other notes have stored chunks they claimed.
+
+        Returns
+        -------
+        list[str]
+            The chunks they failed to store, now claimed by this note.
+        """
+        claimed = []
+        while hashes:
+            for h in hashes:
+                if h in self._in_flight:
+                    await asyncio.wait([self._in_flight[h][1]])
+
+            missing = await asyncio.to_thread(self.dedup.missing, hashes)
+            # Chunks claimed again by another note meanwhile are waited on again
+            hashes = [h for h in missing if h in self._in_flight]
+            new = [h for h in missing if h not in self._in_flight]
+            self._claim(note, new)
+            claimed.extend(new)
+        return claimed
+
+    def fail(self, note: Note, error: Exception) -> None:
+        """
+        Mark a note as failed, and release its chunks.
+        """
+        self._release(note)
+        self.save_state(
+            note, Note.FAILED, failed_stage=note.state["stage"], error=str(error)
+        )
+        print(f"Failed to ingest note {note.id}: {error}")
+
+    async def _work(self, stage_fn, queue: asyncio.Queue, next_queue) -> None:
+        while True:
+            note = await queue.get()
+            try:
+                await stage_fn(note)
+            except Exception as e:
+                try:
+                    self.fail(note, e)
+                except Exception as fail_error:
+                    # Keep the worker running; the note resumes on restart
+                    print(f"Failed to mark note {note.id} as failed: {fail_error}")
+            else:
+                if next_queue is not None and note.state["stage"] != Note.STORED:
+                    await next_queue.put(note)
+            finally:
+                queue.task_done()
+
+    async def extract(self, note: Note) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, pdf_to_txt, note.pdf_fp, note.txt_fp)
+        pages = await loop.run_in_executor(self.executor, page_count, note.pdf_fp)
+        self.save_state(
+            note, Note.EXTRACTED, pages=pages, text_size=note.txt_fp.stat().st_size
+        )
+
+    def split(self, note: Note) -> tuple[str, Optional[dict[str, str]], list[str]]:
+        """
+        Split a note's text into chunks, by their hash.
+
+        Returns
+        -------
+        tuple[str, dict[str, str] | None, list[str]]
+            The hash of the text, its chunks, or None if the whole text is
+            already stored, and the hashes of the chunks not stored yet.
+        """
+        text = note.txt_fp.read_text(encoding="utf-8")
+        document = hash_text(text)
+        if document in self.dedup:
+            return document, None, []
+
+        chunks = {
+            hash_text(chunk.page_content): chunk.page_content
+            for chunk in Bot.chunk_text(text)
+        }
+        return document, chunks, self.dedup.missing(list(chunks))
+
+    async def chunk(self, note: Note) -> None:
+        # Reading, hashing and splitting large notes would block the event loop
+        document, chunks, missing = await asyncio.to_thread(self.split, note)
+        if chunks is None:
+            self.save_state(note, Note.STORED, duplicate=True)
+            return
+
+        # Chunks claimed by other notes are only stored here if those fail
+        new = [h for h in missing if h not in self._in_flight]
+        shared = [h for h in missing if h in self._in_flight]
+        self._claim(note, new)
+
+        data = {
+            "document": document,
+            "chunks": {h: chunks[h] for h in new},
+            "shared": {h: chunks[h] for h in shared},
+        }
+        await asyncio.to_thread(note.chunks_fp.write_text, json.dumps(data))
+        self.save_state(note, Note.CHUNKED, chunks=len(chunks), new_chunks=len(new))
+
+    async def embed(self, note: Note) -> None:
+        data = json.loads(await asyncio.to_thread(note.chunks_fp.read_text))
+        embeddings = await self.embedder.aembed(list(data["chunks"].values()))
+        await asyncio.to_thread(
+            np.save, note.embeddings_fp, np.asarray(embeddings, dtype=np.float32)
+        )
+        self.save_state(note, Note.EMBEDDED)
+
+    def _insert(
+        self, note: Note, chunks: dict[str, str], embeddings: list
+    ) -> tuple[list[str], list[int]]:
+        """
+        Insert a note's chunks in the vector store.
+
+        Chunks that are already stored are skipped, so a resumed note does not
+        store its chunks twice.
+
+        Returns
+        -------
+        tuple[list[str], list[int]]
+            The hashes and vector ids of the inserted chunks.
+        """
+        hashes, texts = list(chunks), list(chunks.values())
+        missing = set(self.dedup.missing(hashes))
+        rows = [i for i, h in enumerate(hashes) if h in missing]
+        if not rows:
+            return [], []
+
+        ids = self.vector_store.insert_many(
+            [texts[i] for i in rows],
+            [embeddings[i] for i in rows],
+            note_id=note.id,
+            subject_id=note.metadata.get("subject_id"),
+        )
+        return [hashes[i] for i in rows], list(ids)
+
+    async def _saved(self, hashes: list[str], ids: list[int]) -> None:
+        """
+        Wait until inserted chunks are saved.
+
+        Saves are shared by the notes stored within ``save_interval`` of each
+        other, so the vector store is not rewritten for every note.
+        """
+        if not hashes:
+            return
+        self._unsaved.append((hashes, ids))
+        if self._save is None:
+            self._save = asyncio.create_task(self._save_later())
+        await asyncio.shield(self._save)
+
+    async def _save_later(self) -> None:
+        await asyncio.sleep(self.save_interval)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Save the vector store, and record the chunks inserted since the last
+        save as stored. If the save fails, they are deleted.
+        """
+        # Chunks inserted from now on wait for the next save
+        self._save = None
+        batch, self._unsaved = self._unsaved, []
+        if not batch:
+            return
+
+        def save():
+            hashes = [h for batch_hashes, _ in batch for h in batch_hashes]
+            try:
+                self.vector_store.save()
+            except Exception:
+                self.vector_store.delete_many([i for _, ids in batch for i in ids])
+                raise
+            self.dedup.add_many(hashes, DedupIndex.CHUNK)
+
+        await asyncio.to_thread(save)
+
+    async def _store_chunks(
+        self, note: Note, chunks: dict[str, str], embeddings: list
+    ) -> None:
+        """
+        Store chunks claimed by a note, and release them once saved.
+        """
+        try:
+            inserted = await asyncio.to_thread(self._insert, note, chunks, embeddings)
+            await self._saved(*inserted)
+        finally:
+            self._release(note, list(chunks))
+
+    async def store(self, note: Note) -> None:
+        data = json.loads(await asyncio.to_thread(note.chunks_fp.read_text))
+        embeddings = []
+        if data["chunks"]:
+            embeddings = (await asyncio.to_thread(np.load, note.embeddings_fp)).tolist()
+        inserted = await asyncio.to_thread(
+            self._insert, note, data["chunks"], embeddings
+        )
+
+        # Wait for the save, and for the notes storing the shared chunks,
+        # without holding up this stage, which those notes may still have to
+        # go through
+        task = asyncio.create_task(self._finish_later(note, data, inserted))
+        self._finishing.add(task)
+        task.add_done_callback(self._finishing.discard)
+
+    async def _finish_later(self, note: Note, data: dict, inserted: tuple) -> None:
+        try:
+            await self.finish(note, data, inserted)
+        except Exception as e:
+            try:
+                self.fail(note, e)
+            except Exception as fail_error:
+                print(f"Failed to mark note {note.id} as failed: {fail_error}")
+
+    async def finish(self, note: Note, data: dict, inserted: tuple) -> None:
+        """
+        Mark a note as stored once its chunks are saved.
+
+        The shared chunks that the notes which claimed them failed to store
+        are stored first.
+        """
+        try:
+            await self._saved(*inserted)
+        finally:
+            self._release(note, list(data["chunks"]))
+
+        shared = data.get("shared", {})
+        claimed = await self._wait_for(note, list(shared))
+        if claimed:
+            texts = [shared[h] for h in claimed]
+            embeddings = await self.embedder.aembed(texts)
+            await self._store_chunks(note, dict(zip(claimed, texts)), embeddings)
+
+        await asyncio.to_thread(
+            self.dedup.add_many, [data["document"]], DedupIndex.DOCUMENT
+        )
+
+        self.save_state(note, Note.STORED)
+        note.chunks_fp.unlink()
+        note.embeddings_fp.unlink(missing_ok=True)
@@ -0,0 +1,216 @@
+"""
+scraibe/jobs.py
+
+Background jobs for long-running agent requests
+"""
+
+import asyncio
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from uuid import uuid4
+
+
+class Job:
+    """
+    A unit of background work and its progress.
+
+    ``results`` holds partial results by name (e.g. by table) as they are
+    reported, so clients can poll them before the job is done, or subscribe()
+    to them.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, kind: str, key: str, total: Optional[int] = None):
+        self.id = str(uuid4())
+        self.kind = kind
+        self.key = key
+        self.status = Job.PENDING
+        self.total = total
+        self.results = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task: Optional[asyncio.Task] = None
+
+        # Queues of the subscribers' results, and None once the job finished
+        self._subscribers: list[asyncio.Queue] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (Job.DONE, Job.FAILED)
+
+    def report(self, name: str, result) -> None:
+        """
+        Record a partial result.
+        """
+        self.results[name] = result
+        for queue in self._subscribers:
+            queue.put_nowait((name, result))
+
+    def _finish(self) -> None:
+        self.finished_at = time.time()
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+
+    async def subscribe(self) -> AsyncIterator[tuple[str, object]]:
+        """
+        Iterate over the partial results: those already reported, then each
+        new one as it is reported, until the job is finished.
+
+        Yields
+        ------
+        tuple[str, object]
+            The name and partial result.
+
+        Raises
+        ------
+        RuntimeError
+            If the job failed.
+        """
+
+        reported = list(self.results.items())
+        queue = asyncio.Queue()
+        if not self.finished:
+            self._subscribers.append(queue)
+        else:
+            queue.put_nowait(None)
+
+        try:
+            for item in reported:
+                yield item
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            if queue in self._subscribers:
+                self._subscribers.remove(queue)
+
+        if self.status == Job.FAILED:
+            raise RuntimeError(self.error)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {"done": len(self.results), "total": self.total},
+            "results": self.results,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs jobs as tasks on the event loop, off the request path.
+
+    Jobs with the same key are deduplicated: while a job is pending, running
+    or done, submitting the same key returns that job instead of starting a
+    new one. Failed jobs, including cancelled ones, are not reused, so they
+    can be retried.
+
+    Jobs are kept in memory, so each server process has its own jobs.
+    """
+
+    def __init__(self, concurrency: int = 2, max_jobs: int = 1000):
+        """
+        Parameters
+        ----------
+        concurrency : int
+            Maximum number of jobs running at once. Other jobs wait as pending.
+        max_jobs : int
+            Maximum number of jobs to remember. The oldest finished jobs are
+            forgotten first.
+        """
+        self.concurrency = concurrency
+        self.max_jobs = max_jobs
+        self.jobs: dict[str, Job] = {}
+        self.by_key: dict[str, Job] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def submit(
+        self,
+        kind: str,
+        key: str,
+        func: Callable[[Job], Awaitable],
+        total: Optional[int] = None,
+    ) -> Job:
+        """
+        Submit a job, or get the existing job with the same key.
+
+        Must be called from a running event loop.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of job, e.g. "analysis".
+        key : str
+            Identifies the job's inputs, for deduplication.
+        func : Callable[[Job], Awaitable]
+            Coroutine function doing the work. It is passed the job to report
+            partial results on, and its return value is the job's result.
+        total : int, optional
+            Expected number of partial results, for progress.
+
+        Returns
+        -------
+        Job
+            The job.
+        """
+
+        job = self.by_key.get(key)
+        if job is not None and job.status != Job.FAILED:
+            return job
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        job = Job(kind, key, total)
+        self.jobs[job.id] = job
+        self.by_key[key] = job
+        job.task = asyncio.create_task(self._run(job, func))
+
+        self._forget_old_jobs()
+        return job
+
+    async def _run(self, job: Job, func: Callable[[Job], Awaitable]) -> None:
+        try:
+            async with self._semaphore:
+                job.status = Job.RUNNING
+                job.result = await func(job)
+                job.status = Job.DONE
+        except asyncio.CancelledError:
+            # Failed, so the key can be submitted again
+            job.error = "cancelled"
+            job.status = Job.FAILED
+            raise
+        except Exception as e:
+            job.error = str(e)
+            job.status = Job.FAILED
+        finally:
+            job._finish()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Get a job by id.
+        """
+        return self.jobs.get(job_id)
+
+    def _forget_old_jobs(self) -> None:
+        if len(self.jobs) <= self.max_jobs:
+            return
+
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished),
+            key=lambda job: job.finished_at,
+        )
+        for job in finished[: len(self.jobs) - self.max_jobs]:
+            del self.jobs[job.id]
+            if self.by_key.get(job.key) is job:
+                del self.by_key[job.key]
@@ -0,0 +1,359 @@
+"""
+scraibe/numpy_store.py
+
+In-process vector store on a NumPy matrix
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from scraibe.store import BaseVectorStore, Match
+
+METADATA = ("note_id", "subject_id")
+METRICS = ("l2", "cosine", "dot")
+
+
+class NumpyVectorStore(BaseVectorStore):
+    """
+    Vectors in a contiguous float32 matrix in memory.
+
+    A search compares the query with every vector in one matrix product and
+    selects the top ``limit`` with argpartition, so results are exact, and
+    many queries are searched with a single product. ``metric`` is "l2" (the
+    squared L2 distance, as in the SQL store), "cosine" or "dot".
+
+    The vectors are saved to ``path`` by save() and loaded from it on
+    creation. A loaded matrix is memory-mapped, and copied into memory on the
+    first change. Only one process should save to a path; other processes
+    can refresh() to load its saves.
+    """
+
+    def __init__(
+        self, path: Optional[Path] = None, metric: str = "l2", mmap: bool = True
+    ):
+        """
+        Parameters
+        ----------
+        path : Path, optional
+            The directory to save the vectors in. None to keep them in memory.
+        metric : str
+            "l2", "cosine" or "dot".
+        mmap : bool
+            Memory-map the saved matrix instead of reading it.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        self.path = path
+        self.metric = metric
+        self.mmap = mmap
+        self._lock = threading.RLock()
+
+        # When the loaded or saved vectors were last written
+        self._mtime: Optional[int] = None
+
+        self.ids = np.empty(0, dtype=np.int64)
+        self.texts: list[str] = []
+        self.metadata = {name: np.empty(0, dtype=object) for name in METADATA}
+        self._next_id = 1
+
+        # Rows past len(self.ids) are spare capacity
+        self._matrix: Optional[np.ndarray] = None
+        self._sq_norms = np.empty(0, dtype=np.float32)
+
+        if path is not None and path.joinpath("vectors.json").exists():
+            self._load(mmap)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._matrix[: len(self.ids)]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _reserve(self, rows: int, dim: int) -> None:
+        """
+        Make the matrix writable, with room for at least ``rows`` rows.
+        """
+        if self._matrix is not None and self._matrix.shape[1] != dim:
+            raise ValueError(
+                f"Expected embeddings of size {self._matrix.shape[1]}, got {dim}"
+            )
+
+        capacity = 0 if self._matrix is None else len(self._matrix)
+        writable = self._matrix is not None and self._matrix.flags.writeable
+        if writable and capacity >= rows:
+            return
+
+        if capacity < rows:
+            capacity = max(rows, 2 * capacity, 1024)
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        if self._matrix is not None:
+            matrix[: len(self.ids)] = self.embeddings
+        self._matrix = matrix
+
+    def _rows(self, vector_ids) -> np.ndarray:
+        return np.flatnonzero(np.isin(self.ids, vector_ids))
+
+    def insert_many(self, texts, embeddings, ids=None, **metadata):
+        """
+        Insert many vectors.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts.
+        embeddings : list[list[float]]
+            The embedding of each text.
+        ids : list[int], optional
+            The id of each vector. Defaults to new ids.
+        **metadata
+            Column values for every vector, e.g. note_id and subject_id.
+
+        Returns
+        -------
+        list[int]
+            The ids of the vectors.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+
+        with self._lock:
+            if ids is None:
+                ids = range(self._next_id, self._next_id + len(vectors))
+            ids = np.asarray(ids, dtype=np.int64)
+            self._next_id = max(self._next_id, int(ids.max()) + 1)
+
+            n = len(self.ids)
+            self._reserve(n + len(vectors), vectors.shape[1])
+            self._matrix[n : n + len(vectors)] = vectors
+            self._sq_norms = np.concatenate(
+                [self._sq_norms, np.einsum("ij,ij->i", vectors, vectors)]
+            )
+
+            self.ids = np.concatenate([self.ids, ids])
+            self.texts.extend(texts)
+            for name in METADATA:
+                values = np.empty(len(vectors), dtype=object)
+                values[:] = metadata.get(name)
+                self.metadata[name] = np.concatenate([self.metadata[name], values])
+
+        return ids.tolist()
+
+    def upsert_many(self, vector_ids, texts, embeddings):
+        """
+        Insert or update many vectors.
+
+        Parameters
+        ----------
+        vector_ids : list[int]
+            The ids of the vectors.
+        texts : list[str]
+            The texts.
+        embeddings : list[list[float]]
+            The embedding of each text.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            rows = {vector_id: row for row, vector_id in enumerate(self.ids.tolist())}
+            new = [i for i, vector_id in enumerate(vector_ids) if vector_id not in rows]
+            existing = [
+                i for i, vector_id in enumerate(vector_ids) if vector_id in rows
+            ]
+
+            if existing:
+                self._reserve(len(self.ids), vectors.shape[1])
+                targets = np.array([rows[vector_ids[i]] for i in existing])
+                self._matrix[targets] = vectors[existing]
+                self._sq_norms[targets] = np.einsum(
+                    "ij,ij->i", vectors[existing], vectors[existing]
+                )
+                for i, target in zip(existing, targets):
+                    self.texts[target] = texts[i]
+
+            if new:
+                self.insert_many(
+                    [texts[i] for i in new],
+                    vectors[new],
+                    ids=[vector_ids[i] for i in new],
+                )
+
+    def update_embedding(self, vector_id, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            rows = self._rows([vector_id])
+            if len(rows) == 0:
+                return
+            self._reserve(len(self.ids), len(vector))
+            self._matrix[rows[0]] = vector
+            self._sq_norms[rows[0]] = vector @ vector
+
+    def delete_many(self, vector_ids):
+        with self._lock:
+            keep = ~np.isin(self.ids, list(vector_ids))
+            if keep.all():
+                return
+
+            # Copy to a new matrix, as searches may still be reading the old one
+            n = int(keep.sum())
+            embeddings = self.embeddings[keep]
+            self._matrix = None
+            self._reserve(n, embeddings.shape[1])
+            self._matrix[:n] = embeddings
+            self._sq_norms = self._sq_norms[keep]
+            self.ids = self.ids[keep]
+            self.texts = [text for text, k in zip(self.texts, keep) if k]
+            for name in METADATA:
+                self.metadata[name] = self.metadata[name][keep]
+
+    def select_nearest(
+        self, embedding, limit=1, filter=None, exact=False, ef=None, **filters
+    ):
+        """
+        Find the nearest vectors to an embedding.
+
+        Searches are always exact, so ``exact`` and ``ef`` have no effect.
+        SQLAlchemy ``filter`` expressions are not supported.
+        """
+        if filter is not None:
+            raise TypeError("filter expressions are only supported by VectorStore")
+        return self.search_many([embedding], limit, **filters)[0]
+
+    def search_many(self, embeddings, limit=1, exact=False, **filters):
+        queries = np.asarray(embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis]
+
+        with self._lock:
+            matrix, sq_norms = self.embeddings, self._sq_norms
+            rows = np.arange(len(self.ids))
+            if filters:
+                mask = np.ones(len(rows), dtype=bool)
+                for name, value in filters.items():
+                    mask &= self.metadata[name] == value
+                rows = np.flatnonzero(mask)
+                matrix, sq_norms = matrix[rows], sq_norms[rows]
+            ids, texts = self.ids, self.texts
+
+        k = min(limit, len(rows))
+        if k == 0:
+            return [[] for _ in queries]
+
+        scores = queries @ matrix.T
+        if self.metric == "dot":
+            distances = -scores
+        elif self.metric == "cosine":
+            norms = np.sqrt(sq_norms) * np.linalg.norm(queries, axis=1)[:, np.newaxis]
+            distances = 1 - scores / np.maximum(norms, np.finfo(np.float32).tiny)
+        else:
+            q_sq_norms = np.einsum("ij,ij->i", queries, queries)[:, np.newaxis]
+            distances = np.maximum(q_sq_norms - 2 * scores + sq_norms, 0)
+
+        # Select the top k of each query without sorting, then sort only those
+        if k < len(rows):
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(len(rows)), (len(queries), k))
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_distances = np.take_along_axis(top_distances, order, axis=1)
+
+        return [
+            [
+                Match(int(ids[rows[j]]), texts[rows[j]], float(distance))
+                for j, distance in zip(query_top, query_distances)
+            ]
+            for query_top, query_distances in zip(top, top_distances)
+        ]
+
+    def save(self):
+        """
+        Save the vectors to ``path``.
+        """
+        if self.path is None:
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            data = {
+                "metric": self.metric,
+                "next_id": self._next_id,
+                "ids": self.ids.tolist(),
+                "texts": self.texts,
+                "metadata": {
+                    name: values.tolist() for name, values in self.metadata.items()
+                },
+            }
+
+            # Each save writes a new matrix file named in vectors.json, so a
+            # reader always loads the ids and vectors of the same save
+            embeddings_fp = self.path.joinpath(f"embeddings-{time.time_ns()}.npy")
+            data["embeddings"] = embeddings_fp.name
+            np.save(embeddings_fp, self.embeddings)
+            data_fp = self.path.joinpath("vectors.json")
+            data_tmp_fp = self.path.joinpath("vectors.tmp.json")
+            data_tmp_fp.write_text(json.dumps(data))
+            os.replace(data_tmp_fp, data_fp)
+            self._mtime = data_fp.stat().st_mtime_ns
+
+            for fp in self.path.glob("embeddings*.npy"):
+                if fp != embeddings_fp:
+                    fp.unlink(missing_ok=True)
+
+    def refresh(self):
+        """
+        Load the vectors again if another process saved them since.
+        """
+        if self.path is None:
+            return
+        try:
+            mtime = self.path.joinpath("vectors.json").stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            with self._lock:
+                self._load(self.mmap)
+
+    def _load(self, mmap: bool) -> None:
+        data_fp = self.path.joinpath("vectors.json")
+        mtime = data_fp.stat().st_mtime_ns
+        data = json.loads(data_fp.read_text())
+        try:
+            matrix = np.load(
+                self.path.joinpath(data.get("embeddings", "embeddings.npy")),
+                mmap_mode="r" if mmap else None,
+            )
+        except FileNotFoundError:
+            # Replaced by a save since vectors.json was read
+            return self._load(mmap)
+        if data["metric"] != self.metric:
+            raise ValueError(
+                f"The vectors in {self.path} were saved with the "
+                f"{data['metric']} metric, not {self.metric}"
+            )
+        self._mtime = mtime
+
+        self._next_id = data["next_id"]
+        self.ids = np.asarray(data["ids"], dtype=np.int64)
+        self.texts = data["texts"]
+        for name in METADATA:
+            values = np.empty(len(self.ids), dtype=object)
+            values[:] = data["metadata"][name]
+            self.metadata[name] = values
+
+        if len(self.ids):
+            self._matrix = matrix[: len(self.ids)]
+            self._sq_norms = np.einsum("ij,ij->i", self._matrix, self._matrix)
+        else:
+            self._matrix = None
+            self._sq_norms = np.empty(0, dtype=np.float32)
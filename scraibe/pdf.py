@@ -1,20 +1,64 @@
 """scraibe.pdf.py"""
 
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from fitz import fitz
 
 
-def pdf_to_txt(pdf_fp: Path, txt_fp: Path) -> Path:
+def page_count(pdf_fp: Path) -> int:
+    """
+    Count the pages of a PDF file.
+    """
+
+    with fitz.open(pdf_fp) as doc:
+        return doc.page_count
+
+
+def extract_pages(pdf_fp: Path, start: int, stop: int) -> str:
+    """
+    Extract the text of a range of pages of a PDF file.
+
+    Parameters
+    ----------
+    pdf_fp : Path
+        The filepath to the PDF file.
+    start : int
+        The first page.
+    stop : int
+        The page after the last page.
+
+    Returns
+    -------
+    str
+        The text of the pages.
+    """
+
+    with fitz.open(pdf_fp) as doc:
+        return "".join(doc[i].get_text() for i in range(start, stop))
+
+
+def pdf_to_txt(
+    pdf_fp: Path, txt_fp: Path, workers: int = 1, pages_per_worker: int = 50
+) -> Path:
     """
     Convert a PDF file to a text file.
 
+    The text of each page is written to the file as soon as it is extracted.
+    Documents with more than ``pages_per_worker`` pages can be split into
+    ranges of pages extracted in parallel processes.
+
     Parameters
     ----------
     pdf_fp : Path
         The filepath to the PDF file.
     txt_fp : Path
         The filepath to the text file.
+    workers : int
+        Number of processes to extract large documents with.
+    pages_per_worker : int
+        Number of pages each process extracts at a time.
 
     Returns
     -------
@@ -22,15 +66,33 @@ def pdf_to_txt(pdf_fp: Path, txt_fp: Path) -> Path:
         The filepath to the text file.
     """
 
-    # Open the PDF file
-    with fitz.open(pdf_fp) as doc:
-        # Convert the PDF file to a text file
-        text = ""
-        for page in doc:
-            text += page.get_text()
-
-    # Save the text file with UTF-8 encoding
-    with txt_fp.open("w", encoding="utf-8") as buffer:  # Specify encoding here
-        buffer.write(text)
+    # Write to a temporary file, so the text file is never partially written
+    tmp_fp = txt_fp.with_suffix(".txt.tmp")
+
+    try:
+        # Save the text file with UTF-8 encoding
+        with fitz.open(pdf_fp) as doc, tmp_fp.open("w", encoding="utf-8") as buffer:
+            if workers <= 1 or doc.page_count <= pages_per_worker:
+                for page in doc:
+                    buffer.write(page.get_text())
+            else:
+                starts = range(0, doc.page_count, pages_per_worker)
+                stops = [
+                    min(start + pages_per_worker, doc.page_count) for start in starts
+                ]
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    # Ranges are written in order as they are extracted
+                    for text in executor.map(
+                        extract_pages, [pdf_fp] * len(starts), starts, stops
+                    ):
+                        buffer.write(text)
+
+            buffer.flush()
+            os.fsync(buffer.fileno())
+
+        os.replace(tmp_fp, txt_fp)
+    except BaseException:
+        tmp_fp.unlink(missing_ok=True)
+        raise
 
     return txt_fp
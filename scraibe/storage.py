@@ -0,0 +1,271 @@
+"""
+scraibe/storage.py
+
+Parquet storage for the MIMIC tables
+"""
+
+import csv
+import gzip
+import re
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from config import PROJECT_DIR
+
+SCHEMA_FP = PROJECT_DIR.joinpath("db", "mimic.sql")
+
+# Arrow types for the column types used in db/mimic.sql
+SQL_TYPES = {
+    "TINYINT": pa.int8(),
+    "SMALLINT": pa.int16(),
+    "MEDIUMINT": pa.int32(),
+    "INT": pa.int32(),
+    "BIGINT": pa.int64(),
+    "FLOAT": pa.float64(),
+    "DOUBLE": pa.float64(),
+    "DATETIME": pa.timestamp("s"),
+    "VARCHAR": pa.string(),
+    "TEXT": pa.string(),
+}
+
+# Types of the identifier columns shared by all tables, including tables that
+# are not described in db/mimic.sql
+ID_TYPES = {
+    "subject_id": pa.int32(),
+    "hadm_id": pa.int32(),
+    "stay_id": pa.int32(),
+}
+
+
+def load_schema(sql_fp: Path = SCHEMA_FP) -> dict[str, dict[str, pa.DataType]]:
+    """
+    Parse the CREATE TABLE statements of a SQL file into Arrow column types.
+
+    Parameters
+    ----------
+    sql_fp : Path
+        The filepath to the SQL file.
+
+    Returns
+    -------
+    dict[str, dict[str, pa.DataType]]
+        The Arrow type of each column, by table name.
+    """
+
+    schema = {}
+    sql = sql_fp.read_text()
+
+    for table, body in re.findall(r"CREATE TABLE (\w+)\s*\((.*?)\);", sql, re.S):
+        columns = {}
+        for line in body.splitlines():
+            line = line.split("--")[0].strip()
+            match = re.match(r"(\w+)\s+([A-Z]+)", line)
+            if match and match.group(2) in SQL_TYPES:
+                columns[match.group(1)] = SQL_TYPES[match.group(2)]
+        schema[table] = columns
+
+    return schema
+
+
+def csv_to_parquet(
+    csv_fp: Path,
+    parquet_fp: Path,
+    column_types: Optional[dict[str, pa.DataType]] = None,
+    block_size: int = 1 << 20,
+) -> Path:
+    """
+    Convert a CSV file to a Parquet file.
+
+    The CSV file is streamed in blocks of ``block_size`` bytes and each block
+    is written as its own row group, so memory use does not depend on the size
+    of the file and readers can skip row groups using their statistics.
+
+    Parameters
+    ----------
+    csv_fp : Path
+        The filepath to the CSV file, decompressed on the fly if it ends with
+        .gz.
+    parquet_fp : Path
+        The filepath to the Parquet file.
+    column_types : dict[str, pa.DataType], optional
+        The Arrow type of each column. Identifier columns default to ID_TYPES
+        and any other column without a type is read as text.
+    block_size : int
+        Number of bytes of CSV to read at a time.
+
+    Returns
+    -------
+    Path
+        The filepath to the Parquet file.
+    """
+
+    column_types = {**ID_TYPES, **(column_types or {})}
+
+    opener = gzip.open if csv_fp.suffix == ".gz" else open
+    with opener(csv_fp, "rt", newline="", encoding="utf-8") as f:
+        names = next(csv.reader(f), [])
+
+    reader = pacsv.open_csv(
+        csv_fp,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: column_types.get(name, pa.string()) for name in names},
+            strings_can_be_null=True,
+        ),
+    )
+
+    # Write to a temporary file so a failed conversion never leaves a partial file
+    tmp_fp = parquet_fp.with_suffix(".tmp")
+    with pq.ParquetWriter(tmp_fp, reader.schema) as writer:
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch]))
+    tmp_fp.replace(parquet_fp)
+
+    return parquet_fp
+
+
+def cache_table(csv_fp: Path, schema: Optional[dict] = None) -> Path:
+    """
+    Get the Parquet copy of a CSV file, converting it if it is missing or stale.
+
+    The Parquet file is stored next to the CSV file.
+
+    Parameters
+    ----------
+    csv_fp : Path
+        The filepath to the CSV file.
+    schema : dict, optional
+        Column types by table name, as returned by load_schema().
+
+    Returns
+    -------
+    Path
+        The filepath to the Parquet file.
+    """
+
+    parquet_fp = csv_fp.with_suffix(".parquet")
+    if parquet_fp.exists() and parquet_fp.stat().st_mtime >= csv_fp.stat().st_mtime:
+        return parquet_fp
+
+    if schema is None:
+        schema = load_schema()
+
+    print(f"Caching {csv_fp.name} as Parquet")
+    return csv_to_parquet(csv_fp, parquet_fp, schema.get(csv_fp.stem))
+
+
+def read_table(
+    fp: Path,
+    columns: Optional[list[str]] = None,
+    subject_ids: Optional[Iterable[int]] = None,
+) -> pa.Table:
+    """
+    Read a Parquet file.
+
+    Parameters
+    ----------
+    fp : Path
+        The filepath to the Parquet file.
+    columns : list[str], optional
+        Only read these columns.
+    subject_ids : Iterable[int], optional
+        Only read rows of these subjects. Row groups without any of them are
+        skipped. Ignored if the table has no subject_id column.
+
+    Returns
+    -------
+    pa.Table
+        The table.
+    """
+
+    filters = None
+    if subject_ids is not None and "subject_id" in pq.read_schema(fp).names:
+        filters = [("subject_id", "in", [int(sid) for sid in subject_ids])]
+
+    return pq.read_table(fp, columns=columns, filters=filters)
+
+
+def write_table(table: pa.Table, fp: Path) -> Path:
+    """
+    Write a table to a Parquet file.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The table to write.
+    fp : Path
+        The filepath to the Parquet file.
+
+    Returns
+    -------
+    Path
+        The filepath to the Parquet file.
+    """
+
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, fp)
+    return fp
+
+
+def to_csv(table: pa.Table) -> bytes:
+    """
+    Serialize a table to CSV.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The table to serialize.
+
+    Returns
+    -------
+    bytes
+        The table as CSV, with a header row and no index column.
+    """
+
+    sink = pa.BufferOutputStream()
+    pacsv.write_csv(table, sink)
+    return sink.getvalue().to_pybytes()
+
+
+def partition_by_subject(
+    table: pa.Table, subject_ids: Iterable[int]
+) -> dict[int, pa.Table]:
+    """
+    Split a table into one table per subject.
+
+    The table is sorted by subject_id once and each subject's rows are sliced
+    out of it, so the cost does not grow with the number of subjects.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The table to split. Must have a subject_id column.
+    subject_ids : Iterable[int]
+        The subjects to split the table for.
+
+    Returns
+    -------
+    dict[int, pa.Table]
+        The rows of each subject. Subjects without rows get an empty table.
+    """
+
+    ids = table["subject_id"].to_numpy()
+    order = np.argsort(ids, kind="stable")
+    table = table.take(order)
+    ids = ids[order]
+
+    unique, starts = np.unique(ids, return_index=True)
+    ends = np.append(starts[1:], len(ids))
+    bounds = {int(sid): (start, end) for sid, start, end in zip(unique, starts, ends)}
+
+    partitions = {}
+    for subject_id in subject_ids:
+        start, end = bounds.get(int(subject_id), (0, 0))
+        partitions[subject_id] = table.slice(start, end - start)
+
+    return partitions
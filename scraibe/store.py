@@ -5,18 +5,85 @@ Lantern wrapper
 """
 
 import os
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+from urllib.parse import parse_qsl
 
-from sqlalchemy import create_engine, Column, Integer, String, ARRAY, Float, func
+import numpy as np
+from sqlalchemy import (
+    create_engine,
+    Column,
+    Integer,
+    LargeBinary,
+    String,
+    ARRAY,
+    REAL,
+    TypeDecorator,
+    bindparam,
+    delete,
+    func,
+    insert,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from config import DATA_DIR
+
 Base = declarative_base()
 
 
 VECTOR_STORE_URL = os.getenv("VECTOR_STORE_URL")
+VECTOR_STORE_DIR = DATA_DIR.joinpath("vectors")
+
+
+@lru_cache
+def get_engine(url: str = None):
+    """
+    Get the engine of a database, creating it on first use.
+    """
+    return create_engine(url or VECTOR_STORE_URL)
+
+
+class Embedding(TypeDecorator):
+    """
+    Embedding column type, with values as lists of floats.
+
+    Postgres stores embeddings as real[] (float32) arrays, the type Lantern
+    indexes. Other databases store them as packed little-endian bytes of
+    ``dtype``, float32 or float16.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, dtype: str = "float32"):
+        super().__init__()
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(ARRAY(REAL))
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == "postgresql":
+            return np.asarray(value, dtype=np.float32).tolist()
+        return np.asarray(value, dtype=self.dtype).tobytes()
 
-engine = create_engine(VECTOR_STORE_URL)
-Session = sessionmaker(bind=engine)
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == "postgresql":
+            return list(value)
+        return np.frombuffer(value, dtype=self.dtype).astype(np.float32).tolist()
 
 
 class Vector(Base):
@@ -24,47 +91,426 @@ class Vector(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     text = Column(String, nullable=False)
-    embedding = Column(ARRAY(Float))
+    embedding = Column(Embedding())
+    note_id = Column(String, index=True)
+    subject_id = Column(Integer, index=True)
 
 
-class VectorStore:
-    def __init__(self, session=Session()):
-        self.session = session
+class Match(NamedTuple):
+    id: int
+    text: str
+    distance: float
 
-    def create_table(self):
-        Base.metadata.create_all(engine)
+
+class BaseVectorStore(ABC):
+    """
+    Interface of the vector store backends.
+
+    Searches return Match-like rows with the id, text and distance of the
+    nearest vectors, nearest first. Vectors can have note_id and subject_id
+    metadata, and searches can filter on them.
+    """
+
+    @abstractmethod
+    def insert_many(self, texts, embeddings, **metadata):
+        raise NotImplementedError
+
+    @abstractmethod
+    def upsert_many(self, vector_ids, texts, embeddings):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_many(self, vector_ids):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_embedding(self, vector_id, embedding):
+        raise NotImplementedError
 
     def insert_vector(self, text, embedding):
-        vector = Vector(text=text, embedding=embedding)
-        self.session.add(vector)
-        self.session.commit()
+        return self.insert_many([text], [embedding])[0]
 
     def upsert_vector(self, vector_id, text, embedding):
-        vector = self.session.query(Vector).filter_by(id=vector_id).first()
-        if vector:
-            vector.text = text
-            vector.embedding = embedding
-        else:
-            new_vector = Vector(id=vector_id, text=text, embedding=embedding)
-            self.session.add(new_vector)
-        self.session.commit()
+        self.upsert_many([vector_id], [text], [embedding])
+
+    def delete_vector(self, vector_id):
+        self.delete_many([vector_id])
+
+    @abstractmethod
+    def select_nearest(
+        self, embedding, limit=1, filter=None, exact=False, ef=None, **filters
+    ):
+        raise NotImplementedError
+
+    def search_many(self, embeddings, limit=1, exact=False, **filters):
+        """
+        Find the nearest vectors to each of many embeddings.
+
+        Parameters
+        ----------
+        embeddings : list[list[float]]
+            The embeddings to search for.
+        limit : int
+            Number of vectors to return per embedding.
+        exact : bool
+            Compare with every vector instead of searching an index.
+        **filters
+            Column values the vectors must have.
+
+        Returns
+        -------
+        list[list[Match]]
+            The nearest vectors to each embedding.
+        """
+        return [
+            self.select_nearest(embedding, limit, exact=exact, **filters)
+            for embedding in embeddings
+        ]
+
+    def save(self):
+        """
+        Persist the vectors, for backends that do not write through.
+        """
+
+    def refresh(self):
+        """
+        Load the vectors saved by another process, for backends that do not
+        write through.
+        """
+
+    def recall(self, embeddings, limit=10, ef=None, **filters) -> float:
+        """
+        Measure the recall of index searches against exact searches.
+
+        Parameters
+        ----------
+        embeddings : list[list[float]]
+            The embeddings to search for.
+        limit : int
+            Number of vectors to return per search.
+        ef : int, optional
+            Size of the candidate list, for index backends.
+        **filters
+            Column values the vectors must have.
+
+        Returns
+        -------
+        float
+            Fraction of the exact nearest vectors found by the index.
+        """
+        found = total = 0
+        for embedding in embeddings:
+            approx = self.select_nearest(embedding, limit, ef=ef, **filters)
+            exact = self.select_nearest(embedding, limit, exact=True, **filters)
+            found += len({row.id for row in approx} & {row.id for row in exact})
+            total += len(exact)
+        return found / total if total else 1.0
+
+
+class VectorStore(BaseVectorStore):
+    """
+    Vectors in a Postgres database with the Lantern extension.
+
+    Nearest neighbours are found with Lantern's HNSW index on the squared L2
+    distance, so a search does not scan the table. ``ef`` is the size of the
+    candidate list during a search: higher values find the true nearest
+    neighbours more often, at the cost of speed. ``exact`` searches scan the
+    whole table and are the reference for measuring recall.
+    """
+
+    INDEX_NAME = "vectors_embedding_hnsw"
+
+    def __init__(self, url: str = None, ef: int = 64):
+        """
+        Parameters
+        ----------
+        url : str, optional
+            The database URL. Defaults to VECTOR_STORE_URL.
+        ef : int
+            Default size of the candidate list while searching.
+        """
+        # Each operation runs in its own session and transaction, so a store
+        # can be shared by concurrent requests
+        self.engine = get_engine(url)
+        self.Session = sessionmaker(bind=self.engine)
+        self.ef = ef
+
+    def create_table(self):
+        Base.metadata.create_all(self.engine)
+
+    def migrate(self):
+        """
+        Migrate a vectors table created by earlier versions.
+
+        Converts double precision[] embeddings to real[] in place and adds
+        the metadata columns. The HNSW index is dropped, as it was built on a
+        cast of the old column: run create_index() again afterwards.
+        """
+        if self.engine.dialect.name != "postgresql":
+            return
+
+        with self.Session.begin() as session:
+            session.execute(text(f"DROP INDEX IF EXISTS {self.INDEX_NAME}"))
+            session.execute(
+                text(
+                    "ALTER TABLE vectors ALTER COLUMN embedding "
+                    "TYPE real[] USING embedding::real[]"
+                )
+            )
+            session.execute(
+                text("ALTER TABLE vectors ADD COLUMN IF NOT EXISTS note_id VARCHAR")
+            )
+            session.execute(
+                text("ALTER TABLE vectors ADD COLUMN IF NOT EXISTS subject_id INTEGER")
+            )
+            for column in ("note_id", "subject_id"):
+                session.execute(
+                    text(
+                        f"CREATE INDEX IF NOT EXISTS ix_vectors_{column} "
+                        f"ON vectors ({column})"
+                    )
+                )
+
+    def create_index(
+        self, dim: int = 1536, m: int = 16, ef_construction: int = 128, ef: int = 64
+    ):
+        """
+        Create the HNSW index on the embeddings.
+
+        Parameters
+        ----------
+        dim : int
+            The size of the embeddings.
+        m : int
+            Number of neighbours of each node in the graph.
+        ef_construction : int
+            Size of the candidate list while building the graph.
+        ef : int
+            Default size of the candidate list while searching.
+        """
+        with self.Session.begin() as session:
+            session.execute(text("CREATE EXTENSION IF NOT EXISTS lantern"))
+            session.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS {self.INDEX_NAME} ON vectors "
+                    f"USING hnsw (embedding dist_l2sq_ops) "
+                    f"WITH (M={int(m)}, ef_construction={int(ef_construction)}, "
+                    f"ef={int(ef)}, dim={int(dim)})"
+                )
+            )
+
+    def insert_many(self, texts, embeddings, **metadata):
+        """
+        Insert many vectors in one transaction.
+
+        Rows are sent in multi-row INSERT statements rather than one
+        statement per row.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts.
+        embeddings : list[list[float]]
+            The embedding of each text.
+        **metadata
+            Column values for every vector, e.g. note_id and subject_id.
+
+        Returns
+        -------
+        list[int]
+            The ids of the vectors.
+        """
+        rows = [
+            {"text": text, "embedding": embedding, **metadata}
+            for text, embedding in zip(texts, embeddings)
+        ]
+        if not rows:
+            return []
+
+        with self.Session.begin() as session:
+            result = session.execute(
+                insert(Vector).returning(Vector.id, sort_by_parameter_order=True),
+                rows,
+            )
+            return result.scalars().all()
+
+    @staticmethod
+    def upsert_statement(dialect: str):
+        """
+        Build an INSERT that updates the text and embedding of existing ids.
+        """
+        insert_fn = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        statement = insert_fn(Vector)
+        return statement.on_conflict_do_update(
+            index_elements=[Vector.id],
+            set_={
+                "text": statement.excluded.text,
+                "embedding": statement.excluded.embedding,
+            },
+        )
+
+    def upsert_many(self, vector_ids, texts, embeddings):
+        """
+        Insert or update many vectors in one transaction.
+
+        Parameters
+        ----------
+        vector_ids : list[int]
+            The ids of the vectors.
+        texts : list[str]
+            The texts.
+        embeddings : list[list[float]]
+            The embedding of each text.
+        """
+        rows = [
+            {"id": vector_id, "text": text, "embedding": embedding}
+            for vector_id, text, embedding in zip(vector_ids, texts, embeddings)
+        ]
+        if not rows:
+            return
+
+        with self.Session.begin() as session:
+            statement = self.upsert_statement(self.engine.dialect.name)
+            session.connection().execute(statement, rows)
 
     def update_embedding(self, vector_id, embedding):
-        vector = self.session.query(Vector).filter_by(id=vector_id).first()
-        if vector:
-            vector.embedding = embedding
-            self.session.commit()
+        with self.Session.begin() as session:
+            session.execute(
+                update(Vector).where(Vector.id == vector_id).values(embedding=embedding)
+            )
 
-    def delete_vector(self, vector_id):
-        vector = self.session.query(Vector).filter_by(id=vector_id).first()
-        if vector:
-            self.session.delete(vector)
-            self.session.commit()
-
-    def select_nearest(self, embedding, limit=1, filter=None):
-        query = self.session.query(Vector.text).order_by(
-            func.abs(func.array_distance(Vector.embedding, embedding))
+    def delete_many(self, vector_ids):
+        """
+        Delete many vectors in one statement.
+
+        Parameters
+        ----------
+        vector_ids : list[int]
+            The ids of the vectors.
+        """
+        with self.Session.begin() as session:
+            session.execute(delete(Vector).where(Vector.id.in_(list(vector_ids))))
+
+    @staticmethod
+    def nearest_query(embedding, limit=1, filter=None, exact=False, **filters):
+        """
+        Build the query for the nearest vectors to an embedding.
+
+        Parameters
+        ----------
+        embedding : list[float]
+            The embedding to search for.
+        limit : int
+            Number of vectors to return.
+        filter : optional
+            SQLAlchemy expression the vectors must match.
+        exact : bool
+            Scan the whole table instead of searching the index.
+        **filters
+            Column values the vectors must have, e.g. subject_id=10000032.
+
+        Returns
+        -------
+        Select
+            Query for the id, text and distance of the vectors, nearest first.
+        """
+        query_embedding = bindparam(
+            "query_embedding", embedding, type_=Vector.embedding.type
         )
-        if filter:
+        distance = func.l2sq_dist(Vector.embedding, query_embedding)
+
+        # Only the operator is served by the index, the function is not
+        order = distance if exact else Vector.embedding.op("<->")(query_embedding)
+
+        query = select(Vector.id, Vector.text, distance.label("distance")).where(
+            *(getattr(Vector, name) == value for name, value in filters.items())
+        )
+        if filter is not None:
             query = query.filter(filter)
-        return query.limit(limit).all()
+        return query.order_by(order).limit(limit)
+
+    def select_nearest(
+        self, embedding, limit=1, filter=None, exact=False, ef=None, **filters
+    ):
+        """
+        Find the nearest vectors to an embedding.
+
+        Parameters
+        ----------
+        embedding : list[float]
+            The embedding to search for.
+        limit : int
+            Number of vectors to return.
+        filter : optional
+            SQLAlchemy expression the vectors must match.
+        exact : bool
+            Scan the whole table instead of searching the index.
+        ef : int, optional
+            Size of the candidate list for this search. Defaults to ``self.ef``.
+        **filters
+            Column values the vectors must have, e.g. subject_id=10000032.
+
+        Returns
+        -------
+        list[Row]
+            The id, text and distance of the vectors, nearest first.
+        """
+        query = self.nearest_query(embedding, limit, filter, exact, **filters)
+        with self.Session.begin() as session:
+            if not exact:
+                ef = max(int(ef or self.ef), limit)
+                session.execute(text(f"SET LOCAL lantern_hnsw.ef = {ef}"))
+            return session.execute(query).all()
+
+
+def _numpy_options(query: str) -> dict:
+    """
+    Parse the options of the NumPy backend from a URL query string.
+    """
+    from scraibe.numpy_store import METRICS
+
+    options = {}
+    for key, value in parse_qsl(query, strict_parsing=bool(query)):
+        if key == "metric":
+            if value not in METRICS:
+                raise ValueError(f"Unknown metric: {value}")
+            options[key] = value
+        elif key == "mmap":
+            if value.lower() not in ("true", "false", "1", "0"):
+                raise ValueError(f"Expected true or false for mmap, got {value}")
+            options[key] = value.lower() in ("true", "1")
+        else:
+            raise ValueError(f"Unknown vector store option: {key}")
+    return options
+
+
+def get_vector_store(url: str = VECTOR_STORE_URL) -> BaseVectorStore:
+    """
+    Get the vector store backend for a URL.
+
+    Parameters
+    ----------
+    url : str
+        A SQLAlchemy database URL, or
+        numpy://<directory>[?metric=<metric>&mmap=<true|false>] for the NumPy
+        backend. Without a URL, the NumPy backend is stored in data/vectors.
+
+    Returns
+    -------
+    BaseVectorStore
+        The vector store.
+
+    Raises
+    ------
+    ValueError
+        If a NumPy backend option is unknown or invalid.
+    """
+    if url is None or url.startswith("numpy://"):
+        from scraibe.numpy_store import NumpyVectorStore
+
+        if not url:
+            return NumpyVectorStore(VECTOR_STORE_DIR)
+        path, _, query = url[len("numpy://") :].partition("?")
+        return NumpyVectorStore(Path(path), **_numpy_options(query))
+
+    return VectorStore(url=url)
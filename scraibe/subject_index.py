@@ -0,0 +1,210 @@
+"""
+scraibe/subject_index.py
+
+subject_id index over the raw MIMIC CSV files
+"""
+
+import csv
+import mmap
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+
+def _record_end(buf, start: int) -> int:
+    """
+    Find the end of the CSV record starting at ``start``.
+
+    A newline only ends a record if it is not inside a quoted field, i.e. if
+    the record so far has an even number of quote characters.
+    """
+    size = len(buf)
+    end = start
+    quotes = 0
+    while True:
+        newline = buf.find(b"\n", end)
+        if newline == -1:
+            return size
+        quotes += buf[end:newline].count(b'"')
+        end = newline + 1
+        if quotes % 2 == 0:
+            return end
+
+
+def _parse_field(record: bytes, column: int) -> str:
+    if b'"' not in record:
+        return record.split(b",", column + 1)[column].strip().decode()
+    return next(csv.reader([record.decode()]))[column]
+
+
+def _parse_subject_id(record: bytes, column: int) -> Optional[int]:
+    try:
+        return int(_parse_field(record, column))
+    except (ValueError, IndexError):
+        return None
+
+
+class SubjectIndex:
+    """
+    Byte ranges of each subject's rows in a CSV file.
+
+    Rows of one subject are usually stored next to each other, so the index
+    keeps one (start, end) range per run of consecutive rows of a subject,
+    sorted by subject_id. Looking up a subject is a binary search, and reading
+    its rows only touches those byte ranges of the memory-mapped file. Rows
+    without an integer subject_id belong to no subject and are not indexed.
+
+    The index is saved next to the CSV file as <table>.idx.npz and rebuilt
+    when the CSV file's size or mtime change.
+    """
+
+    def __init__(
+        self,
+        csv_fp: Path,
+        header_end: int,
+        subject_ids: np.ndarray,
+        starts: np.ndarray,
+        ends: np.ndarray,
+    ):
+        self.csv_fp = csv_fp
+        self.header_end = header_end
+        self.subject_ids = subject_ids
+        self.starts = starts
+        self.ends = ends
+
+    @staticmethod
+    def index_path(csv_fp: Path) -> Path:
+        return csv_fp.with_suffix(".idx.npz")
+
+    @classmethod
+    def build(cls, csv_fp: Path) -> Optional["SubjectIndex"]:
+        """
+        Scan a CSV file once and save its index.
+
+        Parameters
+        ----------
+        csv_fp : Path
+            The filepath to the CSV file.
+
+        Returns
+        -------
+        SubjectIndex, optional
+            The index, or None if the file has no subject_id column.
+        """
+
+        stat = csv_fp.stat()
+        ids, starts, ends = [], [], []
+
+        with csv_fp.open("rb") as f:
+            if stat.st_size == 0:
+                return None
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                header_end = _record_end(buf, 0)
+                header = next(csv.reader([buf[:header_end].decode()]), [])
+                if "subject_id" not in header:
+                    return None
+                column = header.index("subject_id")
+
+                pos = header_end
+                while pos < len(buf):
+                    end = _record_end(buf, pos)
+                    record = buf[pos:end].rstrip(b"\r\n")
+                    subject_id = _parse_subject_id(record, column) if record else None
+                    if subject_id is not None:
+                        if ids and ids[-1] == subject_id and ends[-1] == pos:
+                            ends[-1] = end
+                        else:
+                            ids.append(subject_id)
+                            starts.append(pos)
+                            ends.append(end)
+                    pos = end
+
+        # Sort by subject, keeping each subject's ranges in file order
+        order = np.argsort(np.array(ids, dtype=np.int64), kind="stable")
+        index = cls(
+            csv_fp,
+            header_end,
+            np.array(ids, dtype=np.int64)[order],
+            np.array(starts, dtype=np.int64)[order],
+            np.array(ends, dtype=np.int64)[order],
+        )
+
+        np.savez(
+            cls.index_path(csv_fp),
+            meta=np.array([stat.st_size, stat.st_mtime_ns, header_end], dtype=np.int64),
+            subject_ids=index.subject_ids,
+            starts=index.starts,
+            ends=index.ends,
+        )
+
+        return index
+
+    @classmethod
+    def load(cls, csv_fp: Path) -> Optional["SubjectIndex"]:
+        """
+        Load the index of a CSV file, building it if it is missing or stale.
+
+        Parameters
+        ----------
+        csv_fp : Path
+            The filepath to the CSV file.
+
+        Returns
+        -------
+        SubjectIndex, optional
+            The index, or None if the file has no subject_id column.
+        """
+
+        index_fp = cls.index_path(csv_fp)
+        if index_fp.exists():
+            stat = csv_fp.stat()
+            with np.load(index_fp) as data:
+                size, mtime_ns, header_end = data["meta"].tolist()
+                if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                    return cls(
+                        csv_fp,
+                        header_end,
+                        data["subject_ids"],
+                        data["starts"],
+                        data["ends"],
+                    )
+
+        return cls.build(csv_fp)
+
+    def ranges(self, subject_id: int) -> list[tuple[int, int]]:
+        """
+        Get the byte ranges of a subject's rows, in file order.
+        """
+        lo = np.searchsorted(self.subject_ids, subject_id, side="left")
+        hi = np.searchsorted(self.subject_ids, subject_id, side="right")
+        return list(zip(self.starts[lo:hi].tolist(), self.ends[lo:hi].tolist()))
+
+    def read(self, subject_id: int) -> bytes:
+        """
+        Read the rows of one subject.
+
+        Parameters
+        ----------
+        subject_id : int
+            The subject to read.
+
+        Returns
+        -------
+        bytes
+            The header and the subject's rows, exactly as they are in the file.
+        """
+
+        with self.csv_fp.open("rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as buf:
+            parts = [buf[: self.header_end]]
+            parts.extend(buf[start:end] for start, end in self.ranges(subject_id))
+
+        # The last row of the file may not end with a newline
+        for i, part in enumerate(parts[:-1]):
+            if not part.endswith(b"\n"):
+                parts[i] = part + b"\n"
+
+        return b"".join(parts)
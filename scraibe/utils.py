@@ -1,6 +1,18 @@
 """scraibe.utils.py"""
 
+import hashlib
+import os
+import time
 from pathlib import Path
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    import msvcrt
+
+    fcntl = None
 
 
 def del_dir(dir_path: Path) -> None:
@@ -25,3 +37,103 @@ def del_dir(dir_path: Path) -> None:
 
     # Delete the directory itself
     dir_path.rmdir()
+
+
+def file_digest(fp: Path, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the SHA-256 digest of a file.
+
+    Parameters
+    ----------
+    fp : Path
+        The path to the file.
+    chunk_size : int
+        Number of bytes to read at a time.
+
+    Returns
+    -------
+    str
+        The hex digest of the file's content.
+    """
+    digest = hashlib.sha256()
+    with fp.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lock_file(fd: int, shared: bool = False, blocking: bool = True) -> bool:
+    """
+    Lock an open file against other processes.
+
+    Locks are flock() locks on POSIX. On Windows they lock the file's first
+    byte with msvcrt, which has no shared locks, so shared locks are
+    exclusive there, and the file's first byte cannot be read or written by
+    other processes while it is locked: lock a separate lock file.
+
+    Parameters
+    ----------
+    fd : int
+        The file descriptor of the open file.
+    shared : bool
+        Take a shared lock instead of an exclusive one.
+    blocking : bool
+        Wait for the lock if another process holds it.
+
+    Returns
+    -------
+    bool
+        Whether the lock was taken. Always True when blocking.
+    """
+    if fcntl is not None:
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, operation if blocking else operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    while True:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(0.01)
+
+
+def unlock_file(fd: int) -> None:
+    """
+    Release the lock taken on an open file by lock_file().
+    """
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def try_lock(fp: Path) -> Optional[int]:
+    """
+    Take an exclusive lock on a file, without waiting.
+
+    The lock is held until the returned file descriptor is closed, or the
+    process exits.
+
+    Parameters
+    ----------
+    fp : Path
+        The path to the lock file. It is created if it does not exist.
+
+    Returns
+    -------
+    int | None
+        The file descriptor of the lock, or None if another process holds it.
+    """
+    fd = os.open(fp, os.O_RDWR | os.O_CREAT, 0o644)
+    if not lock_file(fd, blocking=False):
+        os.close(fd)
+        return None
+    return fd
@@ -1,10 +1,89 @@
 """tests/test_agent.py"""
 
 import asyncio
+import csv
+import sqlite3
 
+import openai
+import pytest
 from codeinterpreterapi import File
 
-from scraibe.agent import analyze_data
+import scraibe.agent
+from scraibe import SUBJECT_ID
+from scraibe.cache import ResultCache
+from scraibe.embed import count_tokens
+from scraibe.agent import (
+    analyze_data,
+    export_table,
+    get_data,
+    iter_analysis,
+    load_files,
+    pack_texts,
+    prepare_data,
+    summarize_report,
+)
+
+TABLES = [
+    "d_hcpcs",
+    "d_items",
+    "diagnoses_icd",
+    "drgcodes",
+    "hcpcsevents",
+    "icustays",
+    "microbiologyevents",
+    "outputevents",
+    "patients",
+    "pharmacy",
+    "prescriptions",
+    "procedures_icd",
+    "transfers",
+]
+
+
+def make_db(db_fp, n_rows: int = 25):
+    """
+    Create a sqlite stand-in for the IRIS database.
+    Dictionary tables (d_*) have no subject_id column.
+
+    Returns a connect() replacement that attaches an INFORMATION_SCHEMA
+    database describing the tables' columns.
+    """
+
+    info_fp = db_fp.with_name("information_schema.db")
+
+    conn = sqlite3.connect(db_fp)
+    conn.execute("ATTACH DATABASE ? AS INFORMATION_SCHEMA", [str(info_fp)])
+    conn.execute(
+        "CREATE TABLE INFORMATION_SCHEMA.COLUMNS "
+        "(TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME)"
+    )
+    for table in TABLES:
+        if table.startswith("d_"):
+            columns = ["code", "label"]
+            rows = [(f"c{i}", f"label {i}") for i in range(n_rows)]
+        else:
+            columns = ["subject_id", "value"]
+            rows = [(SUBJECT_ID + i % 3, f"{table} {i}") for i in range(n_rows)]
+        conn.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+        conn.executemany(f"INSERT INTO {table} VALUES (?, ?)", rows)
+        conn.executemany(
+            "INSERT INTO INFORMATION_SCHEMA.COLUMNS VALUES (?, ?, ?)",
+            [("SQLUser", table.upper(), column.upper()) for column in columns],
+        )
+    conn.commit()
+    conn.close()
+
+    def connect():
+        conn = sqlite3.connect(db_fp, check_same_thread=False)
+        conn.execute("ATTACH DATABASE ? AS INFORMATION_SCHEMA", [str(info_fp)])
+        return conn
+
+    return connect
+
+
+def read_csv_rows(fp) -> list[list[str]]:
+    with fp.open(newline="") as f:
+        return list(csv.reader(f))
 
 
 def test_analyze_data():
@@ -12,25 +91,357 @@ def test_analyze_data():
     Test analyze_data() function.
     """
 
-    files = [
-        File.from_path("data/split/d_hcpcs.csv"),
-        File.from_path("data/split/patients.csv"),
-        File.from_path("data/split/hcpcsevents.csv"),
-        File.from_path("data/split/icustays.csv"),
-        File.from_path("data/split/procedures_icd.csv"),
-        File.from_path("data/split/drgcodes.csv"),
-        File.from_path("data/split/transfers.csv"),
-        File.from_path("data/split/diagnoses_icd.csv"),
-        File.from_path("data/split/microbiologyevents.csv"),
-        File.from_path("data/split/outputevents.csv"),
-        File.from_path("data/split/prescriptions.csv"),
-        File.from_path("data/split/pharmacy.csv"),
-        File.from_path("data/split/d_items.csv"),
-    ]
+    files = load_files(
+        tables=[
+            "d_hcpcs",
+            "patients",
+            "hcpcsevents",
+            "icustays",
+            "procedures_icd",
+            "drgcodes",
+            "transfers",
+            "diagnoses_icd",
+            "microbiologyevents",
+            "outputevents",
+            "prescriptions",
+            "pharmacy",
+            "d_items",
+        ]
+    )
 
     answer = asyncio.run(analyze_data(files=files))
     print(answer)
 
 
+class FakeResponse:
+    def __init__(self, content: str):
+        self.content = content
+        self.files = []
+
+
+class FakeSession:
+    """
+    Stand-in for CodeInterpreterSession that records how many requests overlap.
+    Files whose content starts with a number take that many hundredths of a
+    second to analyze.
+    """
+
+    active = 0
+    peak = 0
+    opened = 0
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        FakeSession.opened += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def agenerate_response(self, user_request, files, detailed_error=False):
+        FakeSession.active += 1
+        FakeSession.peak = max(FakeSession.peak, FakeSession.active)
+        delay = files[0].content.split(b"\n")[0]
+        await asyncio.sleep(int(delay) / 100 if delay.isdigit() else 0.01)
+        FakeSession.active -= 1
+        return FakeResponse(f"analysis of {files[0].name}")
+
+
+@pytest.fixture(autouse=True)
+def reset_fake_session():
+    """Reset the FakeSession counters before each test"""
+    FakeSession.active = FakeSession.peak = FakeSession.opened = 0
+
+
+def test_export_table(tmp_path):
+    """
+    Test export_table() streams every row across several batches.
+    """
+
+    db_fp = tmp_path.joinpath("mimic.db")
+    make_db(db_fp, n_rows=25)
+
+    conn = sqlite3.connect(db_fp)
+    out_fp = tmp_path.joinpath("d_items.csv")
+    n_rows = export_table(conn.cursor(), "SELECT * FROM d_items", out_fp, batch_size=4)
+    conn.close()
+
+    rows = read_csv_rows(out_fp)
+    assert n_rows == 25
+    assert rows[0] == ["code", "label"]
+    assert rows[1:] == [[f"c{i}", f"label {i}"] for i in range(25)]
+
+
+def test_get_data(tmp_path, monkeypatch):
+    """
+    Test get_data() against a sqlite stand-in for scraibe.db.connect().
+    """
+
+    connect = make_db(tmp_path.joinpath("mimic.db"), n_rows=30)
+    monkeypatch.setattr(scraibe.agent, "connect", connect)
+
+    get_data(db_dir=tmp_path, batch_size=7, workers=3)
+
+    for table in TABLES:
+        rows = read_csv_rows(tmp_path.joinpath(f"{table}.csv"))
+        if table.startswith("d_"):
+            assert len(rows) == 31
+        else:
+            assert len(rows) == 11
+            assert all(row[0] == str(SUBJECT_ID) for row in rows[1:])
+
+
+def test_get_data_cohort(tmp_path, monkeypatch):
+    """
+    Test get_data() fetches a whole cohort with one query per table.
+    """
+
+    connect = make_db(tmp_path.joinpath("mimic.db"), n_rows=30)
+    monkeypatch.setattr(scraibe.agent, "connect", connect)
+
+    cohort = [SUBJECT_ID, SUBJECT_ID + 2]
+    get_data(db_dir=tmp_path, subject_ids=cohort)
+
+    rows = read_csv_rows(tmp_path.joinpath("pharmacy.csv"))
+    assert len(rows) == 21
+    assert {row[0] for row in rows[1:]} == {str(sid) for sid in cohort}
+
+
+def write_mimic_csvs(db_dir) -> None:
+    """
+    Write a dictionary table and a per-subject table to db_dir.
+    """
+
+    db_dir.mkdir()
+    with db_dir.joinpath("d_items.csv").open("w") as f:
+        f.write("itemid,label\n1,a\n2,b\n")
+    with db_dir.joinpath("icustays.csv").open("w") as f:
+        f.write("subject_id,los\n")
+        f.writelines(f"{100 + i % 3},{i}.5\n" for i in range(10))
+
+
+def test_prepare_data_cohort(tmp_path):
+    """
+    Test prepare_data() splits each CSV table by subject.
+    """
+
+    db_dir = tmp_path.joinpath("mimic")
+    split_dir = tmp_path.joinpath("split")
+    write_mimic_csvs(db_dir)
+
+    prepare_data(db_dir, split_dir, [100, 102, 999], fmt="csv")
+
+    assert read_csv_rows(split_dir.joinpath("d_items.csv")) == [
+        ["itemid", "label"],
+        ["1", "a"],
+        ["2", "b"],
+    ]
+    rows = read_csv_rows(split_dir.joinpath("100", "icustays.csv"))
+    assert rows == [["subject_id", "los"]] + [["100", f"{i}.5"] for i in (0, 3, 6, 9)]
+    rows = read_csv_rows(split_dir.joinpath("102", "icustays.csv"))
+    assert [row[1] for row in rows[1:]] == ["2.5", "5.5", "8.5"]
+    assert read_csv_rows(split_dir.joinpath("999", "icustays.csv")) == [
+        ["subject_id", "los"]
+    ]
+    assert not split_dir.joinpath("101").exists()
+
+
+def test_prepare_data_parquet(tmp_path):
+    """
+    Test prepare_data() splits typed Parquet tables and load_files() emits CSV.
+    """
+
+    db_dir = tmp_path.joinpath("mimic")
+    split_dir = tmp_path.joinpath("split")
+    write_mimic_csvs(db_dir)
+
+    prepare_data(db_dir, split_dir, [100, 102, 999])
+
+    assert db_dir.joinpath("icustays.parquet").exists()
+    assert not split_dir.joinpath("101").exists()
+
+    files = load_files(split_dir.joinpath("102"), tables=["icustays"])
+    assert [file.name for file in files] == ["icustays.csv"]
+    assert (
+        files[0].content.decode() == '"subject_id","los"\n102,2.5\n102,5.5\n102,8.5\n'
+    )
+
+    files = load_files(split_dir.joinpath("999"), tables=["icustays"])
+    assert files[0].content.decode() == '"subject_id","los"\n'
+
+    files = load_files(split_dir)
+    assert [file.name for file in files] == ["d_items.csv"]
+
+
+def test_prepare_data_incremental(tmp_path, monkeypatch):
+    """
+    Test prepare_data() only re-splits files that changed since the last run.
+    """
+
+    db_dir = tmp_path.joinpath("mimic")
+    split_dir = tmp_path.joinpath("split")
+    write_mimic_csvs(db_dir)
+
+    split = []
+    split_parquet = scraibe.agent.split_parquet
+
+    def record_split(fp, *args):
+        split.append(fp.stem)
+        return split_parquet(fp, *args)
+
+    monkeypatch.setattr(scraibe.agent, "split_parquet", record_split)
+
+    prepare_data(db_dir, split_dir, [100, 102])
+    assert sorted(split) == ["d_items", "icustays"]
+
+    # Nothing changed
+    split.clear()
+    prepare_data(db_dir, split_dir, [100, 102])
+    assert split == []
+
+    # Touched but unchanged files are not re-split either
+    db_dir.joinpath("d_items.csv").touch()
+    prepare_data(db_dir, split_dir, [100, 102])
+    assert split == []
+
+    with db_dir.joinpath("icustays.csv").open("a") as f:
+        f.write("100,10.5\n")
+    prepare_data(db_dir, split_dir, [100, 102])
+    assert split == ["icustays"]
+
+    # A different cohort or a missing output re-splits the affected files
+    split.clear()
+    split_dir.joinpath("102", "icustays.parquet").unlink()
+    prepare_data(db_dir, split_dir, [100, 102])
+    assert split == ["icustays"]
+
+    split.clear()
+    prepare_data(db_dir, split_dir, [100])
+    assert sorted(split) == ["d_items", "icustays"]
+
+    split.clear()
+    prepare_data(db_dir, split_dir, [100], force=True)
+    assert sorted(split) == ["d_items", "icustays"]
+
+
+def test_analyze_data_concurrency(tmp_path):
+    """
+    Test analyze_data() bounds concurrent analyses and keeps the output order.
+    """
+
+    files = [File(name=f"table{i}.csv", content=f"a\n{i}\n".encode()) for i in range(7)]
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+
+    answer = asyncio.run(
+        analyze_data(files, concurrency=3, session_cls=FakeSession, cache=cache)
+    )
+
+    assert FakeSession.opened == 3
+    assert FakeSession.peak == 3
+    assert list(answer) == [file.name for file in files]
+    assert answer["table4.csv"] == {"text": "analysis of table4.csv", "images": []}
+
+    # Identical tables are served from the cache without starting a session
+    FakeSession.opened = 0
+    files[2] = File(name="table2.csv", content=b"a\nchanged\n")
+    again = asyncio.run(
+        analyze_data(files, concurrency=3, session_cls=FakeSession, cache=cache)
+    )
+    assert again == answer
+    assert FakeSession.opened == 1
+
+
+def test_iter_analysis(tmp_path):
+    """
+    Test iter_analysis() yields each table as soon as it is analyzed.
+    """
+
+    files = [
+        File(name=f"table{delay}.csv", content=f"{delay}\n".encode())
+        for delay in [9, 1, 5]
+    ]
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+
+    async def collect():
+        return [
+            name
+            async for name, _ in iter_analysis(
+                files, concurrency=3, session_cls=FakeSession, cache=cache
+            )
+        ]
+
+    assert asyncio.run(collect()) == ["table1.csv", "table5.csv", "table9.csv"]
+
+
+def test_pack_texts():
+    """
+    Test pack_texts() groups consecutive texts within the token budget.
+    """
+
+    texts = ["a" * 36, "b" * 36, "c" * 76, "d" * 4]
+    assert pack_texts(texts, 20) == [texts[:2], texts[2:3], texts[3:]]
+    # Separators count between the texts
+    assert pack_texts(texts, 20, "\n\n") == [[text] for text in texts]
+
+
+def test_summarize_report(tmp_path, monkeypatch, capsys):
+    """
+    Test summarize_report() merges the table summaries within the token budget,
+    instructions included, and makes the final summary once.
+    """
+
+    class Image:
+        def show_image(self):
+            raise AssertionError("showed an image")
+
+        def save_image(self, fp):
+            raise AssertionError("saved an image")
+
+    class LongSession(FakeSession):
+        async def agenerate_response(self, user_request, files, detailed_error=False):
+            await super().agenerate_response(user_request, files, detailed_error)
+            resp = FakeResponse(f"{files[0].name} " + "finding " * 40)
+            resp.files = [Image()]
+            return resp
+
+    prompts = []
+
+    async def acreate(model, messages, max_tokens=None):
+        prompts.append(messages[-1]["content"])
+        await asyncio.sleep(0.01)
+        return {"choices": [{"message": {"content": f"merged {len(prompts)}"}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+
+    files = [File(name=f"table{i}.csv", content=f"a\n{i}\n".encode()) for i in range(9)]
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+
+    summary = asyncio.run(
+        summarize_report(
+            files, concurrency=3, session_cls=LongSession, cache=cache, max_tokens=300
+        )
+    )
+
+    assert FakeSession.peak == 3
+    assert summary == f"merged {len(prompts)}"
+    assert len(prompts) > 2
+    assert all(count_tokens(prompt) <= 300 for prompt in prompts)
+    # The tables are summarized as text only
+    assert "AI:" not in capsys.readouterr().out
+    assert prompts[-1].endswith("summary of the patient's medical history.")
+
+    # Everything is cached
+    n = len(prompts)
+    again = asyncio.run(
+        summarize_report(
+            files, concurrency=3, session_cls=LongSession, cache=cache, max_tokens=300
+        )
+    )
+    assert again == summary
+    assert len(prompts) == n
+
+
 if __name__ == "__main__":
     test_analyze_data()
@@ -0,0 +1,114 @@
+"""tests/test_cache.py"""
+
+import time
+
+import numpy as np
+
+from scraibe.cache import EmbeddingCache, ResultCache
+
+
+def test_result_cache(tmp_path):
+    """
+    Test ResultCache keys, expiry, LRU eviction and invalidation.
+    """
+
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"), ttl=None, max_entries=2)
+
+    key = cache.make_key("prompt", [b"a,b\n1,2\n"], "gpt-4", 25)
+    assert key == cache.make_key("prompt", [b"a,b\n1,2\n"], "gpt-4", 25)
+    assert key != cache.make_key("prompt", [b"a,b\n1,3\n"], "gpt-4", 25)
+    assert key != cache.make_key("prompt", [b"a,b\n1,2\n"], "gpt-4", 40)
+
+    cache.set("a", {"text": "A", "images": []})
+    cache.set("b", {"text": "B", "images": []})
+    assert cache.get("a") == {"text": "A", "images": []}
+
+    # "b" is now the least recently used entry
+    cache.set("c", {"text": "C", "images": []})
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    # Results whose images were deleted are misses
+    image_fp = tmp_path.joinpath("image.png")
+    image_fp.write_bytes(b"png")
+    cache.set("d", {"text": "D", "images": [str(image_fp)]})
+    assert cache.get("d") is not None
+    image_fp.unlink()
+    assert cache.get("d") is None
+
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_result_cache_ttl(tmp_path):
+    """
+    Test ResultCache entries expire after the TTL.
+    """
+
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"), ttl=0.05)
+    cache.set("a", {"text": "A"})
+    assert cache.get("a") == {"text": "A"}
+    time.sleep(0.1)
+    assert cache.get("a") is None
+
+
+def test_embedding_cache(tmp_path):
+    """
+    Test EmbeddingCache lookups, counters, persistence and LRU eviction.
+    """
+
+    cache = EmbeddingCache(tmp_path, max_entries=3, touch_interval=0)
+
+    assert cache.get_many("ada", ["a", "b"]) == [None, None]
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    cache.set_many("ada", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+    a, b, c = cache.get_many("ada", ["a", "b", "c"])
+    assert a.dtype == np.float32
+    assert a.tolist() == [1.0, 2.0] and b.tolist() == [3.0, 4.0] and c is None
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    # Keys include the model
+    assert cache.get_many("other", ["a"]) == [None]
+
+    # "b" is the least recently used entry once "a" is read again
+    cache.set_many("ada", ["c"], [[5.0, 6.0]])
+    time.sleep(0.01)
+    cache.get_many("ada", ["a", "c"])
+    cache.set_many("ada", ["d"], [[7.0, 8.0]])
+    assert len(cache) == 3
+    assert cache.get_many("ada", ["b"]) == [None]
+    cache.close()
+
+    # Embeddings persist across instances
+    cache = EmbeddingCache(tmp_path, max_entries=3)
+    a, c, d = cache.get_many("ada", ["a", "c", "d"])
+    assert a.tolist() == [1.0, 2.0] and c.tolist() == [5.0, 6.0]
+    assert d.tolist() == [7.0, 8.0]
+    cache.close()
+
+
+def test_embedding_cache_touch_interval(tmp_path):
+    """Test that lookups only record recent uses once per touch_interval"""
+
+    cache = EmbeddingCache(tmp_path, max_entries=2, touch_interval=60)
+    cache.set_many("ada", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+
+    def accessed_at(text: str) -> float:
+        key = cache.make_key("ada", text)
+        return cache.conn.execute(
+            "SELECT accessed_at FROM embeddings WHERE key = ?", [key]
+        ).fetchone()[0]
+
+    before = accessed_at("a")
+    time.sleep(0.01)
+    assert cache.get_many("ada", ["a"])[0].tolist() == [1.0, 2.0]
+    assert accessed_at("a") == before
+
+    cache.touch_interval = 0
+    cache.get_many("ada", ["a"])
+    assert accessed_at("a") > before
+    cache.close()
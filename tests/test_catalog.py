@@ -0,0 +1,120 @@
+"""tests/test_catalog.py"""
+
+import threading
+
+import pytest
+
+from scraibe.catalog import NoteCatalog
+
+
+def make_catalog(tmp_path) -> NoteCatalog:
+    return NoteCatalog(tmp_path.joinpath("catalog.sqlite"), tmp_path.joinpath("x.csv"))
+
+
+def test_add_update_get(tmp_path):
+    """Test that notes are added once and updated"""
+
+    catalog = make_catalog(tmp_path)
+    catalog.add("a", {"filename": "a.pdf", "subject_id": 7})
+    catalog.add("a", {"filename": "other.pdf"})
+    catalog.update("a", status="extracted", page_count=3, text_size=120)
+
+    note = catalog.get("a")
+    assert note["filename"] == "a.pdf"
+    assert note["metadata"] == {"filename": "a.pdf", "subject_id": 7}
+    assert note["subject_id"] == 7
+    assert (note["status"], note["page_count"], note["text_size"]) == (
+        "extracted",
+        3,
+        120,
+    )
+    assert catalog.get("b") is None
+    assert len(catalog) == 1
+
+
+def test_list(tmp_path):
+    """Test that notes are paginated newest first, and filtered"""
+
+    catalog = make_catalog(tmp_path)
+    for i in range(7):
+        catalog.add(
+            f"note-{i}", {"filename": f"{'ab'[i % 2]}-{i}.pdf", "subject_id": i % 3}
+        )
+
+    ids, cursor = [], None
+    while True:
+        notes, cursor = catalog.list(limit=3, cursor=cursor)
+        ids.extend(note["id"] for note in notes)
+        if cursor is None:
+            break
+    assert ids == [f"note-{i}" for i in reversed(range(7))]
+
+    notes, cursor = catalog.list(subject_id=1)
+    assert [note["id"] for note in notes] == ["note-4", "note-1"]
+    assert cursor is None
+
+    notes, _ = catalog.list(filename="b-")
+    assert [note["id"] for note in notes] == ["note-5", "note-3", "note-1"]
+
+    catalog.update("note-2", status="failed", error="boom")
+    notes, _ = catalog.list(status="failed")
+    assert [(note["id"], note["error"]) for note in notes] == [("note-2", "boom")]
+
+    with pytest.raises(ValueError):
+        catalog.list(cursor="not a cursor")
+
+
+def test_legacy_import(tmp_path):
+    """Test that an index CSV is imported into an empty catalog"""
+
+    legacy_fp = tmp_path.joinpath("index.csv")
+    legacy_fp.write_text("id,filename\na,a.pdf\nb,b.pdf\n")
+    tmp_path.joinpath("b").mkdir()
+    tmp_path.joinpath("b", "b.pdf").write_bytes(b"%PDF")
+
+    catalog = NoteCatalog(tmp_path.joinpath("catalog.sqlite"), legacy_fp)
+    assert len(catalog) == 2
+    assert catalog.get("b")["filename"] == "b.pdf"
+
+    # Pending ingestion if its PDF was kept
+    assert catalog.get("b")["status"] == NoteCatalog.UPLOADED
+    assert catalog.get("a")["status"] == NoteCatalog.FAILED
+    assert catalog.get("a")["error"] == "PDF not found"
+    assert catalog.pending() == ["b"]
+
+
+def test_concurrent_writers(tmp_path):
+    """Test that catalogs sharing a database can write at the same time"""
+
+    catalogs = [make_catalog(tmp_path) for _ in range(4)]
+
+    def write(i: int, catalog: NoteCatalog):
+        for j in range(50):
+            catalog.add(f"{i}-{j}", {"filename": f"{i}-{j}.pdf"})
+            catalog.update(f"{i}-{j}", status="stored")
+
+    threads = [
+        threading.Thread(target=write, args=(i, catalog))
+        for i, catalog in enumerate(catalogs)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(catalogs[0]) == 200
+    assert len(catalogs[0].list(limit=500, status="stored")[0]) == 200
+
+
+def test_pending(tmp_path):
+    """Test that notes not stored or failed yet are pending, oldest first"""
+
+    catalog = make_catalog(tmp_path)
+    for i in range(4):
+        catalog.add(f"note-{i}", {"filename": f"{i}.pdf"})
+    catalog.update("note-1", status="stored")
+    catalog.update("note-2", status="failed")
+    catalog.update("note-3", status="chunked")
+
+    assert catalog.pending() == ["note-0", "note-3"]
+    assert catalog.pending(limit=1) == ["note-0"]
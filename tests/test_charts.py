@@ -0,0 +1,124 @@
+"""tests/test_charts.py"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from codeinterpreterapi import File
+
+from scraibe.agent import generate_visuals
+from scraibe.cache import ResultCache
+from scraibe.charts import get_chart_pool, render_charts
+
+TABLES = {
+    "prescriptions.csv": (
+        "subject_id,starttime,stoptime,drug\n"
+        "1,2201-10-30 12:00:00,2201-11-01 12:00:00,Fentanyl Citrate\n"
+        "1,2201-10-31 08:00:00,,Heparin\n"
+        "1,2201-11-02 08:00:00,2201-11-03 08:00:00,Heparin\n"
+    ),
+    "icustays.csv": (
+        "subject_id,stay_id,first_careunit,intime,los\n"
+        "1,10,Neuro Stepdown,2154-04-24 23:03:44,7.70\n"
+        "1,11,MICU,2155-01-02 10:00:00,2.25\n"
+    ),
+    "diagnoses_icd.csv": (
+        "subject_id,seq_num,icd_code,icd_version\n"
+        "1,1,4139,9\n1,2,4139,9\n1,3,I10,10\n"
+    ),
+    "patients.csv": "subject_id,gender\n1,F\n",
+}
+
+
+class NoExecutor(ThreadPoolExecutor):
+    """Fails if anything is rendered"""
+
+    def submit(self, *args, **kwargs):
+        raise AssertionError("rendered a cached chart")
+
+
+def make_files() -> list[File]:
+    return [File(name=name, content=text.encode()) for name, text in TABLES.items()]
+
+
+def test_render_charts(tmp_path):
+    """Test that standard charts are rendered once, and then cached"""
+
+    files = make_files()
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+    out_dir = tmp_path.joinpath("visualizations")
+
+    results = asyncio.run(render_charts(files, cache, out_dir=out_dir))
+
+    assert list(results) == ["prescriptions.csv", "icustays.csv", "diagnoses_icd.csv"]
+    for result in results.values():
+        (image,) = result["images"]
+        assert Path(image).read_bytes().startswith(b"\x89PNG")
+    assert results["icustays.csv"]["text"].startswith("2 ICU stays")
+    assert "4139 (ICD-9) (2 times)" in results["diagnoses_icd.csv"]["text"]
+
+    with NoExecutor() as executor:
+        again = asyncio.run(render_charts(files, cache, executor, out_dir=out_dir))
+    assert again == results
+
+    # Rendered in the shared pool, which is kept for the next calls
+    assert get_chart_pool() is get_chart_pool()
+    assert get_chart_pool().submit(int).result() == 0
+
+
+def test_render_charts_empty(tmp_path):
+    """Test that tables without rows have no chart"""
+
+    files = [File(name="icustays.csv", content=b"subject_id,intime,los\n")]
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+
+    with ThreadPoolExecutor() as executor:
+        results = asyncio.run(render_charts(files, cache, executor, tmp_path))
+
+    assert results == {
+        "icustays.csv": {"text": "icustays.csv has no rows.", "images": []}
+    }
+
+
+def test_render_charts_unparsable(tmp_path, caplog):
+    """Test that unparsable tables have no chart, and failed charts are left out"""
+
+    files = [
+        File(name="prescriptions.csv", content=b"starttime,stoptime,drug\nx,,A\n"),
+        File(name="icustays.csv", content=b"subject_id,los\n1,2.0\n"),
+    ]
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+
+    with ThreadPoolExecutor() as executor:
+        results = asyncio.run(render_charts(files, cache, executor, tmp_path))
+
+    # icustays.csv has no intime column
+    assert "Failed to render the chart of icustays.csv" in caplog.text
+    assert results == {
+        "prescriptions.csv": {
+            "text": "prescriptions.csv has no rows to chart.",
+            "images": [],
+        }
+    }
+
+
+def test_generate_visuals_local(tmp_path, monkeypatch):
+    """Test that standard charts need no code interpreter session"""
+
+    monkeypatch.setattr("scraibe.charts.VISUALIZATIONS_DIR", tmp_path)
+    files = make_files()[:3]
+    cache = ResultCache(tmp_path.joinpath("cache.sqlite"))
+    reported = []
+
+    with ThreadPoolExecutor() as executor:
+        results = asyncio.run(
+            generate_visuals(
+                files,
+                data={},
+                cache=cache,
+                on_result=lambda name, _: reported.append(name),
+                executor=executor,
+            )
+        )
+
+    assert sorted(results) == sorted(reported) == sorted(file.name for file in files)
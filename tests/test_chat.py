@@ -0,0 +1,122 @@
+"""tests/test_chat.py"""
+
+import asyncio
+
+import openai
+
+from scraibe.cache import ResultCache
+from scraibe.chat import ChatService
+from scraibe.context import message_tokens
+from scraibe.numpy_store import NumpyVectorStore
+
+
+class FakeEmbedder:
+    """Embeds a text as [1, 0] if it mentions "heart", else [0, 1]"""
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(0.01)
+        return [[1.0, 0.0] if "heart" in text else [0.0, 1.0] for text in texts]
+
+
+def make_acreate(log: list):
+    """
+    Fake streaming openai.ChatCompletion.acreate echoing the last message.
+    """
+
+    async def acreate(model, messages, stream):
+        async def chunks():
+            for word in messages[-1]["content"].split():
+                log.append(word)
+                await asyncio.sleep(0.01)
+                yield {"choices": [{"delta": {"content": f"{word} "}}]}
+            yield {"choices": [{"delta": {}}]}
+
+        log.append(messages)
+        return chunks()
+
+    return acreate
+
+
+def make_service(**kwargs) -> ChatService:
+    store = NumpyVectorStore()
+    store.insert_many(["heart note"], [[1.0, 0.0]], subject_id=1)
+    store.insert_many(["lung note"], [[0.0, 1.0]], subject_id=2)
+    return ChatService(FakeEmbedder(), store, limit=1, **kwargs)
+
+
+def test_stream(monkeypatch):
+    """Test that replies are streamed with the retrieved notes in context"""
+
+    log = []
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", make_acreate(log))
+    service = make_service()
+    session = service.get_session()
+
+    async def reply(message: str, **filters) -> list[str]:
+        return [token async for token in service.stream(session, message, **filters)]
+
+    assert asyncio.run(reply("my heart hurts")) == ["my ", "heart ", "hurts "]
+    asyncio.run(reply("and my heart again", subject_id=2))
+
+    requests = [entry for entry in log if isinstance(entry, list)]
+    assert "heart note" in requests[0][1]["content"]
+    assert "lung note" in requests[1][1]["content"]
+    assert service.get_session(session.id) is session
+    assert session.context.history[1] == {
+        "role": "assistant",
+        "content": "my heart hurts ",
+    }
+
+
+def test_concurrent_sessions(monkeypatch):
+    """Test that replies of different conversations are streamed concurrently"""
+
+    log = []
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", make_acreate(log))
+    service = make_service()
+
+    async def reply(message: str) -> str:
+        session = service.get_session()
+        return "".join([token async for token in service.stream(session, message)])
+
+    async def main():
+        return await asyncio.gather(reply("a b c"), reply("x y z"))
+
+    assert asyncio.run(main()) == ["a b c ", "x y z "]
+    words = [entry for entry in log if isinstance(entry, str)]
+    assert words != ["a", "b", "c", "x", "y", "z"]
+    assert len(service.sessions) == 2
+
+
+def test_old_turns_are_summarized(tmp_path, monkeypatch):
+    """Test that turns over the token budget are summarized, not just dropped"""
+
+    log = []
+    summaries = []
+    stream_acreate = make_acreate(log)
+
+    async def acreate(model, messages, stream=False, **kwargs):
+        if stream:
+            return await stream_acreate(model, messages, stream)
+        summaries.append(messages[-1]["content"])
+        return {"choices": [{"message": {"content": f"summary {len(summaries)}"}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    service = make_service(max_tokens=300, cache=ResultCache(tmp_path / "cache.sqlite"))
+    session = service.get_session()
+
+    async def main():
+        for i in range(10):
+            message = f"question {i} about my heart " * 5
+            async for _ in service.stream(session, message):
+                pass
+        return await session.context.amessages()
+
+    messages = asyncio.run(main())
+
+    requests = [entry for entry in log if isinstance(entry, list)]
+    assert summaries and "question 0" in summaries[0]
+    assert session.context.summary == f"summary {len(summaries)}"
+    assert "Summary of the conversation" in requests[-1][1]["content"]
+    assert messages[1]["content"].endswith(session.context.summary)
+    assert sum(map(message_tokens, messages)) <= 300
@@ -0,0 +1,60 @@
+"""tests/test_context.py"""
+
+from scraibe import context as context_module
+from scraibe.context import ChatContext, count_tokens
+
+
+def test_notes_are_deduplicated():
+    """Test that notes are kept once and the oldest are dropped over budget"""
+
+    context = ChatContext("system", notes_tokens=60)
+
+    assert context.add_notes(["a" * 80, "b" * 80]) == ["a" * 80, "b" * 80]
+    assert context.add_notes(["a" * 80, "c" * 80]) == ["c" * 80]
+
+    # "b" was retrieved least recently
+    assert list(context.notes.values()) == ["c" * 80, "a" * 80]
+
+    notes = [m for m in context.messages() if "medical notes" in m["content"]]
+    assert len(notes) == 1
+    assert notes[0]["content"].count("Note:") == 2
+
+
+def test_history_is_trimmed():
+    """Test that the context stays within budget over a long conversation"""
+
+    summaries = []
+
+    def summarize(summary: str, messages: list[dict]) -> str:
+        summaries.append(len(messages))
+        return f"{sum(summaries)} messages."
+
+    context = ChatContext(
+        "system", max_tokens=200, notes_tokens=50, summarize=summarize
+    )
+    for i in range(50):
+        context.add_notes([f"note {i}" * 10])
+        context.add_message("user", f"question {i} " * 10)
+        assert context.tokens() <= 200
+        context.add_message("assistant", f"answer {i} " * 10)
+
+    messages = context.messages()
+    assert messages[0] == {"role": "system", "content": "system"}
+    assert messages[-1]["content"].startswith("answer 49")
+    assert "messages." in messages[1]["content"]
+    assert sum(summaries) == 100 - len(context.history)
+
+
+def test_count_tokens(monkeypatch):
+    """Test that tokens are counted with the tokenizer when it is available"""
+
+    class FakeEncoding:
+        def encode(self, text: str, disallowed_special=()) -> list[int]:
+            return list(range(len(text.split())))
+
+    monkeypatch.setattr(context_module, "get_encoding", lambda: FakeEncoding())
+    assert count_tokens("a few words here") == 4
+
+    # Estimated from the length without it
+    monkeypatch.setattr(context_module, "get_encoding", lambda: None)
+    assert count_tokens("a few words here") == len("a few words here") // 4 + 1
@@ -0,0 +1,68 @@
+"""tests/test_db.py"""
+
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scraibe.db import ConnectionPool, get_tables_with_column
+
+
+def test_connection_pool(tmp_path):
+    """
+    Test ConnectionPool() never opens more than `size` connections and reuses them.
+    """
+
+    db_fp = tmp_path.joinpath("pool.db")
+    opened = []
+    in_use = []
+    lock = threading.Lock()
+    peak = 0
+
+    def connect():
+        conn = sqlite3.connect(db_fp, check_same_thread=False)
+        opened.append(conn)
+        return conn
+
+    def work(_):
+        nonlocal peak
+        with pool.connection() as conn:
+            with lock:
+                in_use.append(conn)
+                peak = max(peak, len(in_use))
+            conn.execute("SELECT 1").fetchone()
+            time.sleep(0.01)
+            with lock:
+                in_use.remove(conn)
+
+    with ConnectionPool(size=3, connect_fn=connect) as pool:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(work, range(40)))
+
+    assert len(opened) <= 3
+    assert peak <= 3
+
+
+def test_get_tables_with_column():
+    """
+    Test get_tables_with_column() only finds tables of the given schema.
+    """
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("ATTACH ':memory:' AS INFORMATION_SCHEMA")
+    conn.execute(
+        "CREATE TABLE INFORMATION_SCHEMA.COLUMNS "
+        "(TABLE_SCHEMA TEXT, TABLE_NAME TEXT, COLUMN_NAME TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO INFORMATION_SCHEMA.COLUMNS VALUES (?, ?, ?)",
+        [
+            ("SQLUser", "patients", "SUBJECT_ID"),
+            ("SQLUser", "d_items", "itemid"),
+            ("Archive", "d_items", "subject_id"),
+        ],
+    )
+
+    tables = ["patients", "d_items", "transfers"]
+    assert get_tables_with_column(conn, "subject_id", tables) == {"patients"}
+    assert get_tables_with_column(conn, "subject_id", tables, "archive") == {"d_items"}
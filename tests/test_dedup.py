@@ -0,0 +1,33 @@
+"""tests/test_dedup.py"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from scraibe.dedup import DedupIndex, hash_text
+
+
+def test_dedup_index(tmp_path):
+    """Test membership, legacy import and concurrent writers"""
+
+    legacy_fp = tmp_path.joinpath("vector.txt")
+    legacy_fp.write_text(f"{hash_text('old note')}\n")
+
+    index = DedupIndex(tmp_path.joinpath("dedup.sqlite"), legacy_fp)
+    assert hash_text("old note") in index
+    assert hash_text("new note") not in index
+
+    hashes = [hash_text(str(i)) for i in range(100)]
+    assert index.missing(hashes + hashes[:10]) == hashes
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for i in range(0, 100, 10):
+            executor.submit(index.add_many, hashes[i : i + 10], DedupIndex.CHUNK)
+
+    assert index.missing(hashes) == []
+    assert len(index) == 101
+    index.close()
+
+    # The legacy file is only imported into an empty index
+    legacy_fp.write_text(f"{hash_text('another note')}\n")
+    index = DedupIndex(tmp_path.joinpath("dedup.sqlite"), legacy_fp)
+    assert len(index) == 101
+    index.close()
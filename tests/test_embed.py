@@ -0,0 +1,94 @@
+"""tests/test_embed.py"""
+
+import asyncio
+
+import openai
+import pytest
+
+from scraibe.cache import EmbeddingCache
+from scraibe.embed import BatchEmbedder
+
+
+def make_acreate(fail_first: int = 0, delay: float = 0.01):
+    """
+    Fake openai.Embedding.acreate returning [len(text), index] for each input.
+
+    The first ``fail_first`` requests raise a RateLimitError.
+    """
+    calls = {"requests": [], "active": 0, "peak": 0, "failures": 0}
+
+    async def acreate(model, input):
+        if calls["failures"] < fail_first:
+            calls["failures"] += 1
+            raise openai.error.RateLimitError("Rate limit reached")
+
+        calls["requests"].append(list(input))
+        calls["active"] += 1
+        calls["peak"] = max(calls["peak"], calls["active"])
+        await asyncio.sleep(delay)
+        calls["active"] -= 1
+
+        data = [
+            {"index": i, "embedding": [float(len(text)), float(i)]}
+            for i, text in enumerate(input)
+        ]
+        return {"data": list(reversed(data))}
+
+    return acreate, calls
+
+
+def test_batches():
+    """Test that batches are limited by size and estimated tokens"""
+
+    embedder = BatchEmbedder(max_batch_size=3, max_batch_tokens=10)
+    texts = ["a" * 4] * 5 + ["b" * 100, "c"]
+
+    batches = embedder.batches(texts)
+
+    assert batches == [[0, 1, 2], [3, 4], [5], [6]]
+
+
+def test_embed(monkeypatch):
+    """Test that texts are embedded in concurrent multi-input requests, in order"""
+
+    acreate, calls = make_acreate(fail_first=2)
+    monkeypatch.setattr(openai.Embedding, "acreate", acreate)
+
+    embedder = BatchEmbedder(max_batch_size=4, concurrency=2, base_delay=0.001)
+    texts = ["x" * i for i in range(10)]
+
+    embeddings = embedder.embed(texts)
+
+    assert [e[0] for e in embeddings] == [float(i) for i in range(10)]
+    assert [len(r) for r in calls["requests"]] == [4, 4, 2]
+    assert calls["failures"] == 2
+    assert calls["peak"] == 2
+
+
+def test_embed_gives_up(monkeypatch):
+    """Test that errors are raised once the retries are used up"""
+
+    acreate, _ = make_acreate(fail_first=10)
+    monkeypatch.setattr(openai.Embedding, "acreate", acreate)
+
+    embedder = BatchEmbedder(max_retries=2, base_delay=0.001)
+
+    with pytest.raises(openai.error.RateLimitError):
+        embedder.embed(["text"])
+
+
+def test_embed_cache(monkeypatch, tmp_path):
+    """Test that repeated and cached texts are not sent again"""
+
+    acreate, calls = make_acreate()
+    monkeypatch.setattr(openai.Embedding, "acreate", acreate)
+
+    embedder = BatchEmbedder(cache=EmbeddingCache(tmp_path))
+
+    first = embedder.embed(["a", "bb", "a"])
+    second = embedder.embed(["bb", "ccc"])
+
+    assert calls["requests"] == [["a", "bb"], ["ccc"]]
+    assert first[0] == first[2]
+    assert second[0] == first[1]
+    assert embedder.cache.hits == 1
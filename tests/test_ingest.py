@@ -0,0 +1,212 @@
+"""tests/test_ingest.py"""
+
+import asyncio
+import json
+
+from fitz import fitz
+
+from scraibe.dedup import DedupIndex
+from scraibe.ingest import IngestPipeline, Note
+from scraibe.numpy_store import NumpyVectorStore
+
+
+class FakeEmbedder:
+    """Embeds texts by length, and records them"""
+
+    def __init__(self):
+        self.texts = []
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        self.texts.extend(texts)
+        await asyncio.sleep(0.01)
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def make_note(notes_dir, note_id: str, text: str, subject_id: int) -> Note:
+    note = Note(notes_dir.joinpath(note_id))
+    note.base_dir.mkdir(parents=True)
+
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    doc.save(note.pdf_fp)
+    doc.close()
+
+    note.json_fp.write_text(json.dumps({"filename": "a.pdf", "subject_id": subject_id}))
+    return note
+
+
+def make_pipeline(tmp_path, embedder, store) -> IngestPipeline:
+    dedup = DedupIndex(tmp_path.joinpath("dedup.sqlite"), tmp_path.joinpath("x.txt"))
+    return IngestPipeline(embedder, store, dedup, queue_size=1, save_interval=0.05)
+
+
+def test_ingest(tmp_path):
+    """Test that notes are searchable after ingestion, and chunks stored once"""
+
+    notes_dir = tmp_path.joinpath("notes")
+    notes = [
+        make_note(notes_dir, f"note-{i}", f"Shared line. Note {i % 3}.", i)
+        for i in range(6)
+    ]
+    embedder, store = FakeEmbedder(), NumpyVectorStore()
+    states = []
+
+    async def main():
+        pipeline = make_pipeline(tmp_path, embedder, store)
+        pipeline.on_state = lambda note, state: states.append(state)
+        pipeline.start()
+        for note in notes:
+            await pipeline.submit(note)
+        await pipeline.join()
+        await pipeline.stop()
+
+    asyncio.run(main())
+
+    extracted = [state for state in states if state["stage"] == Note.EXTRACTED]
+    assert len(extracted) == 6
+    assert all(state["pages"] == 1 and state["text_size"] > 0 for state in extracted)
+    assert all(note.state["stage"] == Note.STORED for note in notes)
+    assert sum(note.state.get("new_chunks", 0) for note in notes) == 3
+
+    # Each distinct note is embedded and stored once
+    assert len(embedder.texts) == len(set(embedder.texts)) == 3
+    assert len(store) == 3
+    assert sorted(store.metadata["subject_id"].tolist()) == [0, 1, 2]
+    assert not list(notes_dir.glob("*/*.chunks.json"))
+
+
+def test_resume(tmp_path):
+    """Test that notes resume from their last completed stage"""
+
+    notes_dir = tmp_path.joinpath("notes")
+    note = make_note(notes_dir, "note", "Resumed note.", 1)
+    note.txt_fp.write_text("Resumed note.")
+    note.save_state(Note.EXTRACTED)
+    note.pdf_fp.write_bytes(b"not a pdf anymore")
+
+    embedder, store = FakeEmbedder(), NumpyVectorStore()
+
+    async def main():
+        pipeline = make_pipeline(tmp_path, embedder, store)
+        pipeline.start()
+        resumed = await pipeline.resume(notes_dir)
+        # Notes being ingested are not queued twice
+        assert not await pipeline.submit(Note(note.base_dir))
+        await pipeline.join()
+        await pipeline.stop()
+        return resumed
+
+    assert [n.id for n in asyncio.run(main())] == ["note"]
+    assert note.state["stage"] == Note.STORED
+    assert store.texts == ["Resumed note."]
+
+
+class FailingEmbedder(FakeEmbedder):
+    """Fails to embed the first texts it is given"""
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        if texts and not self.texts:
+            self.texts.append(None)
+            await asyncio.sleep(0.05)
+            raise RuntimeError("Embedding failed")
+        return await super().aembed(texts)
+
+
+def test_shared_chunk_failed(tmp_path):
+    """Test that a chunk is stored by another note if the note storing it fails"""
+
+    notes_dir = tmp_path.joinpath("notes")
+    notes = [make_note(notes_dir, f"note-{i}", "Same text.", i) for i in range(2)]
+    embedder, store = FailingEmbedder(), NumpyVectorStore()
+
+    async def main():
+        pipeline = make_pipeline(tmp_path, embedder, store)
+        pipeline.start()
+        for note in notes:
+            await pipeline.submit(note)
+        await pipeline.join()
+        await pipeline.stop()
+
+    asyncio.run(main())
+
+    # Either note can claim the chunk first
+    failed, stored = sorted(notes, key=lambda note: note.state["stage"])
+    assert failed.state["stage"] == Note.FAILED
+    assert stored.state["stage"] == Note.STORED
+    assert stored.state["new_chunks"] == 0
+    assert store.texts == ["Same text."]
+
+
+def test_failure_handler_error(tmp_path):
+    """Test that workers keep running if recording a failure fails"""
+
+    notes_dir = tmp_path.joinpath("notes")
+    broken = make_note(notes_dir, "broken", "Broken.", 1)
+    broken.pdf_fp.write_bytes(b"not a pdf")
+    note = make_note(notes_dir, "note", "Fine.", 2)
+    embedder, store = FakeEmbedder(), NumpyVectorStore()
+
+    def on_state(note, state):
+        if state["stage"] == Note.FAILED:
+            raise OSError("catalog is down")
+
+    async def main():
+        pipeline = make_pipeline(tmp_path, embedder, store)
+        pipeline.workers[None] = 1
+        pipeline.on_state = on_state
+        pipeline.start()
+        await pipeline.submit(broken)
+        await pipeline.submit(note)
+        await pipeline.join()
+        await pipeline.stop()
+
+    asyncio.run(main())
+
+    assert note.state["stage"] == Note.STORED
+
+
+class CountingStore(NumpyVectorStore):
+    """Counts its saves"""
+
+    saves = 0
+
+    def save(self):
+        self.saves += 1
+        super().save()
+
+
+def test_batched_saves(tmp_path):
+    """Test that notes stored together share a save, and stop() saves"""
+
+    notes_dir = tmp_path.joinpath("notes")
+    notes = [make_note(notes_dir, f"note-{i}", f"Note {i}.", i) for i in range(6)]
+    embedder, store = FakeEmbedder(), CountingStore(tmp_path.joinpath("vectors"))
+
+    async def main():
+        pipeline = make_pipeline(tmp_path, embedder, store)
+        pipeline.save_interval = 60
+        pipeline.start()
+        for note in notes:
+            await pipeline.submit(note)
+        for stage in pipeline.STAGES:
+            await pipeline.queues[stage].join()
+        await pipeline.stop()
+
+    asyncio.run(main())
+
+    # Inserted, then saved once on stop; the notes finish when resumed
+    assert store.saves == 1
+    assert len(CountingStore(tmp_path.joinpath("vectors"))) == 6
+    assert all(note.state["stage"] == Note.EMBEDDED for note in notes)
+
+    async def resume():
+        pipeline = make_pipeline(tmp_path, embedder, store)
+        pipeline.start()
+        await pipeline.resume(notes_dir)
+        await pipeline.join()
+        await pipeline.stop()
+
+    asyncio.run(resume())
+
+    assert all(note.state["stage"] == Note.STORED for note in notes)
+    assert len(store) == 6
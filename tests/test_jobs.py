@@ -0,0 +1,136 @@
+"""tests/test_jobs.py"""
+
+import asyncio
+
+import pytest
+
+from scraibe.jobs import Job, JobManager
+
+
+def test_job_manager():
+    """
+    Test JobManager runs jobs in the background, reports progress and dedupes.
+    """
+
+    calls = []
+
+    async def fail(job: Job):
+        raise RuntimeError("boom")
+
+    async def main():
+        manager = JobManager(concurrency=1)
+        reported = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def work(job: Job):
+            calls.append(job.id)
+            job.report("a.csv", {"text": "a.csv"})
+            reported.set()
+            await resume.wait()
+            job.report("b.csv", {"text": "b.csv"})
+            return {"done": True}
+
+        job = manager.submit("analysis", "key", work, total=2)
+        assert job.status == Job.PENDING
+        assert manager.submit("analysis", "key", work) is job
+
+        await reported.wait()
+        status = manager.get(job.id).to_dict()
+        assert status["status"] == Job.RUNNING
+        assert status["progress"] == {"done": 1, "total": 2}
+        assert status["results"] == {"a.csv": {"text": "a.csv"}}
+
+        resume.set()
+        await job.task
+        assert job.status == Job.DONE
+        assert job.result == {"done": True}
+        assert manager.submit("analysis", "key", work) is job
+        assert len(calls) == 1
+
+        failed = manager.submit("graphs", "other", fail)
+        await failed.task
+        assert failed.status == Job.FAILED
+        assert failed.error == "boom"
+
+        # Failed jobs can be retried
+        retry = manager.submit("graphs", "other", work)
+        assert retry is not failed
+        await retry.task
+        assert retry.status == Job.DONE
+
+        assert manager.get("missing") is None
+
+    asyncio.run(main())
+
+
+def test_subscribe():
+    """Test that subscribers get the reported results, then the new ones"""
+
+    async def main():
+        manager = JobManager()
+        reported = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def work(job: Job):
+            job.report("a.csv", 1)
+            reported.set()
+            await resume.wait()
+            job.report("b.csv", 2)
+
+        async def collect(job: Job) -> list:
+            return [item async for item in job.subscribe()]
+
+        job = manager.submit("analysis", "key", work)
+        await reported.wait()
+        late = asyncio.create_task(collect(job))
+        await asyncio.sleep(0)
+        resume.set()
+
+        assert await late == [("a.csv", 1), ("b.csv", 2)]
+        # Subscribing to a finished job replays its results
+        assert await collect(job) == [("a.csv", 1), ("b.csv", 2)]
+
+        async def fail(job: Job):
+            raise RuntimeError("boom")
+
+        failed = manager.submit("graphs", "other", fail)
+        with pytest.raises(RuntimeError, match="boom"):
+            await collect(failed)
+
+    asyncio.run(main())
+
+
+def test_cancel():
+    """Test that a cancelled job fails, so its key can be submitted again"""
+
+    async def main():
+        manager = JobManager(concurrency=1)
+        started = asyncio.Event()
+
+        async def work(job: Job):
+            started.set()
+            await asyncio.Event().wait()
+
+        async def done(job: Job):
+            return "done"
+
+        running = manager.submit("analysis", "a", work)
+        pending = manager.submit("analysis", "b", work)
+        await started.wait()
+
+        for job in (running, pending):
+            job.task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await job.task
+            assert (job.status, job.error) == (Job.FAILED, "cancelled")
+            assert job.finished_at is not None
+
+        with pytest.raises(RuntimeError, match="cancelled"):
+            [item async for item in running.subscribe()]
+
+        retry = manager.submit("analysis", "a", done)
+        assert retry is not running
+        await retry.task
+        assert retry.result == "done"
+
+    asyncio.run(main())
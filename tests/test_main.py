@@ -0,0 +1,189 @@
+"""tests/test_main.py"""
+
+import asyncio
+import importlib
+import json
+import sys
+from functools import partial
+
+import pytest
+from codeinterpreterapi import File
+from fastapi.testclient import TestClient
+
+from scraibe.agent import analyze_data
+from scraibe.cache import EmbeddingCache, ResultCache
+from scraibe.catalog import NoteCatalog
+from scraibe.dedup import DedupIndex
+from scraibe.numpy_store import NumpyVectorStore
+
+
+class FakeResponse:
+    def __init__(self, content: str):
+        self.content = content
+        self.files = []
+
+
+class FakeSession:
+    """Stand-in for CodeInterpreterSession that records overlapping requests"""
+
+    active = 0
+    peak = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def agenerate_response(self, user_request, files, detailed_error=False):
+        FakeSession.active += 1
+        FakeSession.peak = max(FakeSession.peak, FakeSession.active)
+        await asyncio.sleep(0.05)
+        FakeSession.active -= 1
+        return FakeResponse(f"analysis of {files[0].name}")
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    """The app, with its data, caches and vector store in tmp_path"""
+
+    monkeypatch.setattr("config.DATA_DIR", tmp_path)
+    monkeypatch.setattr(
+        "scraibe.agent.load_files",
+        lambda tables: [
+            File(name=f"{table}.csv", content=f"subject_id\n{i}\n".encode())
+            for i, table in enumerate(tables)
+        ],
+    )
+    monkeypatch.setattr(
+        "scraibe.catalog.NoteCatalog",
+        partial(NoteCatalog, tmp_path.joinpath("catalog.sqlite"), tmp_path / "x.csv"),
+    )
+    monkeypatch.setattr(
+        "scraibe.cache.EmbeddingCache",
+        partial(EmbeddingCache, tmp_path.joinpath("embeddings")),
+    )
+    monkeypatch.setattr(
+        "scraibe.dedup.DedupIndex",
+        partial(DedupIndex, tmp_path.joinpath("dedup.sqlite"), tmp_path / "x.txt"),
+    )
+    monkeypatch.setattr(
+        "scraibe.store.get_vector_store",
+        lambda: NumpyVectorStore(tmp_path.joinpath("vectors")),
+    )
+
+    sys.modules.pop("main", None)
+    module = importlib.import_module("main")
+    monkeypatch.setattr(
+        module,
+        "analyze_data",
+        partial(
+            analyze_data,
+            session_cls=FakeSession,
+            cache=ResultCache(tmp_path.joinpath("cache.sqlite")),
+        ),
+    )
+    FakeSession.active = FakeSession.peak = 0
+
+    yield module
+
+    module.pdf_pool.shutdown()
+    sys.modules.pop("main", None)
+
+
+def test_analysis_concurrency(main, monkeypatch):
+    """Test that the analysis endpoint analyzes tables concurrently"""
+
+    monkeypatch.setattr(main, "ANALYSIS_CONCURRENCY", 3)
+    with TestClient(main.app) as client:
+        response = client.get("/analysis/stream")
+
+    events = response.text.split("\n\n")
+    assert sum(event.startswith("event: result") for event in events) == len(main.files)
+    assert "event: done" in response.text
+    assert FakeSession.peak == 3
+
+
+def test_get_analysis(main):
+    """Test that GET /analysis still waits for and returns the analysis"""
+
+    with TestClient(main.app) as client:
+        response = client.get("/analysis")
+        again = client.get("/analysis")
+
+    assert response.status_code == 200
+    assert set(response.json()) == {file.name for file in main.files}
+    name = main.files[0].name
+    assert response.json()[name]["text"] == f"analysis of {name}"
+    assert again.json() == response.json()
+
+
+@pytest.fixture
+def client(main, monkeypatch):
+    """A client of the app, without the background ingestion"""
+
+    async def ingest_notes():
+        pass
+
+    monkeypatch.setattr(main, "ingest_notes", ingest_notes)
+    with TestClient(main.app) as client:
+        yield client
+
+
+def upload(client: TestClient, content: bytes, **kwargs):
+    return client.post(
+        "/upload/notes",
+        files={"file": ("note.pdf", content, "application/pdf")},
+        data={"metadata": json.dumps({"filename": "note.pdf", "subject_id": 7})},
+        **kwargs,
+    )
+
+
+def test_upload(main, client):
+    """Test that an upload is saved and added to the catalog"""
+
+    response = upload(client, b"%PDF-1.4 note")
+
+    assert response.status_code == 202
+    note_id = response.json()["filename"]
+    assert main.NOTES_DIR.joinpath(note_id, f"{note_id}.pdf").read_bytes() == (
+        b"%PDF-1.4 note"
+    )
+    note = main.catalog.get(note_id)
+    assert note["status"] == NoteCatalog.UPLOADED
+    assert note["metadata"] == {"filename": "note.pdf", "subject_id": 7}
+
+
+def test_upload_without_length(main, client):
+    """Test that an upload without a Content-Length is rejected"""
+
+    response = client.post(
+        "/upload/notes",
+        content=iter([b"--boundary--\r\n"]),
+        headers={"Content-Type": "multipart/form-data; boundary=boundary"},
+    )
+
+    assert response.status_code == 411
+    assert len(main.catalog) == 0
+
+
+def test_upload_too_large(main, client, monkeypatch):
+    """Test that oversize uploads are rejected, by header or while saved"""
+
+    monkeypatch.setattr(main, "MAX_UPLOAD_SIZE", 100)
+
+    # Larger than the limit and the form's overhead, so never read
+    monkeypatch.setattr(main, "MAX_UPLOAD_OVERHEAD", 0)
+    assert upload(client, b"x" * 200).status_code == 413
+
+    # Within the overhead, so rejected while it is saved
+    monkeypatch.setattr(main, "MAX_UPLOAD_OVERHEAD", 1 << 20)
+    response = upload(client, b"x" * 200)
+    assert response.status_code == 413
+    assert "larger than 100 bytes" in response.json()["error"]
+
+    assert len(main.catalog) == 0
+    assert list(main.NOTES_DIR.iterdir()) == []
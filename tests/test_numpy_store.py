@@ -0,0 +1,138 @@
+"""tests/test_numpy_store.py"""
+
+import numpy as np
+import pytest
+
+from scraibe.numpy_store import NumpyVectorStore
+from scraibe.store import get_vector_store
+
+
+def brute_force(embeddings: np.ndarray, query: np.ndarray, limit: int) -> list[int]:
+    distances = ((embeddings - query) ** 2).sum(axis=1)
+    return np.argsort(distances, kind="stable")[:limit].tolist()
+
+
+@pytest.mark.parametrize("metric", ["l2", "cosine", "dot"])
+def test_search(metric):
+    """Test that searches match a brute-force search"""
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(200, 8)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    queries = rng.normal(size=(5, 8)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    store = NumpyVectorStore(metric=metric)
+    ids = store.insert_many([str(i) for i in range(200)], embeddings)
+    assert ids == list(range(1, 201))
+
+    # Normalized vectors rank the same under every metric
+    results = store.search_many(queries, limit=10)
+    for query, matches in zip(queries, results):
+        assert [m.id - 1 for m in matches] == brute_force(embeddings, query, 10)
+        distances = [m.distance for m in matches]
+        assert distances == sorted(distances)
+
+    match = store.select_nearest(embeddings[42], limit=1)[0]
+    assert (match.id, match.text) == (43, "42")
+    assert store.recall(queries, limit=10) == 1.0
+
+
+def test_filters_and_mutations():
+    """Test metadata filters, upserts, updates and deletes"""
+
+    store = NumpyVectorStore()
+    store.insert_many(["a", "b"], [[1.0, 0.0], [0.9, 0.1]], subject_id=1)
+    store.insert_many(["c"], [[1.0, 0.0]], subject_id=2, note_id="n")
+
+    assert [m.text for m in store.select_nearest([1.0, 0.0], 3, subject_id=1)] == [
+        "a",
+        "b",
+    ]
+    assert [m.text for m in store.select_nearest([1.0, 0.0], 3, note_id="n")] == ["c"]
+    assert store.select_nearest([1.0, 0.0], 3, subject_id=3) == []
+
+    store.update_embedding(1, [0.0, 1.0])
+    store.upsert_vector(2, "B", [0.0, 1.0])
+    store.upsert_vector(10, "d", [1.0, 0.0])
+    store.delete_vector(3)
+
+    assert len(store) == 3
+    assert [m.id for m in store.select_nearest([1.0, 0.0], 1)] == [10]
+    assert store.insert_vector("e", [0.5, 0.5]) == 11
+    with pytest.raises(ValueError):
+        store.insert_vector("f", [1.0, 0.0, 0.0])
+
+
+def test_batch_mutations():
+    """Test upserting and deleting many vectors at once"""
+
+    store = NumpyVectorStore()
+    store.insert_many(["a", "b", "c"], [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+
+    store.upsert_many([2, 5], ["B", "e"], [[1.0, 0.0], [0.5, 0.5]])
+    store.delete_many([1, 3])
+
+    assert store.ids.tolist() == [2, 5]
+    assert store.texts == ["B", "e"]
+    assert store.select_nearest([1.0, 0.0], 1)[0].text == "B"
+    assert store.insert_vector("f", [0.0, 1.0]) == 6
+
+
+def test_save_load(tmp_path):
+    """Test that saved vectors are loaded memory-mapped and stay writable"""
+
+    store = NumpyVectorStore(tmp_path)
+    store.insert_many(["a", "b"], [[1.0, 0.0], [0.0, 1.0]], subject_id=1)
+    store.save()
+
+    store = NumpyVectorStore(tmp_path)
+    assert isinstance(store.embeddings, np.memmap)
+    assert [m.text for m in store.select_nearest([0.0, 1.0], 1, subject_id=1)] == ["b"]
+
+    store.insert_vector("c", [1.0, 1.0])
+    assert store.insert_vector("d", [1.0, 1.0]) == 4
+    assert len(store) == 4
+
+
+def test_refresh(tmp_path):
+    """Test that a reader loads the vectors saved by another store"""
+
+    writer = NumpyVectorStore(tmp_path)
+    writer.insert_many(["a", "b"], [[1.0, 0.0], [0.0, 1.0]])
+    writer.save()
+    reader = NumpyVectorStore(tmp_path)
+
+    writer.delete_vector(1)
+    writer.insert_vector("c", [1.0, 1.0])
+    writer.save()
+    reader.refresh()
+
+    assert reader.texts == ["b", "c"]
+    assert [m.text for m in reader.select_nearest([1.0, 1.0], 1)] == ["c"]
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+
+
+def test_metric_mismatch(tmp_path):
+    """Test that vectors saved with another metric are not loaded"""
+
+    store = NumpyVectorStore(tmp_path, metric="cosine")
+    store.insert_vector("a", [1.0, 0.0])
+    store.save()
+
+    with pytest.raises(ValueError):
+        NumpyVectorStore(tmp_path)
+    store = get_vector_store(f"numpy://{tmp_path}?metric=cosine")
+    assert (store.metric, store.texts) == ("cosine", ["a"])
+
+
+def test_vector_store_options(tmp_path):
+    """Test that the NumPy backend's URL options are parsed and validated"""
+
+    store = get_vector_store(f"numpy://{tmp_path}?mmap=false&metric=dot")
+    assert (store.mmap, store.metric) == (False, "dot")
+    assert get_vector_store(f"numpy://{tmp_path}?mmap=True").mmap is True
+
+    for query in ["mmap=no", "metric=l1", "mmap_mode=r", "metric"]:
+        with pytest.raises(ValueError):
+            get_vector_store(f"numpy://{tmp_path}?{query}")
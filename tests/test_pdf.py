@@ -0,0 +1,49 @@
+"""tests/test_pdf.py"""
+
+import pytest
+from fitz import fitz
+
+from scraibe.pdf import pdf_to_txt
+
+
+def make_pdf(fp, pages: int) -> None:
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {i}")
+    doc.save(fp)
+    doc.close()
+
+
+def test_pdf_to_txt(tmp_path):
+    """Test that serial and page-parallel extraction write the same text"""
+
+    pdf_fp = tmp_path.joinpath("note.pdf")
+    make_pdf(pdf_fp, 7)
+
+    serial_fp = pdf_to_txt(pdf_fp, tmp_path.joinpath("serial.txt"))
+    parallel_fp = pdf_to_txt(
+        pdf_fp, tmp_path.joinpath("parallel.txt"), workers=2, pages_per_worker=2
+    )
+
+    text = serial_fp.read_text(encoding="utf-8")
+    assert text.split() == [word for i in range(7) for word in ("Page", str(i))]
+    assert parallel_fp.read_text(encoding="utf-8") == text
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_pdf_to_txt_failure(tmp_path, monkeypatch):
+    """Test that a failed conversion leaves no temporary file behind"""
+
+    pdf_fp = tmp_path.joinpath("note.pdf")
+    make_pdf(pdf_fp, 2)
+
+    def fsync(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr("scraibe.pdf.os.fsync", fsync)
+    with pytest.raises(OSError):
+        pdf_to_txt(pdf_fp, tmp_path.joinpath("note.txt"))
+
+    assert not list(tmp_path.glob("*.tmp"))
+    assert not tmp_path.joinpath("note.txt").exists()
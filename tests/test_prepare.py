@@ -0,0 +1,49 @@
+"""tests/test_prepare.py"""
+
+import gzip
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data.prepare import gz_to_csv, uncompress
+
+TEXT = "subject_id,hadm_id,drug\n1,20,Heparin\n2,,Fentanyl\n"
+
+
+def make_gz(fp, text: str = TEXT):
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(fp, "wt", newline="") as f:
+        f.write(text)
+    return fp
+
+
+def test_gz_to_csv(tmp_path):
+    """Test that a .csv.gz file is uncompressed in small buffers"""
+
+    out_fp = gz_to_csv(make_gz(tmp_path.joinpath("a.csv.gz")), buffer_size=8)
+
+    assert out_fp == tmp_path.joinpath("a.csv")
+    assert out_fp.read_text() == TEXT
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_uncompress(tmp_path):
+    """Test that the tables of every folder are converted and archived"""
+
+    make_gz(tmp_path.joinpath("hosp", "prescriptions.csv.gz"))
+    make_gz(tmp_path.joinpath("icu", "icustays.csv.gz"))
+    folders = [tmp_path.joinpath("hosp"), tmp_path.joinpath("icu")]
+
+    uncompress(workers=1, to_parquet=True, folders=folders)
+
+    table = pq.read_table(tmp_path.joinpath("hosp", "prescriptions.parquet"))
+    assert table.schema.field("subject_id").type == pa.int32()
+    assert table.column("hadm_id").to_pylist() == [20, None]
+    assert table.column("drug").to_pylist() == ["Heparin", "Fentanyl"]
+    assert tmp_path.joinpath("icu", "icustays.parquet").exists()
+    assert tmp_path.joinpath("archive", "icu", "icustays.csv.gz").exists()
+    assert not list(tmp_path.glob("*/*.csv.gz"))
+
+    make_gz(tmp_path.joinpath("hosp", "patients.csv.gz"))
+    uncompress(workers=1, folders=folders[:1])
+    assert tmp_path.joinpath("hosp", "patients.csv").read_text() == TEXT
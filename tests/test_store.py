@@ -0,0 +1,110 @@
+"""tests/test_store.py"""
+
+import numpy as np
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql
+
+from scraibe.store import BaseVectorStore, Vector, VectorStore
+
+
+def make_store(tmp_path) -> VectorStore:
+    """
+    Create a VectorStore on a SQLite database, with an l2sq_dist function.
+    """
+    store = VectorStore(f"sqlite:///{tmp_path.joinpath('vectors.sqlite')}")
+
+    def l2sq_dist(a: bytes, b: bytes) -> float:
+        a, b = np.frombuffer(a, "<f4"), np.frombuffer(b, "<f4")
+        return float(((a - b) ** 2).sum())
+
+    @event.listens_for(store.engine, "connect")
+    def connect(dbapi_connection, _):
+        dbapi_connection.create_function("l2sq_dist", 2, l2sq_dist)
+
+    store.create_table()
+    return store
+
+
+def compile_query(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+def test_nearest_query():
+    """Test that searches use the index operator and exact searches do not"""
+
+    query = compile_query(VectorStore.nearest_query([0.1, 0.2], limit=5))
+    order_by = query.split("ORDER BY")[1]
+    assert "<->" in order_by
+    assert "l2sq_dist" not in order_by
+    assert "LIMIT" in query
+
+    query = compile_query(VectorStore.nearest_query([0.1, 0.2], exact=True))
+    order_by = query.split("ORDER BY")[1]
+    assert "<->" not in order_by
+    assert "l2sq_dist" in order_by
+
+
+def test_nearest_query_filters():
+    """Test that metadata filters are applied"""
+
+    query = VectorStore.nearest_query(
+        [0.1, 0.2], subject_id=10000032, filter=Vector.note_id != "a"
+    )
+    where = compile_query(query).split("WHERE")[1].split("ORDER BY")[0]
+    assert "vectors.subject_id =" in where
+    assert "vectors.note_id !=" in where
+
+
+def test_upsert_statement():
+    """Test that upserts update existing ids in one statement"""
+
+    query = compile_query(VectorStore.upsert_statement("postgresql"))
+    assert query.startswith("INSERT INTO vectors")
+    assert "ON CONFLICT (id) DO UPDATE SET text = excluded.text" in query
+    assert "embedding = excluded.embedding" in query
+
+
+def test_vector_store(tmp_path):
+    """Test batch mutations and exact searches"""
+
+    store = make_store(tmp_path)
+
+    ids = store.insert_many(
+        ["a", "b", "c"], [[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]], subject_id=1
+    )
+    assert ids == [1, 2, 3]
+    assert store.insert_vector("d", [2.0, 2.0]) == 4
+
+    store.upsert_many([2, 5], ["B", "e"], [[0.9, 0.1], [0.0, 1.0]])
+    store.update_embedding(3, [0.1, 0.2])
+    store.delete_many([1, 4])
+
+    matches = store.select_nearest([1.0, 0.0], limit=3, exact=True)
+    assert [m.text for m in matches] == ["B", "c", "e"]
+    assert matches[0].distance == pytest.approx(0.02)
+
+    matches = store.select_nearest([1.0, 0.0], limit=3, exact=True, subject_id=1)
+    assert [m.text for m in matches] == ["B", "c"]
+
+
+def test_embedding_storage(tmp_path):
+    """Test that embeddings are stored as packed float32"""
+
+    store = make_store(tmp_path)
+    store.insert_many(["a"], [[0.1] * 1536])
+
+    with store.engine.connect() as conn:
+        stored = conn.execute(text("SELECT embedding FROM vectors")).scalar_one()
+    assert len(stored) == 1536 * 4
+
+    with store.Session() as session:
+        vector = session.get(Vector, 1)
+    assert vector.embedding == [np.float32(0.1)] * 1536
+
+
+def test_base_vector_store_is_abstract():
+    """Test that backends must implement the vector store interface"""
+
+    with pytest.raises(TypeError):
+        BaseVectorStore()
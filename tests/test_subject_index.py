@@ -0,0 +1,66 @@
+"""tests/test_subject_index.py"""
+
+from scraibe.subject_index import SubjectIndex
+
+
+def test_subject_index(tmp_path):
+    """
+    Test SubjectIndex reads each subject's rows, including quoted newlines.
+    """
+
+    csv_fp = tmp_path.joinpath("notes.csv")
+    csv_fp.write_bytes(
+        b"note_id,subject_id,text\n"
+        b"1,100,plain\n"
+        b'2,100,"multi\nline, quoted"\n'
+        b"3,101,other\n"
+        b'4,"100",again\n'
+        b"5,102,no trailing newline"
+    )
+
+    index = SubjectIndex.load(csv_fp)
+    assert SubjectIndex.index_path(csv_fp).exists()
+    assert index.subject_ids.tolist() == [100, 100, 101, 102]
+
+    assert index.read(100) == (
+        b"note_id,subject_id,text\n"
+        b"1,100,plain\n"
+        b'2,100,"multi\nline, quoted"\n'
+        b'4,"100",again\n'
+    )
+    assert index.read(102) == (
+        b"note_id,subject_id,text\n" b"5,102,no trailing newline"
+    )
+    assert index.read(999) == b"note_id,subject_id,text\n"
+
+    # The saved index is reused until the file changes
+    assert SubjectIndex.load(csv_fp).ranges(101) == index.ranges(101)
+    with csv_fp.open("ab") as f:
+        f.write(b"\n6,101,appended\n")
+    assert (
+        SubjectIndex.load(csv_fp).read(101).endswith(b"3,101,other\n6,101,appended\n")
+    )
+
+
+def test_subject_index_without_subject_id(tmp_path):
+    """
+    Test SubjectIndex is None for files without a subject_id column.
+    """
+
+    csv_fp = tmp_path.joinpath("d_items.csv")
+    csv_fp.write_text("itemid,label\n1,a\n")
+
+    assert SubjectIndex.load(csv_fp) is None
+
+
+def test_subject_index_missing_subject_id(tmp_path):
+    """
+    Test SubjectIndex skips rows without a subject_id.
+    """
+
+    csv_fp = tmp_path.joinpath("notes.csv")
+    csv_fp.write_text("note_id,subject_id\n1,100\n2,\n3,n/a\n4\n5,100\n")
+
+    index = SubjectIndex.load(csv_fp)
+    assert index.subject_ids.tolist() == [100, 100]
+    assert index.read(100) == b"note_id,subject_id\n1,100\n5,100\n"
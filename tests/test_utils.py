@@ -0,0 +1,71 @@
+"""tests/test_utils.py"""
+
+import importlib
+import os
+import sys
+import types
+
+import scraibe.utils
+from scraibe.utils import lock_file, try_lock, unlock_file
+
+
+def test_try_lock(tmp_path):
+    """Test that a lock is held by one file descriptor at a time"""
+
+    fp = tmp_path.joinpath("x.lock")
+    fd = try_lock(fp)
+    assert fd is not None
+    assert try_lock(fp) is None
+
+    os.close(fd)
+    fd = try_lock(fp)
+    assert fd is not None
+    os.close(fd)
+
+
+def test_lock_file(tmp_path):
+    """Test that shared locks exclude exclusive locks only"""
+
+    fp = tmp_path.joinpath("x.lock")
+    fp.touch()
+    a, b = os.open(fp, os.O_RDONLY), os.open(fp, os.O_RDONLY)
+
+    assert lock_file(a, shared=True)
+    assert lock_file(b, shared=True, blocking=False)
+    unlock_file(b)
+    assert not lock_file(b, blocking=False)
+    unlock_file(a)
+    assert lock_file(b, blocking=False)
+
+    os.close(a)
+    os.close(b)
+
+
+def test_try_lock_without_fcntl(tmp_path, monkeypatch):
+    """Test that locks fall back to msvcrt where fcntl is missing"""
+
+    locked = set()
+
+    def locking(fd, mode, nbytes):
+        key = os.fstat(fd).st_ino
+        if mode == msvcrt.LK_UNLCK:
+            locked.discard(key)
+        elif key in locked:
+            raise OSError("locked")
+        else:
+            locked.add(key)
+
+    msvcrt = types.SimpleNamespace(LK_NBLCK=2, LK_UNLCK=0, locking=locking)
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    monkeypatch.setitem(sys.modules, "msvcrt", msvcrt)
+    utils = importlib.reload(scraibe.utils)
+    try:
+        fp = tmp_path.joinpath("x.lock")
+        fd = utils.try_lock(fp)
+        assert fd is not None
+        assert utils.try_lock(fp) is None
+        utils.unlock_file(fd)
+        os.close(fd)
+    finally:
+        monkeypatch.undo()
+        importlib.reload(scraibe.utils)